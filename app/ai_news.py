@@ -1,38 +1,43 @@
 import json
 from fastapi import APIRouter, Request, Form, Depends, HTTPException, UploadFile, File, Body
-from fastapi.responses import RedirectResponse, FileResponse, HTMLResponse, Response, PlainTextResponse, JSONResponse
-from app.deps import require_admin, get_current_user, get_docs_coll, get_db
+from fastapi.responses import RedirectResponse, HTMLResponse, Response, PlainTextResponse, JSONResponse
+from app.deps import require_admin, get_current_user, get_db, get_unread_counts
 from app.utils.save_with_notifica import save_and_notify
 from bson import ObjectId
 from datetime import datetime, timedelta
 from pathlib import Path
 from motor.motor_asyncio import AsyncIOMotorCollection
-import aiofiles
 from mimetypes import guess_type
 from app.notifiche import crea_notifica, crea_notifica_commento
 from fastapi.templating import Jinja2Templates
 from app.models.ai_news_model import AINewsBase, AINewsDB, CommentBase, CommentDB, ViewIn, ViewActionType
 from fastapi import Query
-from app.ws_broadcast import broadcast_message, broadcast_resource_event
+from app.ws_broadcast import broadcast_message, broadcast_resource_event, broadcast_batch
 from typing import Optional
 from pydantic import BaseModel, GetCoreSchemaHandler
 from pydantic_core import core_schema
 import bleach
-import re
 import os
 import shutil
 from app.utils.notification_helpers import create_action_notification_payload, create_admin_confirmation_trigger
-try:
-    from markdown_it import MarkdownIt
-except ImportError:
-    MarkdownIt = None
+from app.utils import keyset, home_feed, photos
+from app.utils.uploads import safe_filename, UploadTooLarge
+from app.utils import blob_store, comment_cascade
+from app.utils.downloads import file_response
+from app.utils.markdown_render import render_markdown
 from pymongo import ReturnDocument
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 # Costante per il percorso base dei documenti AI
 BASE_AI_NEWS_DIR = Path("media/docs/ai_news")   # cartella radice documenti AI
+AI_NEWS_MAX_FILE_SIZE = int(os.getenv("AI_NEWS_MAX_FILE_SIZE", str(200 * 1024 * 1024)))  # 200 MB
 
 # Costanti di configurazione
 DEBOUNCE_HOURS = 24  # tempo minimo fra due view validanti
+AI_NEWS_PAGE_SIZE = 50  # news per pagina nella lista HTML /ai-news
 
 def to_str_id(doc: dict) -> dict:
     """Converte ObjectId fields in stringa per i template Jinja o JSON risposte."""
@@ -109,20 +114,21 @@ async def upload_ai_news(
         employment_type_list = ['*']
 
 
-    # 1. Salva il file fisicamente (se presente)
-    docs_dir = BASE_AI_NEWS_DIR
-    docs_dir.mkdir(parents=True, exist_ok=True)
+    # 1. Salva il file nell'archivio per contenuto (se presente)
+    db = request.app.state.db
     filename_on_disk = None
     file_content_type = None
+    stored = None
 
     if file and file.filename:
-        # Basic sanitization, consider more robust methods
-        safe_filename = re.sub(r"[^\w\.-]", "_", file.filename)
-        dest = docs_dir / safe_filename
-        async with aiofiles.open(dest, "wb") as out:
-            content = await file.read() # Read file content
-            await out.write(content)   # Write to disk
-        filename_on_disk = safe_filename
+        try:
+            stored = await blob_store.put_upload(db, file, max_bytes=AI_NEWS_MAX_FILE_SIZE)
+        except UploadTooLarge:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Il file supera il limite di {AI_NEWS_MAX_FILE_SIZE // (1024 * 1024)} MB."
+            )
+        filename_on_disk = safe_filename(file.filename)
         file_content_type = file.content_type
 
     # Se non c'è né file né link, errore
@@ -132,7 +138,6 @@ async def upload_ai_news(
         # Or raise HTTPException if a JSON error response is preferred for API-like behavior.
         raise HTTPException(status_code=400, detail="Devi caricare un file o inserire un link esterno.")
 
-    db = request.app.state.db
     doc_data = {
         "title": title.strip(),
         "branch": branch.strip(),
@@ -140,6 +145,9 @@ async def upload_ai_news(
         "tags": [tag.strip() for tag in tags.split(",")] if tags and tags.strip() else [],
         "filename": filename_on_disk,
         "content_type": file_content_type,
+        "blob": stored.sha256 if stored else None,
+        "size": stored.size if stored else None,
+        "sha256": stored.sha256 if stored else None,
         "external_url": external_url.strip() if external_url else None,
         "uploaded_at": datetime.utcnow(),
         "category": category.strip(),
@@ -161,45 +169,48 @@ async def upload_ai_news(
         source_user_id=str(current_user["_id"]) # User who performed the action
     )
 
-    # 5. Invia WebSocket toast per non-admin
-    payload_toast = create_action_notification_payload(
-        'create', # Action: 'create', 'update', 'delete'
-        'ai_news',   # Resource type for client-side handling
-        title.strip(), # Title of the resource
-        str(current_user["_id"]) # ID of the user who performed the action
-    )
-    await broadcast_message(
-        payload_toast,
-        branch=branch.strip(),
-        employment_type=employment_type_list,
-        exclude_user_id=str(current_user["_id"]) # Exclude the admin who created it
-    )
+    # Eventi WebSocket della creazione raggruppati in un frame per client
+    async with broadcast_batch():
+        # 5. Invia WebSocket toast per non-admin
+        payload_toast = create_action_notification_payload(
+            'create', # Action: 'create', 'update', 'delete'
+            'ai_news',   # Resource type for client-side handling
+            title.strip(), # Title of the resource
+            str(current_user["_id"]) # ID of the user who performed the action
+        )
+        await broadcast_message(
+            payload_toast,
+            branch=branch.strip(),
+            employment_type=employment_type_list,
+            exclude_user_id=str(current_user["_id"]) # Exclude the admin who created it
+        )
 
-    # 6. Broadcast dell'evento generico per aggiornare UI (es. liste)
-    await broadcast_resource_event(
-        event="add", # "add", "update", "delete"
-        item_type="ai_news",
-        item_id=new_id,
-        user_id=str(current_user["_id"]),
-        data_filter_criteria={"branch": branch.strip(), "employment_type": employment_type_list} # For client-side filtering
-    )
+        # 6. Broadcast dell'evento generico per aggiornare UI (es. liste)
+        await broadcast_resource_event(
+            event="add", # "add", "update", "delete"
+            item_type="ai_news",
+            item_id=new_id,
+            user_id=str(current_user["_id"]),
+            data_filter_criteria={"branch": branch.strip(), "employment_type": employment_type_list} # For client-side filtering
+        )
 
-    # 7. Aggiorna home_highlights se show_on_home è True
-    if show_on_home:
-        await db.home_highlights.insert_one({
-            "type": "ai_news",
-            "object_id": new_id, # Store as string ID
-            "title": title.strip(),
-            "branch": branch.strip(),
-            "employment_type": employment_type_list,
-            "created_at": doc_data["uploaded_at"] # Use the same creation timestamp
-        })
-        # Broadcast refresh for home highlights
-        payload_highlight = {
-            "type": "refresh_home_highlights",
-            "data": {"branch": branch.strip(), "employment_type": employment_type_list}
-        }
-        await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type_list)
+        # 7. Aggiorna home_highlights se show_on_home è True
+        if show_on_home:
+            await db.home_highlights.insert_one({
+                "type": "ai_news",
+                "object_id": new_id, # Store as string ID
+                "title": title.strip(),
+                "branch": branch.strip(),
+                "employment_type": employment_type_list,
+                "created_at": doc_data["uploaded_at"] # Use the same creation timestamp
+            })
+            await home_feed.highlight_changed("ai_news", new_id)
+            # Broadcast refresh for home highlights
+            payload_highlight = {
+                "type": "refresh_home_highlights",
+                "data": {"branch": branch.strip(), "employment_type": employment_type_list}
+            }
+            await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type_list)
 
     # 8. Risposta di conferma per l'admin con chiusura modale e redirect/refresh
     resp = Response(status_code=200) # Empty 200 OK, triggers in headers
@@ -329,60 +340,63 @@ async def edit_ai_news_submit(
         source_user_id=str(current_user["_id"])
     )
 
-    # WebSocket toast for non-admin users
-    payload_toast = create_action_notification_payload(
-        'update', # Action
-        'ai_news',   # Resource type
-        title.strip(), # Title
-        str(current_user["_id"]) # User ID
-    )
-    await broadcast_message(
-        payload_toast,
-        branch=branch.strip(),
-        employment_type=employment_type_list,
-        exclude_user_id=str(current_user["_id"])
-    )
-
-    # Home Highlights Management
-    # Fetch the *updated* document to get its creation date for highlights consistency
-    # (or pass original_doc.get("uploaded_at") if fetched before update)
-    updated_doc_for_highlight = await db.ai_news.find_one({"_id": object_id_doc})
-    created_at_for_highlight = updated_doc_for_highlight.get("uploaded_at", datetime.utcnow())
-
-    if show_on_home:
-        await db.home_highlights.update_one(
-            {"type": "ai_news", "object_id": doc_id}, # Use string doc_id for consistency if object_id is string
-            {"$set": {
-                "type": "ai_news", "object_id": doc_id, "title": title.strip(),
-                "branch": branch.strip(), "employment_type": employment_type_list,
-                "created_at": created_at_for_highlight
-            }},
-            upsert=True
+    # Un solo frame WebSocket per client con tutti gli eventi dell'aggiornamento
+    async with broadcast_batch():
+        # WebSocket toast for non-admin users
+        payload_toast = create_action_notification_payload(
+            'update', # Action
+            'ai_news',   # Resource type
+            title.strip(), # Title
+            str(current_user["_id"]) # User ID
+        )
+        await broadcast_message(
+            payload_toast,
+            branch=branch.strip(),
+            employment_type=employment_type_list,
+            exclude_user_id=str(current_user["_id"])
         )
-    else: # If not show_on_home, ensure it's removed from highlights
-        await db.home_highlights.delete_one({"type": "ai_news", "object_id": doc_id})
-
-    # Always broadcast highlight refresh to relevant users as criteria might have changed
-    # or item added/removed from home.
-    payload_highlight_refresh = {
-        "type": "refresh_home_highlights",
-        # Send new criteria. If item removed, users matching old criteria also need refresh.
-        # This might require fetching original_doc for old criteria if they could change.
-        # For now, simplifying to new criteria.
-        "data": {"branch": branch.strip(), "employment_type": employment_type_list}
-    }
-    await broadcast_message(payload_highlight_refresh, branch=branch.strip(), employment_type=employment_type_list)
 
+        # Home Highlights Management
+        # Fetch the *updated* document to get its creation date for highlights consistency
+        # (or pass original_doc.get("uploaded_at") if fetched before update)
+        updated_doc_for_highlight = await db.ai_news.find_one({"_id": object_id_doc})
+        created_at_for_highlight = updated_doc_for_highlight.get("uploaded_at", datetime.utcnow())
+
+        if show_on_home:
+            await db.home_highlights.update_one(
+                {"type": "ai_news", "object_id": doc_id}, # Use string doc_id for consistency if object_id is string
+                {"$set": {
+                    "type": "ai_news", "object_id": doc_id, "title": title.strip(),
+                    "branch": branch.strip(), "employment_type": employment_type_list,
+                    "created_at": created_at_for_highlight
+                }},
+                upsert=True
+            )
+        else: # If not show_on_home, ensure it's removed from highlights
+            await db.home_highlights.delete_one({"type": "ai_news", "object_id": doc_id})
+        await home_feed.highlight_changed("ai_news", doc_id)
 
-    # WebSocket event for UI update (e.g., refreshing the specific row in a list)
-    await broadcast_resource_event(
-        event="update",
-        item_type="ai_news",
-        item_id=doc_id, # doc_id is already string
-        user_id=str(current_user["_id"]),
-        # Pass data that might be needed by client to update the row, or client refetches
-        data_filter_criteria={"branch": branch.strip(), "employment_type": employment_type_list}
-    )
+        # Always broadcast highlight refresh to relevant users as criteria might have changed
+        # or item added/removed from home.
+        payload_highlight_refresh = {
+            "type": "refresh_home_highlights",
+            # Send new criteria. If item removed, users matching old criteria also need refresh.
+            # This might require fetching original_doc for old criteria if they could change.
+            # For now, simplifying to new criteria.
+            "data": {"branch": branch.strip(), "employment_type": employment_type_list}
+        }
+        await broadcast_message(payload_highlight_refresh, branch=branch.strip(), employment_type=employment_type_list)
+
+
+        # WebSocket event for UI update (e.g., refreshing the specific row in a list)
+        await broadcast_resource_event(
+            event="update",
+            item_type="ai_news",
+            item_id=doc_id, # doc_id is already string
+            user_id=str(current_user["_id"]),
+            # Pass data that might be needed by client to update the row, or client refetches
+            data_filter_criteria={"branch": branch.strip(), "employment_type": employment_type_list}
+        )
 
     # Return the updated row partial
     updated_doc_for_template = await db.ai_news.find_one({"_id": object_id_doc})
@@ -409,6 +423,13 @@ async def edit_ai_news_submit(
 
     return resp
 
+def _stored_filename(doc: dict) -> Optional[str]:
+    """Nome del file allegato: struttura nuova (content.type == file) o vecchia (filename a livello root)."""
+    content = doc.get("content") or {}
+    if content.get("type") == "file" and content.get("filename"):
+        return content["filename"]
+    return doc.get("filename")
+
 @ai_news_router.get("/ai-news/{doc_id}/download")  # Modificato da /ai-news/{doc_id}
 async def download_ai_news(doc_id: str, request: Request):
     db = request.app.state.db
@@ -417,10 +438,17 @@ async def download_ai_news(doc_id: str, request: Request):
         doc = await db.ai_news.find_one({"_id": ObjectId(doc_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Documento AI non trovato")
-    file_path = BASE_AI_NEWS_DIR / doc["filename"]
-    if not file_path.exists():
+    filename = _stored_filename(doc)
+    file_path = blob_store.resolve(doc, BASE_AI_NEWS_DIR, filename) if filename else None
+    if not file_path or not file_path.exists():
         raise HTTPException(404, "File non trovato")
-    return FileResponse(path=file_path, filename=doc["filename"], media_type=doc.get("content_type", "application/octet-stream"))
+    return file_response(
+        request, file_path,
+        filename=filename,
+        media_type=doc.get("content_type", "application/octet-stream"),
+        etag=blob_store.strong_etag(doc),
+        immutable=bool(doc.get("blob"))
+    )
 
 @ai_news_router.get("/api/ai-news/{doc_id}/preview")
 async def preview_ai_news(doc_id: str, request: Request):
@@ -430,30 +458,29 @@ async def preview_ai_news(doc_id: str, request: Request):
         doc = await db.ai_news.find_one({"_id": ObjectId(doc_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Documento AI non trovato")
-    # Primo caso: struttura nuova (content.type == file)
-    if doc.get("content", {}).get("type") == "file" and doc.get("content", {}).get("filename"):
-        filename = doc["content"]["filename"]
-    # Secondo caso: struttura vecchia (filename a livello root)
-    elif doc.get("filename"):
-        filename = doc["filename"]
-    else:
+    filename = _stored_filename(doc)
+    if not filename:
         raise HTTPException(status_code=400, detail="Tipo di contenuto non supportato per l'anteprima")
-    file_path = BASE_AI_NEWS_DIR / filename
+    file_path = blob_store.resolve(doc, BASE_AI_NEWS_DIR, filename)
     if not file_path.exists():
         raise HTTPException(404, "File non trovato")
-    mime, _ = guess_type(str(file_path))
-    headers = {"Content-Disposition": f'inline; filename="{filename}"'}
-    return FileResponse(
-        path=file_path,
+    # I blob non hanno estensione: il tipo si ricava dal nome originale
+    mime, _ = guess_type(filename)
+    return file_response(
+        request, file_path,
         filename=filename,
-        media_type=mime or "application/octet-stream",
-        headers=headers
+        media_type=mime,
+        etag=blob_store.strong_etag(doc),
+        immutable=bool(doc.get("blob")),
+        inline=True
     )
 
-@ai_news_router.get("/ai-news", response_class=HTMLResponse)
+@ai_news_router.get("/ai-news", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def list_ai_news(
     request: Request,
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_user),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(AI_NEWS_PAGE_SIZE, ge=1, le=200)
 ):
     db = request.app.state.db
     employment_type = current_user.get("employment_type")
@@ -477,20 +504,39 @@ async def list_ai_news(
                 }
             ]
         }
-    ai_news = await db.ai_news.find(mongo_filter).sort("uploaded_at", -1).to_list(None)
-    # Aggiungi lo stato dei like per ogni notizia
+    total = await db.ai_news.count_documents(mongo_filter)
+    total_pages = max(1, -(-total // page_size))
+    page = min(page, total_pages)
+    ai_news = await (
+        db.ai_news.find(mongo_filter)
+        .sort("uploaded_at", -1)
+        .skip((page - 1) * page_size)
+        .limit(page_size)
+        .to_list(page_size)
+    )
+    # Stato dei like dell'utente per tutta la pagina con una sola query
+    liked_ids = {
+        like["news_id"]
+        async for like in db.ai_news_likes.find(
+            {
+                "user_id": ObjectId(current_user["_id"]),
+                "news_id": {"$in": [news["_id"] for news in ai_news]}
+            },
+            {"news_id": 1, "_id": 0}
+        )
+    }
     for news in ai_news:
-        user_like = await db.ai_news_likes.find_one({
-            "news_id": ObjectId(news["_id"]),
-            "user_id": ObjectId(current_user["_id"])
-        })
-        news["user_liked"] = bool(user_like)
+        news["user_liked"] = news["_id"] in liked_ids
     return request.app.state.templates.TemplateResponse(
         "ai_news.html",
         {
             "request": request,
             "ai_news": ai_news,
-            "user": current_user
+            "user": current_user,
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "total_pages": total_pages
         }
     )
 
@@ -519,52 +565,58 @@ async def delete_ai_news(
         employment_type_from_doc = [employment_type_from_doc]
 
 
-    # Delete physical file if it exists and filename is present
-    if doc_to_delete.get("filename"):
-        file_path = BASE_AI_NEWS_DIR / doc_to_delete["filename"]
+    # Delete the document from DB
+    await db.ai_news.delete_one({"_id": object_id_to_delete})
+
+    # Release the stored file (the blob is removed with its last reference);
+    # documents uploaded before the blob store still have a file in BASE_AI_NEWS_DIR
+    if doc_to_delete.get("blob"):
+        await blob_store.release(db, doc_to_delete["blob"])
+    elif _stored_filename(doc_to_delete):
+        file_path = BASE_AI_NEWS_DIR / _stored_filename(doc_to_delete)
         if file_path.exists():
             try:
                 os.remove(file_path)
             except Exception as e:
-                print(f"Error deleting file {file_path}: {e}") # Log error but continue deletion
-
-    # Delete the document from DB
-    await db.ai_news.delete_one({"_id": object_id_to_delete})
+                logger.error("Error deleting file %s: %s", file_path, e) # Log error but continue deletion
 
     # Remove from home_highlights (use string doc_id as object_id is stored as string there)
     await db.home_highlights.delete_one({"type": "ai_news", "object_id": doc_id})
+    await home_feed.highlight_changed("ai_news", doc_id)
+
+    # Toast, rimozione riga e refresh highlights arrivano in un solo frame
+    async with broadcast_batch():
+        # 1. WebSocket for non-admin toast notification
+        payload_toast = create_action_notification_payload(
+            'delete', # action
+            'ai_news',   # resource_type
+            title,    # resource_title
+            str(current_user["_id"]) # user_id
+        )
+        await broadcast_message(
+            payload_toast,
+            branch=branch, # Use branch from the deleted doc
+            employment_type=employment_type_from_doc, # Use employment_type from the deleted doc
+            exclude_user_id=str(current_user["_id"])
+        )
 
-    # 1. WebSocket for non-admin toast notification
-    payload_toast = create_action_notification_payload(
-        'delete', # action
-        'ai_news',   # resource_type
-        title,    # resource_title
-        str(current_user["_id"]) # user_id
-    )
-    await broadcast_message(
-        payload_toast,
-        branch=branch, # Use branch from the deleted doc
-        employment_type=employment_type_from_doc, # Use employment_type from the deleted doc
-        exclude_user_id=str(current_user["_id"])
-    )
-
-    # 2. WebSocket for UI update (list refresh / row removal)
-    await broadcast_resource_event(
-        event="delete",
-        item_type="ai_news",
-        item_id=doc_id, # doc_id is already a string here
-        user_id=str(current_user["_id"]),
-        # Pass criteria of the deleted item so clients can filter if necessary
-        data_filter_criteria={"branch": branch, "employment_type": employment_type_from_doc}
-    )
+        # 2. WebSocket for UI update (list refresh / row removal)
+        await broadcast_resource_event(
+            event="delete",
+            item_type="ai_news",
+            item_id=doc_id, # doc_id is already a string here
+            user_id=str(current_user["_id"]),
+            # Pass criteria of the deleted item so clients can filter if necessary
+            data_filter_criteria={"branch": branch, "employment_type": employment_type_from_doc}
+        )
 
-    # 3. Refresh highlights if it was on home (or just always refresh for relevant users)
-    # No need to check was_on_home, just send refresh to those who might have seen it based on its criteria
-    payload_highlight_refresh = {
-        "type": "refresh_home_highlights",
-        "data": {"branch": branch, "employment_type": employment_type_from_doc}
-    }
-    await broadcast_message(payload_highlight_refresh, branch=branch, employment_type=employment_type_from_doc)
+        # 3. Refresh highlights if it was on home (or just always refresh for relevant users)
+        # No need to check was_on_home, just send refresh to those who might have seen it based on its criteria
+        payload_highlight_refresh = {
+            "type": "refresh_home_highlights",
+            "data": {"branch": branch, "employment_type": employment_type_from_doc}
+        }
+        await broadcast_message(payload_highlight_refresh, branch=branch, employment_type=employment_type_from_doc)
 
     # 4. Admin confirmation via HX-Trigger
     resp = Response(status_code=200) # HTMX expects 200 for swap, even on delete if hx-target is used for row removal
@@ -577,8 +629,8 @@ async def delete_ai_news(
 async def list_ai_news_api(
     request: Request,
     current_user = Depends(get_current_user),
-    skip: int = 0,
-    limit: int = 20,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
     section: Optional[str] = None,
     branch: Optional[str] = None,
     search: Optional[str] = None
@@ -592,15 +644,26 @@ async def list_ai_news_api(
         mongo_filter["section"] = section
     if branch:
         mongo_filter["branch"] = branch
+    search = (search or "").strip()
+    pipeline = []
     if search:
-        mongo_filter["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"tags": {"$regex": search, "$options": "i"}}
-        ]
-    cursor = db.ai_news.find(mongo_filter)
-    total = await db.ai_news.count_documents(mongo_filter)
-    news = await cursor.sort("uploaded_at", -1).skip(skip).limit(limit).to_list(None)
+        # Ricerca full-text sull'indice ai_news_text (app/utils/indexes.py): stemming italiano,
+        # accenti ignorati, risultati ordinati per rilevanza
+        mongo_filter["$text"] = {"$search": search}
+        pipeline.append({"$match": mongo_filter})
+        pipeline.append({"$addFields": {"score": {"$meta": "textScore"}}})
+        sort = {"score": -1, "uploaded_at": -1}
+    else:
+        pipeline.append({"$match": mongo_filter})
+        sort = {"uploaded_at": -1}
+    # Totale e pagina con un'unica aggregazione
+    pipeline.append({"$facet": {
+        "total": [{"$count": "n"}],
+        "items": [{"$sort": sort}, {"$skip": skip}, {"$limit": limit}]
+    }})
+    result = (await db.ai_news.aggregate(pipeline).to_list(1))[0]
+    total = result["total"][0]["n"] if result["total"] else 0
+    news = result["items"]
     for doc in news:
         doc["_id"] = str(doc["_id"])
         doc["author_id"] = str(doc["author_id"])
@@ -725,7 +788,7 @@ async def add_view(
     )
 
     if not should_increment:
-        print("[DEBUG_AI_NEWS] view debounced")
+        logger.debug("[AI_NEWS] view debounced")
         return {"success": True, "debounced": True}
 
     # ── 3. incrementa il campo views sulla news -------------------
@@ -805,20 +868,22 @@ async def get_stats(
 async def get_comments(
     request: Request,
     news_id: str,
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = None,
     page_size: int = Query(5, ge=1, le=20),
     db = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     try:
         news_oid = ObjectId(news_id)
-        skip = (page - 1) * page_size
-        total_count = await db.ai_news_comments.count_documents({"news_id": news_oid})
-        comments = await db.ai_news_comments.find(
-            {"news_id": news_oid}
-        ).sort(
-            [("created_at", 1)]
-        ).skip(skip).limit(page_size).to_list(None)
+        # Totale dal contatore mantenuto da add_comment/delete_comment
+        news = await db.ai_news.find_one({"_id": news_oid}, {"stats.comments": 1})
+        if not news:
+            raise HTTPException(status_code=404, detail="News non trovata")
+        total_count = news.get("stats", {}).get("comments", 0)
+        # Pagina keyset su (created_at, _id): nessuno skip, nessun conteggio
+        comments, next_cursor = await keyset.fetch_page(
+            db.ai_news_comments, {"news_id": news_oid}, cursor, page_size
+        )
         # Popola le informazioni degli autori
         user_ids = [ObjectId(comment["author_id"]) for comment in comments]
         users = await db.users.find({"_id": {"$in": user_ids}}).to_list(None)
@@ -842,7 +907,8 @@ async def get_comments(
             return {
                 "items": comments,
                 "total_count": total_count,
-                "has_more": total_count > (skip + len(comments))
+                "has_more": next_cursor is not None,
+                "next_cursor": next_cursor
             }
         # Renderizza il template con i commenti
         return request.app.state.templates.TemplateResponse(
@@ -853,14 +919,17 @@ async def get_comments(
                 "news_id": news_id,
                 "user": current_user,
                 "page_size": page_size,
-                "current_page": page,
+                "cursor": cursor,
+                "next_cursor": next_cursor,
                 "total_comments": total_count,
-                "has_more": total_count > (skip + len(comments)),
+                "has_more": next_cursor is not None,
                 "users": users  # Per le menzioni
             }
         )
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"[ERROR] Errore nel caricamento dei commenti: {str(e)}")
+        logger.error("Errore nel caricamento dei commenti: %s", str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 @ai_news_router.post("/api/ai-news/{news_id}/comments", dependencies=[Depends(get_current_user)])
@@ -896,6 +965,7 @@ async def add_comment(
         "news_id": ObjectId(news_id),
         "user_id": current_user["_id"],
         "content": sanitized_content, # Usa il contenuto sanitizzato
+        "content_html": render_markdown(sanitized_content), # HTML pronto per le liste
         "created_at": datetime.utcnow(),
         "likes": [],
         "replies_count": 0
@@ -926,7 +996,8 @@ async def add_comment(
         "author": { # Standardizzato a "author"
             "_id": str(current_user["_id"]),
             "name": current_user["name"],
-            "avatar": current_user.get("avatar", "")
+            "avatar": current_user.get("avatar", ""),
+            "photo_version": current_user.get("photo_version")
         },
         "likes": comment.get("likes", []), # Assicurati che likes sia presente
         "replies_count": comment.get("replies_count", 0) # Assicurati che replies_count sia presente
@@ -996,80 +1067,26 @@ async def delete_comment(
     if str(comment["user_id"]) != str(current_user["_id"]) and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Non autorizzato")
 
-    news_id_obj = comment["news_id"] # Salva l'ObjectId della news
-
-    # --- Inizio Eliminazione a Cascata ---
-    # 1. Trova e elimina tutte le risposte al commento principale
-    replies_to_delete_cursor = db.ai_news_comments.find({"parent_id": ObjectId(comment_id)})
-    replies_to_delete = await replies_to_delete_cursor.to_list(None)
-    
-    num_replies_deleted = 0
-    if replies_to_delete:
-        reply_ids_to_delete = [reply["_id"] for reply in replies_to_delete]
-        delete_result = await db.ai_news_comments.delete_many({"_id": {"$in": reply_ids_to_delete}})
-        num_replies_deleted = delete_result.deleted_count
-
-        # Invia messaggi WebSocket per ogni risposta eliminata
-        for reply in replies_to_delete:
-            # Per aggiornare il conteggio sul genitore (che sta per essere eliminato),
-            # non è strettamente necessario, ma per coerenza di evento.
-            # Dato che il genitore viene eliminato, il suo replies_count non è più rilevante.
-            # Potremmo inviare parent_replies_count = 0 o ometterlo.
-            await broadcast_message({
-                "type": "reply/delete",
-                "data": {
-                    "news_id": str(news_id_obj),
-                    "parent_id": str(comment_id), # Il commento che stiamo eliminando è il genitore di queste risposte
-                    "reply_id": str(reply["_id"]),
-                    "parent_replies_count": 0 # Il genitore sta scomparendo
-                }
-            })
-    # --- Fine Eliminazione a Cascata ---
-
-    # 2. Elimina il commento genitore
-    await db.ai_news_comments.delete_one({"_id": ObjectId(comment_id)})
-    num_parent_deleted = 1
-
-    # 3. Aggiorna le statistiche sulla news
-    total_comments_deleted = num_parent_deleted + num_replies_deleted
-    await db.ai_news.update_one(
-        {"_id": news_id_obj},
-        {"$inc": {"stats.comments": -total_comments_deleted}}
-    )
+    # Commento e intero sottoalbero di risposte, contatori inclusi, in una transazione
+    deleted = await comment_cascade.delete_comment_tree(db, comment)
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Commento non trovato")
 
-    # 4. Invia messaggio WebSocket per l'eliminazione del commento genitore
-    # Calcola il nuovo totale dei commenti per la news (dopo tutte le eliminazioni)
-    new_total_comments_for_news = await db.ai_news_comments.count_documents({"news_id": news_id_obj})
-    
+    # Un solo evento: il client rimuove anche le risposte elencate in reply_ids
     await broadcast_message({
-        "type": "comment/delete", # Evento per il commento genitore
-        "data": { # Struttura dati unificata
-            "news_id": str(news_id_obj),
+        "type": "comment/delete",
+        "data": {
+            "news_id": str(comment["news_id"]),
             "comment_id": str(comment_id),
             "author_id": str(comment["user_id"]), # Autore del commento eliminato
-            "total_comments": new_total_comments_for_news, # Conteggio aggiornato per la news
-            "deleted_replies_count": num_replies_deleted # Info aggiuntiva
+            "total_comments": deleted["total_comments"], # Conteggio aggiornato per la news
+            "reply_ids": [str(reply_id) for reply_id in deleted["reply_ids"]],
+            "deleted_replies_count": len(deleted["reply_ids"]),
+            # Se il commento era una risposta: nuovo conteggio risposte del genitore
+            "parent_id": str(comment["parent_id"]) if comment.get("parent_id") else None,
+            "parent_replies_count": deleted["parent_replies_count"]
         }
     })
-    
-    # Se il commento eliminato era esso stesso una risposta, aggiorna il conteggio del SUO genitore
-    if comment.get("parent_id"):
-        parent_of_deleted_comment_updated = await db.ai_news_comments.find_one_and_update(
-            {"_id": comment["parent_id"]},
-            {"$inc": {"replies_count": -1}},
-            return_document=ReturnDocument.AFTER,
-            projection={"replies_count": 1}
-        )
-        if parent_of_deleted_comment_updated:
-            # Invia un evento per aggiornare il conteggio delle risposte del nonno
-            await broadcast_message({
-                "type": "reply/count_update", # Evento generico per aggiornare il conteggio risposte
-                "data": {
-                    "news_id": str(news_id_obj),
-                    "parent_id": str(comment["parent_id"]), # Il genitore del commento che abbiamo appena eliminato
-                    "parent_replies_count": parent_of_deleted_comment_updated.get("replies_count", 0)
-                }
-            })
 
     return Response(status_code=204)
 
@@ -1157,6 +1174,7 @@ async def update_comment(
 
     update_data = {
         "content": sanitized_content, # Usa il contenuto sanitizzato
+        "content_html": render_markdown(sanitized_content),
         "metadata": comment_update.metadata,
         "updated_at": datetime.utcnow()
     }
@@ -1255,15 +1273,8 @@ async def delete_reply(
 async def markdown_preview(request: Request):
     data = await request.json()
     text = data.get("text", "")
-    if MarkdownIt is None:
-        return "<em>Markdown non disponibile</em>"
-    md = MarkdownIt("commonmark", {'breaks': True, 'html': False})
-    html = md.render(text)
-    # Sanitize output
-    safe_html = bleach.clean(html, tags=[
-        'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul', 'p', 'pre', 'br', 'span', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'
-    ], attributes={'a': ['href', 'title', 'target'], 'span': ['class']}, strip=True)
-    return safe_html
+    # Renderer condiviso; le anteprime cambiano a ogni tasto, non vanno in cache
+    return render_markdown(text, cache=False)
 
 @ai_news_router.get("/api/ai-news/{news_id}/comments/count")
 async def get_comments_count(
@@ -1303,7 +1314,7 @@ async def search_users(
     results = [{
         "_id": str(user["_id"]),
         "name": user["name"],
-        "avatar": user.get("avatar")
+        "avatar": photos.photo_url(user, 32)
     } for user in users]
     return results
 
@@ -1337,9 +1348,9 @@ async def get_comment_replies(
     request: Request,
     news_id: str,
     comment_id: str,
-    page: int = Query(1, ge=1),
+    cursor: Optional[str] = None,
     page_size: int = Query(5, ge=1, le=20),
-    db = Depends(get_docs_coll),
+    db = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     try:
@@ -1348,26 +1359,20 @@ async def get_comment_replies(
         comment_oid = ObjectId(comment_id)
         
         # Verifica l'esistenza del commento padre
-        parent = await db.ai_news_comments.find_one({"_id": comment_oid})
+        parent = await db.ai_news_comments.find_one({"_id": comment_oid}, {"replies_count": 1})
         if not parent:
             raise HTTPException(404, "Commento non trovato")
         
-        # Calcola l'offset per la paginazione
-        skip = (page - 1) * page_size
+        # Totale dal contatore replies_count del genitore
+        total_replies = parent.get("replies_count", 0)
         
-        # Recupera le risposte paginate
-        replies = await db.ai_news_comments.find({
-            "news_id": news_oid,
-            "parent_id": comment_oid
-        }).sort(
-            [("created_at", 1)]  # Dal più vecchio al più nuovo
-        ).skip(skip).limit(page_size).to_list(None)
-        
-        # Conta il totale delle risposte per questo commento
-        total_replies = await db.ai_news_comments.count_documents({
-            "news_id": news_oid,
-            "parent_id": comment_oid
-        })
+        # Recupera le risposte dopo il cursore (dal più vecchio al più nuovo)
+        replies, next_cursor = await keyset.fetch_page(
+            db.ai_news_comments,
+            {"news_id": news_oid, "parent_id": comment_oid},
+            cursor,
+            page_size
+        )
         
         # Popola le informazioni degli autori
         user_ids = [ObjectId(reply["author_id"]) for reply in replies]
@@ -1383,30 +1388,29 @@ async def get_comment_replies(
             reply["author_id"] = str(reply["author_id"])
             reply["parent_id"] = str(reply["parent_id"])
         
-        # Calcola se ci sono altre risposte da caricare
-        has_more = total_replies > (skip + len(replies))
-        
         # Renderizza il template con le risposte
         return request.app.state.templates.TemplateResponse(
-            "ai_news/comments_list_partial.html",
+            "ai_news/replies_list_partial.html",
             {
                 "request": request,
-                "messages": replies,
+                "replies": replies,
                 "news_id": news_id,
-                "parent_id": comment_id,
+                "comment_id": comment_id,
                 "user": current_user,
                 "page_size": page_size,
-                "current_page": page,
                 "total_replies": total_replies,
-                "has_more": has_more,
+                "has_more": next_cursor is not None,
+                "next_cursor": next_cursor,
                 "users": users  # Per le menzioni
             }
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@ai_news_router.get("/ai-news/{news_id}")
+@ai_news_router.get("/ai-news/{news_id}", dependencies=[Depends(get_unread_counts)])
 async def view_ai_news(
     request: Request,
     news_id: str,
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request, Form, Depends, HTTPException, Response
 from fastapi.responses import RedirectResponse, HTMLResponse, PlainTextResponse
-from app.deps import require_admin, get_current_user
+from app.deps import require_admin, get_current_user, get_unread_counts
 from app.utils.save_with_notifica import save_and_notify
 from app.models.contacts_model import ContactIn, ContactOut
 from bson import ObjectId
@@ -10,8 +10,13 @@ from typing import Annotated
 from app.notifiche import crea_notifica
 from app.ws_broadcast import broadcast_message, broadcast_resource_event
 from app.utils.notification_helpers import create_action_notification_payload, create_admin_confirmation_trigger
+from app.utils import home_feed
 import json
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 contatti_router = APIRouter(tags=["contatti"])
 
 @contatti_router.post(
@@ -61,12 +66,13 @@ async def create_contact(
             "team": (team or "").strip() or None,
             "work_branch": work_branch
         }
-        print("Salvo in home_highlights (creazione):", highlight_data)
+        logger.debug("Salvo in home_highlights (creazione): %s", highlight_data)
         await db.home_highlights.update_one(
             {"type": "contact", "object_id": str(new_id)},
             {"$set": highlight_data},
             upsert=True
         )
+        await home_feed.highlight_changed("contact", new_id)
         # --- AGGIUNTA BROADCAST HIGHLIGHT ---
         try:
             payload_highlight = {
@@ -82,7 +88,7 @@ async def create_contact(
             # per assicurarci che ws_broadcast li usi per filtrare i destinatari.
             await broadcast_message(payload_highlight, branch=branch, employment_type=employment_type_list)
         except Exception as e:
-            print("[WebSocket] Errore broadcast su update_contact_highlight:", e)
+            logger.warning("[WebSocket] Errore broadcast su update_contact_highlight: %s", e)
         # --- FINE AGGIUNTA ---
     await crea_notifica(
         request=request,
@@ -103,14 +109,14 @@ async def create_contact(
     )
 
     # 1. Notifica WebSocket per lo staff
-    print(f"[DEBUG] Creazione notifica per contatto '{name}' da utente {current_user['_id']}")
+    logger.debug("Creazione notifica per contatto '%s' da utente %s", name, current_user['_id'])
     payload = create_action_notification_payload('create', 'contatto', name.strip(), str(current_user["_id"]))
-    print(f"[DEBUG] Payload notifica: {payload}")
+    logger.debug("Payload notifica: %s", payload)
     await broadcast_message(payload, branch=branch, employment_type=employment_type, exclude_user_id=str(current_user["_id"]))
-    print(f"[DEBUG] Broadcast completato")
+    logger.debug("Broadcast completato")
 
     # 2. Conferma per l'admin
-    print(f"[DEBUG] Creazione conferma admin")
+    logger.debug("Creazione conferma admin")
     resp = Response(status_code=200)
     # Prima mostra la conferma
     resp.headers["HX-Trigger"] = create_admin_confirmation_trigger('create', name.strip())
@@ -119,10 +125,10 @@ async def create_contact(
         "closeModal": "true",
         "redirectToContatti": "/contatti"
     })
-    print(f"[DEBUG] Headers risposta: {dict(resp.headers)}")
+    logger.debug("Headers risposta: %s", dict(resp.headers))
     return resp
 
-@contatti_router.get("/contatti", response_class=HTMLResponse)
+@contatti_router.get("/contatti", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def list_contacts(
     request: Request,
     current_user = Depends(get_current_user)
@@ -172,35 +178,35 @@ async def edit_contact_form(
     contact_id: str,
     user = Depends(get_current_user)
 ):
-    print("[DEBUG MODALE] Richiesta edit contatto ricevuta")
-    print("[DEBUG MODALE] Contact ID:", contact_id)
+    logger.debug("[MODALE] Richiesta edit contatto ricevuta")
+    logger.debug("[MODALE] Contact ID: %s", contact_id)
     
     db = request.app.state.db
     contact = await db.contatti.find_one({"_id": ObjectId(contact_id)})
-    print("[DEBUG MODALE] Contatto trovato:", contact)
+    logger.debug("[MODALE] Contatto trovato: %s", contact)
     
     if not contact:
-        print("[DEBUG MODALE] Contatto non trovato!")
+        logger.debug("[MODALE] Contatto non trovato!")
         raise HTTPException(404, "Contatto non trovato")
     
     branches = await db.branches.distinct("name")
     if not branches:
-        print("[DEBUG MODALE] Usando branches di default")
+        logger.debug("[MODALE] Usando branches di default")
         branches = DEFAULT_BRANCHES
-    print("[DEBUG MODALE] Branches:", branches)
+    logger.debug("[MODALE] Branches: %s", branches)
     
     hire_types = await db.hire_types.find().to_list(None)
     if not hire_types:
-        print("[DEBUG MODALE] Usando hire_types di default")
+        logger.debug("[MODALE] Usando hire_types di default")
         hire_types = DEFAULT_HIRE_TYPES
-    print("[DEBUG MODALE] Hire types:", hire_types)
+    logger.debug("[MODALE] Hire types: %s", hire_types)
     
     # Controllo se il contatto è in evidenza
     highlight = await db.home_highlights.find_one({"type": "contact", "object_id": str(contact_id)})
     show_on_home = bool(highlight)
-    print("[DEBUG MODALE] Show on home:", show_on_home)
+    logger.debug("[MODALE] Show on home: %s", show_on_home)
     
-    print("[DEBUG MODALE] Rendering template edit_partial.html")
+    logger.debug("[MODALE] Rendering template edit_partial.html")
     return request.app.state.templates.TemplateResponse(
         "contatti/contatti_edit_partial.html",
         {
@@ -283,8 +289,8 @@ async def new_contact(request: Request, current_user: dict = Depends(require_adm
     if not hire_types:
         hire_types = DEFAULT_HIRE_TYPES
 
-    print("branches:", branches)        # debug: lista filiali
-    print("hire_types:", hire_types)    # debug: lista tipologie assunzione
+    logger.debug("branches: %s", branches)        # debug: lista filiali
+    logger.debug("hire_types: %s", hire_types)    # debug: lista tipologie assunzione
     
     return request.app.state.templates.TemplateResponse(
         "contatti/contatti_new.html",
@@ -306,8 +312,8 @@ async def new_contact_partial(request: Request, current_user: dict = Depends(req
     if not hire_types:
         hire_types = DEFAULT_HIRE_TYPES
 
-    print("branches (partial):", branches)        # debug: lista filiali
-    print("hire_types (partial):", hire_types)    # debug: lista tipologie assunzione
+    logger.debug("branches (partial): %s", branches)        # debug: lista filiali
+    logger.debug("hire_types (partial): %s", hire_types)    # debug: lista tipologie assunzione
     
     return request.app.state.templates.TemplateResponse(
         "contatti/contatto_new_partial.html",
@@ -356,6 +362,30 @@ async def update_contact(
         {"$set": update_data}
     )
     c = await db.contatti.find_one({"_id": ObjectId(contact_id)})
+
+    # Allinea la copia in home_highlights (come per documenti e link)
+    if c and c.get("show_on_home"):
+        await db.home_highlights.update_one(
+            {"type": "contact", "object_id": str(contact_id)},
+            {"$set": {
+                "type": "contact",
+                "object_id": str(contact_id),
+                "title": c["name"],
+                "created_at": c.get("created_at", datetime.utcnow()),
+                "branch": c.get("branch"),
+                "employment_type": c.get("employment_type", []),
+                "email": c.get("email"),
+                "phone": c.get("phone"),
+                "bu": c.get("bu"),
+                "team": c.get("team"),
+                "work_branch": c.get("work_branch")
+            }},
+            upsert=True
+        )
+    else:
+        await db.home_highlights.delete_one({"type": "contact", "object_id": str(contact_id)})
+    await home_feed.highlight_changed("contact", contact_id)
+
     html = request.app.state.templates.TemplateResponse(
         "contatti/contatti_row_partial.html",
         {"request": request, "contact": c, "current_user": current_user},
@@ -385,23 +415,24 @@ async def delete_contact(
         "type": "contact",
         "object_id": str(contact_id)
     })
+    await home_feed.highlight_changed("contact", contact_id)
 
     # 4. Notifica WebSocket per lo staff (come nella creazione)
-    print(f"[DEBUG] Preparazione notifica eliminazione per '{contact['name']}'")
+    logger.debug("Preparazione notifica eliminazione per '%s'", contact['name'])
     payload = create_action_notification_payload(
         'delete', 
         'contatto', 
         contact["name"], 
         str(current_user["_id"])
     )
-    print(f"[DEBUG] Payload notifica: {payload}")
+    logger.debug("Payload notifica: %s", payload)
     await broadcast_message(
         payload, 
         branch=contact["branch"],
         employment_type=contact["employment_type"],
         exclude_user_id=str(current_user["_id"])
     )
-    print(f"[DEBUG] Notifica inviata")
+    logger.debug("Notifica inviata")
 
     # 5. Broadcast dell'evento per aggiornare UI
     await broadcast_resource_event(
@@ -416,7 +447,7 @@ async def delete_contact(
         try:
             await broadcast_message({"type": "refresh_home_highlights"})
         except Exception as e:
-            print("[WebSocket] Errore broadcast su delete_contact_highlight:", e)
+            logger.warning("[WebSocket] Errore broadcast su delete_contact_highlight: %s", e)
 
     # 7. Conferma per l'admin
     response = Response(status_code=200)
@@ -424,6 +455,6 @@ async def delete_contact(
         'delete',
         contact["name"]
     )
-    print("[DEBUG-CONTATTI-DELETE] Payload conferma admin:", admin_trigger)
+    logger.debug("[CONTATTI-DELETE] Payload conferma admin: %s", admin_trigger)
     response.headers["HX-Trigger"] = admin_trigger
     return response
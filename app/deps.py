@@ -1,8 +1,12 @@
 from fastapi import Request, Depends, HTTPException, Response
-from bson import ObjectId
 from fastapi.responses import RedirectResponse
 from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
 from pymongo.read_preferences import ReadPreference
+from app.utils import user_cache, unread_counters
+
+import logging
+
+logger = logging.getLogger("intranet")
 
 # ─── FUNZIONE ORA INDIPENDENTE ─────────────────────────────
 async def get_current_user(request: Request):
@@ -27,13 +31,13 @@ async def get_current_user(request: Request):
             headers={"HX-Redirect": "/login"}
         )
 
-    # ─── LOOK-UP DELL'UTENTE ────────────────────────────────────────
-    user = await request.app.state.db.users.find_one({"_id": ObjectId(uid)})
+    # ─── LOOK-UP DELL'UTENTE (con cache process-local) ─────────────
+    user = await user_cache.get_user(request.app.state.db, uid)
     if not user:
-        print(f"[DEBUG] Nessun utente trovato in DB per id {uid} (richiesta a {request.url.path})")
+        logger.debug("Nessun utente trovato in DB per id %s (richiesta a %s)", uid, request.url.path)
         raise HTTPException(401, "User not found")
 
-    print(f"[DEBUG] Utente autenticato: {user.get('name')} ({user.get('email')}) per richiesta a {request.url.path}")
+    logger.debug("Utente autenticato: %s (%s) per richiesta a %s", user.get('name'), user.get('email'), request.url.path)
 
     # ─── OBBLIGO CAMBIO PASSWORD ───────────────────────────────────
     if user.get("must_change_pw") and request.url.path not in ("/me/password", "/logout"):
@@ -48,36 +52,31 @@ async def get_current_user(request: Request):
 
     # tutto ok → salva l'utente nello state e restituiscilo
     request.state.user = user
+    return user
 
-    # ─── CONTEGGIO NOTIFICHE NON LETTE (AGGIUNTO) ───────────────────
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-
-    # Query per contare le notifiche non lette di tipo "link"
-    emp_type_conditions = [
-        {"employment_type": {"$in": ["*"]}},
-        {"employment_type": {"$exists": False}},
-        {"employment_type": []}
-    ]
-    if employment_type:
-        emp_type_conditions.append({"employment_type": {"$in": [employment_type]}})
-
-    q_links = {
-        "tipo": "link",
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])},
-        "$or": emp_type_conditions
-    }
-    unread_links_count = await db.notifiche.count_documents(q_links)
-
-    # Inizializza request.state.unread_counts se non esiste
+# ─── CONTEGGIO NOTIFICHE NON LETTE (OPT-IN) ─────────────────────
+async def get_unread_counts(
+    request: Request,
+    user = Depends(get_current_user)
+) -> dict:
+    """
+    Calcola i conteggi delle notifiche non lette mostrati nei badge della
+    navbar (base.html) e li salva in request.state.unread_counts.
+    Va aggiunta solo alle rotte che renderizzano una pagina completa:
+    API JSON e partial HTMX non pagano la query.
+    """
     if not hasattr(request.state, 'unread_counts'):
         request.state.unread_counts = {}
-    request.state.unread_counts["link"] = unread_links_count
-    # ───────────────────────────────────────────────────────────────────
 
-    return user
+    # Le richieste HTMX ricevono solo un frammento, senza navbar
+    if request.headers.get("HX-Request") == "true" or not isinstance(user, dict):
+        return request.state.unread_counts
+
+    # Contatori per-utente: un find_one per chiave, nessuna scansione di notifiche
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    request.state.unread_counts.update(counts)
+    request.state.unread_counts.setdefault("link", 0)
+    return request.state.unread_counts
 
 async def require_admin(
     _: Request,
@@ -1,26 +1,32 @@
 from fastapi import APIRouter, Request, Form, Depends, HTTPException, UploadFile, File
-from fastapi.responses import RedirectResponse, FileResponse, HTMLResponse, Response, PlainTextResponse
-from app.deps import require_admin, get_current_user, get_docs_coll
+from fastapi.responses import RedirectResponse, HTMLResponse, Response, PlainTextResponse
+from app.deps import require_admin, get_current_user, get_docs_coll, get_unread_counts
 from app.utils.save_with_notifica import save_and_notify
 from bson import ObjectId
 from datetime import datetime
 from pathlib import Path
 from motor.motor_asyncio import AsyncIOMotorCollection
-import aiofiles
 from mimetypes import guess_type
 from app.notifiche import crea_notifica
 from fastapi.templating import Jinja2Templates
-import sys
 import asyncio
-from app.ws_broadcast import broadcast_message, broadcast_resource_event
+from app.ws_broadcast import broadcast_message, broadcast_resource_event, broadcast_batch
 from app.utils.notification_helpers import create_action_notification_payload, create_admin_confirmation_trigger
+from app.utils import home_feed, change_counters
+from app.utils.uploads import safe_filename, UploadTooLarge
+from app.utils import blob_store
+from app.utils.downloads import file_response
 import os
 import shutil
 import json
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 # Costante per il percorso base dei documenti
 BASE_DOCS_DIR = Path("media/docs")   # cartella radice documenti
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
+MAX_FILE_SIZE = int(os.getenv("DOCUMENTS_MAX_FILE_SIZE", str(10 * 1024 * 1024)))  # 10 MB
 ALLOWED_MIME_TYPES = [
     'application/pdf',
     'application/vnd.openxmlformats-officedocument.wordprocessingml.document', # .docx
@@ -55,60 +61,60 @@ async def upload_document(
     show_on_home: str = Form(None),
     current_user: dict = Depends(get_current_user)
 ):
-    print(f"[DEBUG] Upload documento '{title}' da utente {current_user['_id']}")
+    logger.debug("Upload documento '%s' da utente %s", title, current_user['_id'])
     
     show_on_home = show_on_home is not None
     
-    # 1. Valida il file
-    contents = await file.read()
-    if len(contents) > MAX_FILE_SIZE:
+    # 1. Valida il tipo di file (la dimensione è controllata durante la copia)
+    if file.content_type not in ALLOWED_MIME_TYPES:
         error_trigger = {
             "showAdminConfirmation": {
-                "title": "File Troppo Grande",
-                "message": f"La dimensione del file supera il limite massimo di {MAX_FILE_SIZE / 1024 / 1024:.0f} MB.",
+                "title": "Formato File Non Valido",
+                "message": "Il tipo di file non è consentito. Si prega di caricare documenti o immagini.",
                 "level": "error", "duration": 5000
             }
         }
         return Response(status_code=400, headers={"HX-Trigger": json.dumps(error_trigger)})
 
-    if file.content_type not in ALLOWED_MIME_TYPES:
+    # 2. Salva il file nell'archivio per contenuto (un contenuto già presente non viene duplicato)
+    logger.debug("Salvataggio file fisico")
+    db = request.app.state.db
+    try:
+        stored = await blob_store.put_upload(db, file, max_bytes=MAX_FILE_SIZE)
+    except UploadTooLarge:
         error_trigger = {
             "showAdminConfirmation": {
-                "title": "Formato File Non Valido",
-                "message": "Il tipo di file non è consentito. Si prega di caricare documenti o immagini.",
+                "title": "File Troppo Grande",
+                "message": f"La dimensione del file supera il limite massimo di {MAX_FILE_SIZE / 1024 / 1024:.0f} MB.",
                 "level": "error", "duration": 5000
             }
         }
         return Response(status_code=400, headers={"HX-Trigger": json.dumps(error_trigger)})
 
-    # 2. Salva il file fisicamente
-    print(f"[DEBUG] Salvataggio file fisico")
-    docs_dir = BASE_DOCS_DIR
-    docs_dir.mkdir(parents=True, exist_ok=True)
-    dest = docs_dir / file.filename
-    async with aiofiles.open(dest, "wb") as out:
-        await out.write(contents)
-
     employment_type_list = [employment_type] if isinstance(employment_type, str) else (employment_type or [])
     
     # 3. Salva il documento in Mongo
-    print(f"[DEBUG] Salvataggio documento in MongoDB")
-    db = request.app.state.db
+    logger.debug("Salvataggio documento in MongoDB")
     doc = {
         "title": title.strip(),
         "branch": branch.strip(),
         "employment_type": employment_type_list,
         "tags": [tag.strip() for tag in tags.split(",")] if tags else [],
-        "filename": file.filename,
+        "filename": safe_filename(file.filename),
+        "original_filename": file.filename,
+        "blob": stored.sha256,
+        "size": stored.size,
+        "sha256": stored.sha256,
         "content_type": file.content_type,
         "uploaded_at": datetime.utcnow(),
         "show_on_home": show_on_home
     }
     result = await db.documents.insert_one(doc)
     doc_id = result.inserted_id
+    await change_counters.collection_changed("documents", doc_id)
 
     # 4. Aggiorna home_highlights
-    print(f"[DEBUG] Aggiornamento highlights")
+    logger.debug("Aggiornamento highlights")
     if show_on_home:
         await db.home_highlights.update_one(
             {"type": "document", "object_id": str(doc_id)},
@@ -124,9 +130,10 @@ async def upload_document(
         )
     else:
         await db.home_highlights.delete_one({"type": "document", "object_id": str(doc_id)})
+    await home_feed.highlight_changed("document", doc_id)
 
     # 5. Crea la notifica
-    print(f"[DEBUG] Creazione notifica")
+    logger.debug("Creazione notifica")
     await crea_notifica(
         request=request,
         tipo="documento",
@@ -136,42 +143,44 @@ async def upload_document(
         employment_type=employment_type_list
     )
 
-    # 6. Notifica WebSocket per lo staff
-    try:
-        print(f"[DEBUG] Creazione notifica per nuovo documento")
-        payload = create_action_notification_payload('create', 'documento', title.strip(), str(current_user["_id"]))
-        print(f"[DEBUG] Payload notifica: {payload}")
-        await broadcast_message(payload, branch=branch.strip(), employment_type=employment_type_list, exclude_user_id=str(current_user["_id"]))
-        print(f"[DEBUG] Broadcast completato")
+    # Eventi WebSocket del caricamento raggruppati in un frame per client
+    async with broadcast_batch():
+        # 6. Notifica WebSocket per lo staff
+        try:
+            logger.debug("Creazione notifica per nuovo documento")
+            payload = create_action_notification_payload('create', 'documento', title.strip(), str(current_user["_id"]))
+            logger.debug("Payload notifica: %s", payload)
+            await broadcast_message(payload, branch=branch.strip(), employment_type=employment_type_list, exclude_user_id=str(current_user["_id"]))
+            logger.debug("Broadcast completato")
         
-        # 7. Aggiorna highlights home
-        print(f"[DEBUG] Aggiornamento highlights per creazione documento")
-        if show_on_home: # Invia il broadcast solo se il documento è effettivamente in home
-            payload_highlight = {
-                "type": "refresh_home_highlights",
-                "data": {
-                    "branch": branch.strip(),
-                    "employment_type": employment_type_list
+            # 7. Aggiorna highlights home
+            logger.debug("Aggiornamento highlights per creazione documento")
+            if show_on_home: # Invia il broadcast solo se il documento è effettivamente in home
+                payload_highlight = {
+                    "type": "refresh_home_highlights",
+                    "data": {
+                        "branch": branch.strip(),
+                        "employment_type": employment_type_list
+                    }
                 }
-            }
-            await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type_list)
-            print(f"[DEBUG] Broadcast refresh_home_highlights inviato per i destinatari corretti.")
-        else:
-            print(f"[DEBUG] Il documento non è show_on_home, nessun broadcast per refresh_home_highlights.")
+                await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type_list)
+                logger.debug("Broadcast refresh_home_highlights inviato per i destinatari corretti.")
+            else:
+                logger.debug("Il documento non è show_on_home, nessun broadcast per refresh_home_highlights.")
 
-    except Exception as e:
-        print("[WebSocket] Errore broadcast su creazione documento:", e)
-
-    # 8. Broadcast evento risorsa
-    await broadcast_resource_event(
-        event="add",
-        item_type="document",
-        item_id=str(doc_id),
-        user_id=str(current_user["_id"]),
-    )
+        except Exception as e:
+            logger.warning("[WebSocket] Errore broadcast su creazione documento: %s", e)
+
+        # 8. Broadcast evento risorsa
+        await broadcast_resource_event(
+            event="add",
+            item_type="document",
+            item_id=str(doc_id),
+            user_id=str(current_user["_id"]),
+        )
 
     # 9. Prepara risposta con conferma admin
-    print(f"[DEBUG] Preparazione risposta")
+    logger.debug("Preparazione risposta")
     resp = PlainTextResponse(status_code=200)
     # Prima mostra la conferma
     resp.headers["HX-Trigger"] = create_admin_confirmation_trigger('create', title.strip())
@@ -180,7 +189,7 @@ async def upload_document(
         "closeModal": "true",
         "redirect-to-documents": "/documents"
     })
-    print(f"[DEBUG] Headers risposta: {dict(resp.headers)}")
+    logger.debug("Headers risposta: %s", dict(resp.headers))
     return resp
 
 @documents_router.get("/documents/upload", response_class=HTMLResponse, dependencies=[Depends(require_admin)])
@@ -231,7 +240,7 @@ async def edit_document_submit(
     show_on_home: str = Form(None),
     current_user = Depends(get_current_user)
 ):
-    print(f"[DEBUG] Modifica documento '{title}' da utente {current_user['_id']}")
+    logger.debug("Modifica documento '%s' da utente %s", title, current_user['_id'])
     
     db = request.app.state.db
     employment_type_list = [employment_type] if isinstance(employment_type, str) else (employment_type or [])
@@ -264,60 +273,65 @@ async def edit_document_submit(
         )
     else:
         await db.home_highlights.delete_one({"type": "document", "object_id": str(doc_id)})
+    await home_feed.highlight_changed("document", doc_id)
+
+    await change_counters.collection_changed("documents", doc_id)
 
     # 3. Recupera il documento aggiornato
     updated = await db.documents.find_one({"_id": ObjectId(doc_id)})
     updated = to_str_id(updated)
 
-    # 4. Notifica WebSocket per lo staff
-    try:
-        print(f"[DEBUG] Creazione notifica per modifica documento")
-        payload = create_action_notification_payload('update', 'documento', title.strip(), str(current_user["_id"]))
-        print(f"[DEBUG] Payload notifica: {payload}")
-        await broadcast_message(payload, branch=branch.strip(), employment_type=employment_type_list, exclude_user_id=str(current_user["_id"]))
-        print(f"[DEBUG] Broadcast completato")
+    # Eventi WebSocket della modifica raggruppati in un frame per client
+    async with broadcast_batch():
+        # 4. Notifica WebSocket per lo staff
+        try:
+            logger.debug("Creazione notifica per modifica documento")
+            payload = create_action_notification_payload('update', 'documento', title.strip(), str(current_user["_id"]))
+            logger.debug("Payload notifica: %s", payload)
+            await broadcast_message(payload, branch=branch.strip(), employment_type=employment_type_list, exclude_user_id=str(current_user["_id"]))
+            logger.debug("Broadcast completato")
         
-        # 5. Aggiorna highlights home
-        print(f"[DEBUG] Aggiornamento highlights per modifica documento")
-        if show_on_home is not None: # Invia il broadcast solo se il documento è effettivamente in home
-            payload_highlight = {
-                "type": "refresh_home_highlights",
-                "data": {
-                    "branch": branch.strip(),
-                    "employment_type": employment_type_list
+            # 5. Aggiorna highlights home
+            logger.debug("Aggiornamento highlights per modifica documento")
+            if show_on_home is not None: # Invia il broadcast solo se il documento è effettivamente in home
+                payload_highlight = {
+                    "type": "refresh_home_highlights",
+                    "data": {
+                        "branch": branch.strip(),
+                        "employment_type": employment_type_list
+                    }
                 }
-            }
-            await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type_list)
-            print(f"[DEBUG] Broadcast refresh_home_highlights inviato per i destinatari corretti.")
-        else:
-            # Se show_on_home è False (o None qui, che significa che il checkbox non era spuntato),
-            # e il documento POTREBBE essere stato precedentemente in home,
-            # inviamo comunque un refresh generico ai destinatari che POTEVANO vederlo,
-            # così la loro home si aggiorna rimuovendolo.
-            # La logica di `home_highlights_partial` poi non lo includerà.
-            payload_highlight = {
-                "type": "refresh_home_highlights",
-                 "data": { # Usiamo i valori del documento per raggiungere chi lo vedeva prima
-                    "branch": updated.get("branch", "*"), # branch precedente o attuale
-                    "employment_type": updated.get("employment_type", ["*"])
+                await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type_list)
+                logger.debug("Broadcast refresh_home_highlights inviato per i destinatari corretti.")
+            else:
+                # Se show_on_home è False (o None qui, che significa che il checkbox non era spuntato),
+                # e il documento POTREBBE essere stato precedentemente in home,
+                # inviamo comunque un refresh generico ai destinatari che POTEVANO vederlo,
+                # così la loro home si aggiorna rimuovendolo.
+                # La logica di `home_highlights_partial` poi non lo includerà.
+                payload_highlight = {
+                    "type": "refresh_home_highlights",
+                     "data": { # Usiamo i valori del documento per raggiungere chi lo vedeva prima
+                        "branch": updated.get("branch", "*"), # branch precedente o attuale
+                        "employment_type": updated.get("employment_type", ["*"])
+                    }
                 }
-            }
-            await broadcast_message(payload_highlight, branch=updated.get("branch", "*"), employment_type=updated.get("employment_type", ["*"]))
-            print(f"[DEBUG] Documento non più show_on_home, inviato refresh_home_highlights per la rimozione.")
+                await broadcast_message(payload_highlight, branch=updated.get("branch", "*"), employment_type=updated.get("employment_type", ["*"]))
+                logger.debug("Documento non più show_on_home, inviato refresh_home_highlights per la rimozione.")
 
-    except Exception as e:
-        print("[WebSocket] Errore broadcast su modifica documento:", e)
-
-    # 6. Broadcast evento risorsa
-    await broadcast_resource_event(
-        event="update",
-        item_type="document",
-        item_id=str(doc_id),
-        user_id=str(current_user["_id"]),
-    )
+        except Exception as e:
+            logger.warning("[WebSocket] Errore broadcast su modifica documento: %s", e)
+
+        # 6. Broadcast evento risorsa
+        await broadcast_resource_event(
+            event="update",
+            item_type="document",
+            item_id=str(doc_id),
+            user_id=str(current_user["_id"]),
+        )
 
     # 7. Prepara la risposta con conferma admin
-    print(f"[DEBUG] Preparazione risposta")
+    logger.debug("Preparazione risposta")
     resp = request.app.state.templates.TemplateResponse(
         "documents/row_partial.html",
         {"request": request, "d": updated, "user": current_user}
@@ -327,7 +341,7 @@ async def edit_document_submit(
     admin_confirmation_payload["closeModal"] = True # Aggiungiamo closeModal per il gestore globale in ui.js
     resp.headers["HX-Trigger"] = json.dumps(admin_confirmation_payload)
 
-    print(f"[DEBUG] Headers risposta: {dict(resp.headers)}")
+    logger.debug("Headers risposta: %s", dict(resp.headers))
     
     return resp
 
@@ -339,10 +353,16 @@ async def download_document(doc_id: str, request: Request):
         doc = await db.documents.find_one({"_id": ObjectId(doc_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Documento non trovato")
-    file_path = BASE_DOCS_DIR / doc["filename"]
-    if not file_path.exists():
+    file_path = blob_store.resolve(doc, BASE_DOCS_DIR)
+    if not file_path or not file_path.exists():
         raise HTTPException(404, "File non trovato")
-    return FileResponse(path=file_path, filename=doc["filename"], media_type=doc.get("content_type", "application/octet-stream"))
+    return file_response(
+        request, file_path,
+        filename=Path(doc["filename"]).name,
+        media_type=doc.get("content_type", "application/octet-stream"),
+        etag=blob_store.strong_etag(doc),
+        immutable=bool(doc.get("blob"))
+    )
 
 @documents_router.get("/documents/{doc_id}/preview")
 async def preview_document(doc_id: str, request: Request):
@@ -352,19 +372,21 @@ async def preview_document(doc_id: str, request: Request):
         doc = await db.documents.find_one({"_id": ObjectId(doc_id)})
     if not doc:
         raise HTTPException(status_code=404, detail="Documento non trovato")
-    file_path = BASE_DOCS_DIR / doc["filename"]
-    if not file_path.exists():
+    file_path = blob_store.resolve(doc, BASE_DOCS_DIR)
+    if not file_path or not file_path.exists():
         raise HTTPException(404, "File non trovato")
-    mime, _ = guess_type(str(file_path))
-    headers = {"Content-Disposition": f'inline; filename="{doc["filename"]}"'}
-    return FileResponse(
-        path=file_path,
-        filename=doc["filename"],
-        media_type=mime or "application/octet-stream",
-        headers=headers
+    # I blob non hanno estensione: il tipo si ricava dal nome originale
+    mime, _ = guess_type(doc["filename"])
+    return file_response(
+        request, file_path,
+        filename=Path(doc["filename"]).name,
+        media_type=mime,
+        etag=blob_store.strong_etag(doc),
+        immutable=bool(doc.get("blob")),
+        inline=True
     )
 
-@documents_router.get("/documents", response_class=HTMLResponse)
+@documents_router.get("/documents", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def list_documents(
     request: Request,
     current_user = Depends(get_current_user),
@@ -426,57 +448,63 @@ async def delete_document(request: Request, doc_id: str, current_user: dict = De
     branch = doc.get("branch", "*")
     employment_type = doc.get("employment_type", ["*"])
     
-    # Rimuovi il file fisico
+    # Rimuovi da MongoDB
+    await db.documents.delete_one({"_id": ObjectId(doc_id)})
+
+    # Rilascia il file: il blob viene eliminato solo con l'ultimo riferimento
     filename = doc.get("filename")
-    if filename:
+    if doc.get("blob"):
+        await blob_store.release(db, doc["blob"])
+    elif filename:
         file_path = BASE_DOCS_DIR / filename
         try:
             file_path.unlink()
         except Exception as e:
-            print(f"Errore rimozione file {filename}:", e)
-
-    # Rimuovi da MongoDB
-    await db.documents.delete_one({"_id": ObjectId(doc_id)})
+            logger.error("Errore rimozione file %s: %s", filename, e)
+    await change_counters.collection_changed("documents", doc_id)
     await db.home_highlights.delete_one({"type": "document", "object_id": str(doc_id)})
+    await home_feed.highlight_changed("document", doc_id)
+
+    # Toast, evento risorsa e refresh highlights in un solo frame per client
+    async with broadcast_batch():
+        # 1. Notifica WebSocket per lo staff
+        logger.debug("Creazione notifica per eliminazione documento '%s' da utente %s", title, current_user['_id'])
+        payload = create_action_notification_payload('delete', 'documento', title, str(current_user["_id"]))
+        logger.debug("Payload notifica: %s", payload)
+        await broadcast_message(payload, branch=branch, employment_type=employment_type, exclude_user_id=str(current_user["_id"]))
+        logger.debug("Broadcast completato")
+
+        # 2. Broadcast evento risorsa
+        await broadcast_resource_event(
+            event="delete",
+            item_type="document",
+            item_id=str(doc_id),
+            user_id=str(current_user["_id"]),
+        )
 
-    # 1. Notifica WebSocket per lo staff
-    print(f"[DEBUG] Creazione notifica per eliminazione documento '{title}' da utente {current_user['_id']}")
-    payload = create_action_notification_payload('delete', 'documento', title, str(current_user["_id"]))
-    print(f"[DEBUG] Payload notifica: {payload}")
-    await broadcast_message(payload, branch=branch, employment_type=employment_type, exclude_user_id=str(current_user["_id"]))
-    print(f"[DEBUG] Broadcast completato")
-
-    # 2. Broadcast evento risorsa
-    await broadcast_resource_event(
-        event="delete",
-        item_type="document",
-        item_id=str(doc_id),
-        user_id=str(current_user["_id"]),
-    )
-
-    # 3. Aggiorna highlights home
-    try:
-        # Se il documento era show_on_home, invia un broadcast mirato per refresh.
-        # Gli utenti che non avevano accesso a questo branch/emp_type non riceveranno il segnale.
-        # Gli utenti che avevano accesso lo riceveranno e la loro home si aggiornerà (rimuovendo il doc).
-        if doc.get("show_on_home"):
-            payload_highlight = {
-                "type": "refresh_home_highlights",
-                "data": {
-                    "branch": branch, # branch del documento eliminato
-                    "employment_type": employment_type # employment_type del documento eliminato
+        # 3. Aggiorna highlights home
+        try:
+            # Se il documento era show_on_home, invia un broadcast mirato per refresh.
+            # Gli utenti che non avevano accesso a questo branch/emp_type non riceveranno il segnale.
+            # Gli utenti che avevano accesso lo riceveranno e la loro home si aggiornerà (rimuovendo il doc).
+            if doc.get("show_on_home"):
+                payload_highlight = {
+                    "type": "refresh_home_highlights",
+                    "data": {
+                        "branch": branch, # branch del documento eliminato
+                        "employment_type": employment_type # employment_type del documento eliminato
+                    }
                 }
-            }
-            await broadcast_message(payload_highlight, branch=branch, employment_type=employment_type)
-            print(f"[DEBUG] Broadcast refresh_home_highlights per eliminazione inviato a branch '{branch}', emp_type '{employment_type}'.")
-    except Exception as e:
-        print("[WebSocket] Errore broadcast su refresh highlights dopo eliminazione documento:", e)
+                await broadcast_message(payload_highlight, branch=branch, employment_type=employment_type)
+                logger.debug("Broadcast refresh_home_highlights per eliminazione inviato a branch '%s', emp_type '%s'.", branch, employment_type)
+        except Exception as e:
+            logger.warning("[WebSocket] Errore broadcast su refresh highlights dopo eliminazione documento: %s", e)
 
     # 4. Conferma per l'admin
-    print(f"[DEBUG] Creazione conferma admin")
+    logger.debug("Creazione conferma admin")
     resp = Response(status_code=200)
     resp.headers["HX-Trigger"] = create_admin_confirmation_trigger('delete', title)
-    print(f"[DEBUG] Headers risposta: {dict(resp.headers)}")
+    logger.debug("Headers risposta: %s", dict(resp.headers))
     
     return resp
 
@@ -486,6 +514,10 @@ async def list_documents_partial(
     current_user = Depends(get_current_user),
     docs_coll: AsyncIOMotorCollection = Depends(get_docs_coll)
 ):
+    etag = change_counters.partial_etag("documents_list", current_user, ["documents"])
+    not_modified = change_counters.not_modified(request, etag, "documents_list")
+    if not_modified:
+        return not_modified
     try:
         employment_type = current_user.get("employment_type")
         branch = current_user.get("branch")
@@ -509,9 +541,10 @@ async def list_documents_partial(
         documents = await docs_coll.find(filter_query).sort("uploaded_at", -1).to_list(None)
         documents = [to_str_id(doc) for doc in documents]
     except Exception as e:
-        print(f"[ERROR] Errore in list_documents_partial: {e}", file=sys.stderr)
+        logger.error("Errore in list_documents_partial: %s", e)
         documents = []
-    return request.app.state.templates.TemplateResponse(
+    resp = request.app.state.templates.TemplateResponse(
         "documents/list_partial.html",
         {"request": request, "documents": documents, "current_user": current_user}
     )
+    return change_counters.with_etag(resp, etag)
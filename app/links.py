@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Request, Form, Depends, HTTPException, Response
 from fastapi.responses import RedirectResponse, HTMLResponse
-from app.deps import require_admin, get_current_user
+from app.deps import require_admin, get_current_user, get_unread_counts
+from app.utils import unread_counters, home_feed, change_counters
 from bson import ObjectId
 from datetime import datetime
 import json
@@ -8,6 +9,10 @@ import json
 from app.utils.notification_helpers import create_action_notification_payload, create_admin_confirmation_trigger
 from app.ws_broadcast import broadcast_message, broadcast_resource_event
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 # Aggiunto il prefisso "/links" per allineare le rotte con il frontend
 links_router = APIRouter(prefix="/links", tags=["links"])
 
@@ -34,6 +39,7 @@ async def create_link(
     }
     result = await db.links.insert_one(link_data)
     new_id = str(result.inserted_id)
+    await change_counters.collection_changed("links", new_id)
 
     # 1. Salva la notifica nel database per il conteggio dei badge e la persistenza
     # Assicurati che la funzione crea_notifica sia importata in links.py
@@ -87,10 +93,11 @@ async def create_link(
             "employment_type": employment_type,
             "created_at": datetime.utcnow()
         })
+        await home_feed.highlight_changed("link", new_id)
         # Aggiorna highlights home
         try:
             if show_on_home:
-                print(f"[DEBUG] Aggiornamento highlights per link creato")
+                logger.debug("Aggiornamento highlights per link creato")
                 payload_highlight = {
                     "type": "refresh_home_highlights",
                     "data": {
@@ -99,14 +106,14 @@ async def create_link(
                     }
                 }
                 await broadcast_message(payload_highlight, branch=branch, employment_type=employment_type)
-                print(f"[DEBUG] Broadcast refresh_home_highlights inviato per i destinatari corretti.")
+                logger.debug("Broadcast refresh_home_highlights inviato per i destinatari corretti.")
             else:
-                print(f"[DEBUG] Il link non è show_on_home, nessun broadcast per refresh_home_highlights.")
+                logger.debug("Il link non è show_on_home, nessun broadcast per refresh_home_highlights.")
         except Exception as e:
-            print("[WebSocket] Errore broadcast su refresh highlights:", e)
+            logger.warning("[WebSocket] Errore broadcast su refresh highlights: %s", e)
 
     # 4. Risposta di conferma per l'admin con redirect ritardato
-    print(f"[DEBUG] Preparazione risposta")
+    logger.debug("Preparazione risposta")
     resp = Response(status_code=200)
     # Prima mostra la conferma
     resp.headers["HX-Trigger"] = create_admin_confirmation_trigger('create', title)
@@ -115,15 +122,15 @@ async def create_link(
         "closeModal": "true",
         "redirect-to-links": "/links"
     })
-    print(f"[DEBUG] Headers risposta: {dict(resp.headers)}")
+    logger.debug("Headers risposta: %s", dict(resp.headers))
     return resp
 
-@links_router.get("/", response_class=HTMLResponse)
+@links_router.get("/", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def list_links(request: Request, current_user=Depends(get_current_user)):
     db = request.app.state.db
     employment_type = current_user.get("employment_type")
     branch = current_user.get("branch")
-    print(f"[DEBUG] Utente corrente: {current_user}")
+    logger.debug("Utente corrente: %s", current_user)
     if current_user["role"] == "admin" or not employment_type: # Admin vede tutto, utente senza employment_type definito vede tutto (da rivedere se corretto)
         mongo_filter = {}
     else:
@@ -152,9 +159,10 @@ async def list_links(request: Request, current_user=Depends(get_current_user)):
                 }
             ]
         }
-    print(f"[DEBUG] Filtro Mongo per list_links: {mongo_filter}")
+    logger.debug("Filtro Mongo per list_links: %s", mongo_filter)
     links = await db.links.find(mongo_filter).to_list(length=None)
-    print(f"[DEBUG] Link trovati: {[l.get('title') for l in links]}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Link trovati: %s", [l.get('title') for l in links])
 
     # --- Segna tutte le notifiche 'link' come lette per l'utente ---
     def get_emp_type_conditions(user_emp_type):
@@ -178,15 +186,12 @@ async def list_links(request: Request, current_user=Depends(get_current_user)):
         notifications_to_mark_read_filter,
         {"$addToSet": {"letta_da": user_id_str}}
     )
-    print(f"[DEBUG] Segnate {update_result.modified_count} notifiche link come lette per {user_id_str} visitando /links")
+    logger.debug("Segnate %s notifiche link come lette per %s visitando /links", update_result.modified_count, user_id_str)
+    await unread_counters.reset_unread(db, user_id_str, "link")
 
-    # --- Conteggio notifiche non lette di tipo link per il badge ---
-    unread_counts = {"link": await db.notifiche.count_documents({
-        "tipo": "link",
-        "letta_da": {"$ne": user_id_str},
-        "branch": {"$in": ["*", branch]},
-        "$or": get_emp_type_conditions(employment_type)
-    })}
+    # --- Conteggio notifiche non lette per il badge (appena azzerato per i link) ---
+    unread_counts = {**getattr(request.state, "unread_counts", {}), "link": 0}
+    request.state.unread_counts = unread_counts
 
     response = request.app.state.templates.TemplateResponse(
         "links/links_index.html",
@@ -260,11 +265,13 @@ async def delete_link(request: Request, link_id: str, current_user: dict = Depen
 
     # Esegui l'eliminazione
     await db.links.delete_one({"_id": object_id_to_delete})
+    await change_counters.collection_changed("links", link_id)
 
     # Elimina le notifiche associate a questo link
     # Questo aiuta a mantenere il conteggio dei badge accurato dopo l'eliminazione di un link.
-    delete_notifiche_result = await db.notifiche.delete_many({"id_risorsa": link_id, "tipo": "link"})
-    print(f"[DEBUG] Eliminate {delete_notifiche_result.deleted_count} notifiche associate al link {link_id}")
+    from app.notifiche import elimina_notifiche
+    deleted_count = await elimina_notifiche(db, {"id_risorsa": link_id, "tipo": "link"})
+    logger.debug("Eliminate %s notifiche associate al link %s", deleted_count, link_id)
     
     # 1. Notifica WebSocket SOLO ai destinatari
     payload = create_action_notification_payload(
@@ -283,6 +290,7 @@ async def delete_link(request: Request, link_id: str, current_user: dict = Depen
     # 2. Aggiornamento highlights
     was_on_home = link_to_delete.get("show_on_home", False)
     await db.home_highlights.delete_one({"type": "link", "object_id": link_id}) # Assicurati di specificare anche il type
+    await home_feed.highlight_changed("link", link_id)
 
     if was_on_home:
         try:
@@ -295,9 +303,9 @@ async def delete_link(request: Request, link_id: str, current_user: dict = Depen
                 }
             }
             await broadcast_message(payload_highlight, branch=branch, employment_type=employment_type)
-            print(f"[DEBUG] Broadcast refresh_home_highlights per eliminazione link inviato a branch '{branch}', emp_type '{employment_type}'.")
+            logger.debug("Broadcast refresh_home_highlights per eliminazione link inviato a branch '%s', emp_type '%s'.", branch, employment_type)
         except Exception as e:
-            print(f"[WebSocket] Errore broadcast refresh_home_highlights (delete link): {e}")
+            logger.warning("[WebSocket] Errore broadcast refresh_home_highlights (delete link): %s", e)
 
     # Invia comunque l'evento generico di eliminazione risorsa
     await broadcast_resource_event(
@@ -310,7 +318,7 @@ async def delete_link(request: Request, link_id: str, current_user: dict = Depen
     # 3. Conferma immediata SOLO per l'admin
     resp = Response(status_code=200)
     admin_trigger = create_admin_confirmation_trigger('delete', title)
-    print("[DEBUG-LINKS-DELETE] Payload conferma admin:", admin_trigger)
+    logger.debug("[LINKS-DELETE] Payload conferma admin: %s", admin_trigger)
     resp.headers["HX-Trigger"] = admin_trigger
     return resp
 
@@ -336,6 +344,7 @@ async def edit_link_submit(
             "show_on_home": show_on_home
         }}
     )
+    await change_counters.collection_changed("links", link_id)
 
     # 1. Notifica WebSocket SOLO ai destinatari
     payload = create_action_notification_payload(
@@ -370,6 +379,7 @@ async def edit_link_submit(
             }},
             upsert=True
         )
+        await home_feed.highlight_changed("link", link_id)
         # Invia broadcast mirato per refresh (aggiunta o modifica di un highlight esistente)
         try:
             payload_highlight = {
@@ -378,10 +388,11 @@ async def edit_link_submit(
             }
             await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type)
         except Exception as e:
-            print(f"[WebSocket] Errore broadcast refresh_home_highlights (update link add/mod): {e}")
+            logger.warning("[WebSocket] Errore broadcast refresh_home_highlights (update link add/mod): %s", e)
     else:
         # Se show_on_home è false, il link non deve essere/rimanere negli highlights
         delete_result = await db.home_highlights.delete_one({"type": "link", "object_id": link_id})
+        await home_feed.highlight_changed("link", link_id)
         if delete_result.deleted_count > 0: # Era in home ed è stato rimosso
             # Invia broadcast mirato per refresh per notificare la rimozione
             # È importante usare i criteri del link *prima* della modifica se sono cambiati,
@@ -395,7 +406,7 @@ async def edit_link_submit(
                 }
                 await broadcast_message(payload_highlight, branch=branch.strip(), employment_type=employment_type)
             except Exception as e:
-                print(f"[WebSocket] Errore broadcast refresh_home_highlights (update link remove): {e}")
+                logger.warning("[WebSocket] Errore broadcast refresh_home_highlights (update link remove): %s", e)
 
     await broadcast_resource_event(
         event="update",
@@ -420,6 +431,10 @@ async def new_link_form(request: Request):
 
 @links_router.get("/list", response_class=HTMLResponse)
 async def list_links_partial(request: Request, current_user=Depends(get_current_user)):
+    etag = change_counters.partial_etag("links_list", current_user, ["links"])
+    not_modified = change_counters.not_modified(request, etag, "links_list")
+    if not_modified:
+        return not_modified
     db = request.app.state.db
     employment_type = current_user.get("employment_type")
     branch = current_user.get("branch")
@@ -447,10 +462,10 @@ async def list_links_partial(request: Request, current_user=Depends(get_current_
                 }
             ]
         }
-    print(f"[DEBUG] Filtro Mongo per list_links_partial: {mongo_filter}")
+    logger.debug("Filtro Mongo per list_links_partial: %s", mongo_filter)
     links = await db.links.find(mongo_filter).to_list(length=None)
     
-    return request.app.state.templates.TemplateResponse(
+    resp = request.app.state.templates.TemplateResponse(
         "links/links_list_partial.html",
         {
             "request": request,
@@ -458,3 +473,4 @@ async def list_links_partial(request: Request, current_user=Depends(get_current_
             "current_user": current_user
         }
     )
+    return change_counters.with_etag(resp, etag)
@@ -1,17 +1,22 @@
 from fastapi import APIRouter, Request, Form, Depends, HTTPException, Response
 from fastapi.responses import RedirectResponse, HTMLResponse, PlainTextResponse, JSONResponse
-from app.deps import require_admin, get_current_user
+from app.deps import require_admin, get_current_user, get_unread_counts
 from app.utils.save_with_notifica import save_and_notify
 from app.models.news_model import NewsIn, NewsOut
 from datetime import datetime, timedelta
 from bson import ObjectId
 from fastapi import status
 from app.constants import DEFAULT_HIRE_TYPES
-from app.notifiche import crea_notifica
+from app.notifiche import crea_notifica, elimina_notifiche
+from app.utils import unread_counters, home_feed, change_counters
 from app.ws_broadcast import broadcast_message, broadcast_resource_event
 from app.utils.notification_helpers import create_action_notification_payload, create_admin_confirmation_trigger
 import json
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 news_router = APIRouter(tags=["news"])
 
 def get_news_toast(action, title):
@@ -38,7 +43,7 @@ async def create_news(
     expires_at_str: str = Form(None), # Aggiunto expires_at_str
     current_user: dict = Depends(get_current_user)
 ):
-    print("[DEBUG] Inizio creazione news")
+    logger.debug("Inizio creazione news")
     employment_type_list = [employment_type] if isinstance(employment_type, str) else (employment_type or [])
     show_on_home = show_on_home is not None
 
@@ -63,6 +68,7 @@ async def create_news(
     }
     result = await db.news.insert_one(news_data)
     news_id = str(result.inserted_id)
+    await home_feed.news_changed(news_id)
 
     # Crea la notifica
     await crea_notifica(
@@ -122,7 +128,7 @@ async def create_news(
         # Invia a tutti (o filtra se il ticker ha logica di visibilità specifica)
         await broadcast_message(ticker_payload, branch=news_data['branch'], employment_type=news_data['employment_type'])
     except Exception as e:
-        print(f"[WebSocket] Errore broadcast news_ticker_add: {e}")
+        logger.warning("[WebSocket] Errore broadcast news_ticker_add: %s", e)
 
     # 3. Risposta con conferma admin e redirect
     resp = Response(status_code=200)
@@ -135,7 +141,7 @@ async def create_news(
     })
     return resp
 
-@news_router.get("/news", response_class=HTMLResponse)
+@news_router.get("/news", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def list_news(
     request: Request,
     current_user = Depends(get_current_user)
@@ -188,14 +194,11 @@ async def list_news(
         notifications_to_mark_read_filter,
         {"$addToSet": {"letta_da": user_id_str}}
     )
+    await unread_counters.reset_unread(db, user_id_str, "news")
 
-    # --- Conteggio notifiche non lette di tipo news per il badge ---
-    unread_counts = {"news": await db.notifiche.count_documents({
-        "tipo": "news",
-        "letta_da": {"$ne": user_id_str},
-        "branch": {"$in": ["*", branch]},
-        "$or": get_emp_type_conditions(employment_type)
-    })}
+    # --- Conteggio notifiche non lette per il badge (appena azzerato per le news) ---
+    unread_counts = {**getattr(request.state, "unread_counts", {}), "news": 0}
+    request.state.unread_counts = unread_counts
 
     response = request.app.state.templates.TemplateResponse(
         "news/news_index.html",
@@ -283,6 +286,7 @@ async def edit_news_submit(
             {"_id": ObjectId(news_id)},
             {"$set": update_fields}
         )
+        await home_feed.news_changed(news_id)
 
     updated = await db.news.find_one({"_id": ObjectId(news_id)})
     # RIMOSSA logica di interazione con db.home_highlights per le news
@@ -307,7 +311,7 @@ async def edit_news_submit(
     )
     resp.headers["HX-Trigger"] = "closeModal"
     # Elimino tutte le vecchie notifiche relative a questa news
-    await db.notifiche.delete_many({"id_risorsa": str(news_id), "tipo": "news"})
+    await elimina_notifiche(db, {"id_risorsa": str(news_id), "tipo": "news"})
     await crea_notifica(
         request=request,
         tipo="news",
@@ -365,7 +369,7 @@ async def edit_news_submit(
         }
         await broadcast_message(ticker_payload, branch=updated['branch'], employment_type=updated['employment_type'])
     except Exception as e:
-        print(f"[WebSocket] Errore broadcast news_ticker_update: {e}")
+        logger.warning("[WebSocket] Errore broadcast news_ticker_update: %s", e)
     # --- FINE AGGIUNTA ---
 
     # Toast di notifica (create_action_notification_payload gestisce già questo tipo di toast per gli utenti)
@@ -412,6 +416,7 @@ async def delete_news(request: Request, news_id: str, current_user: dict = Depen
     
     # Elimina la news dal DB
     await db.news.delete_one({"_id": ObjectId(news_id)})
+    await home_feed.news_changed(news_id)
     
     # 1. Notifica WebSocket ai destinatari (tutti tranne l'admin)
     payload = create_action_notification_payload('delete', 'news', news.get('title', ''), str(current_user["_id"]))
@@ -458,7 +463,7 @@ async def delete_news(request: Request, news_id: str, current_user: dict = Depen
         # per notificare gli stessi utenti che la vedevano.
         await broadcast_message(ticker_payload, branch=news.get("branch", "*"), employment_type=news.get("employment_type", ["*"]))
     except Exception as e:
-        print(f"[WebSocket] Errore broadcast news_ticker_remove: {e}")
+        logger.warning("[WebSocket] Errore broadcast news_ticker_remove: %s", e)
 
     # 3. Conferma per l'admin
     resp = Response(status_code=200)
@@ -467,6 +472,10 @@ async def delete_news(request: Request, news_id: str, current_user: dict = Depen
 
 @news_router.get('/news/partial', response_class=HTMLResponse)
 async def news_partial(request: Request, current_user = Depends(get_current_user)):
+    etag = change_counters.partial_etag("news_list", current_user, ["news"])
+    not_modified = change_counters.not_modified(request, etag, "news_list")
+    if not_modified:
+        return not_modified
     db = request.app.state.db
     employment_type = current_user.get("employment_type")
     branch = current_user.get("branch")
@@ -492,15 +501,19 @@ async def news_partial(request: Request, current_user = Depends(get_current_user
             ]
         }
     news_items = await db.news.find(mongo_filter).sort("created_at", -1).to_list(None)
-    print(f"[DEBUG] /news/partial: trovate {len(news_items)} news")
+    logger.debug("/news/partial: trovate %s news", len(news_items))
     response = request.app.state.templates.TemplateResponse(
         "partials/home_news_list.html",
         {"request": request, "news": news_items, "user": current_user}
     )
-    return response
+    return change_counters.with_etag(response, etag)
 
 @news_router.get('/news/ticker', response_class=HTMLResponse)
 async def news_ticker(request: Request, current_user = Depends(get_current_user)):
+    etag = change_counters.partial_etag("news_ticker", current_user, ["news"])
+    not_modified = change_counters.not_modified(request, etag, "news_ticker")
+    if not_modified:
+        return not_modified
     db = request.app.state.db
     employment_type = current_user.get("employment_type")
     branch = current_user.get("branch")
@@ -530,7 +543,7 @@ async def news_ticker(request: Request, current_user = Depends(get_current_user)
         "partials/news_ticker.html",
         {"request": request, "news": news_items, "user": current_user}
     )
-    return response
+    return change_counters.with_etag(response, etag)
 
 @news_router.get("/news/{news_id}/row_partial", response_class=HTMLResponse)
 async def news_row_partial(request: Request, news_id: str, user=Depends(get_current_user)):
@@ -707,6 +720,7 @@ async def pin_news(request: Request, news_id: str, current_user: dict = Depends(
         {"_id": ObjectId(news_id)},
         {"$set": {"pinned": True, "pinned_at": datetime.utcnow()}}
     )
+    await home_feed.news_changed(news_id)
     
     news_item = await db.news.find_one({"_id": ObjectId(news_id)})
     title = news_item.get("title", "News")
@@ -731,6 +745,7 @@ async def unpin_news(request: Request, news_id: str, current_user: dict = Depend
         {"_id": ObjectId(news_id)},
         {"$set": {"pinned": False}, "$unset": {"pinned_at": ""}}
     )
+    await home_feed.news_changed(news_id)
     
     news_item = await db.news.find_one({"_id": ObjectId(news_id)})
     title = news_item.get("title", "News")
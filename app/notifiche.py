@@ -2,10 +2,16 @@ from fastapi import APIRouter, Request, Depends, HTTPException, Query
 from fastapi.responses import HTMLResponse, JSONResponse, Response
 from bson import ObjectId
 from datetime import datetime
+from typing import Optional
 
 # 🔸 Niente più import da main.py!
-from app.deps import get_current_user                       # ✅
+from app.deps import get_current_user, get_unread_counts    # ✅
 # Usa sempre request.app.state.templates per i render        # ✅
+from app.utils import unread_counters, change_counters
+
+import logging
+
+logger = logging.getLogger("intranet")
 
 notifiche_router = APIRouter(tags=["notifiche"])
 
@@ -34,13 +40,15 @@ async def crea_notifica(
     }
     if employment_type is not None:
         notifica_doc_data["employment_type"] = employment_type
-        print(f"[DEBUG] Creo notifica DB: tipo={tipo}, id_risorsa={id_risorsa}, employment_type={employment_type}")
+        logger.debug("Creo notifica DB: tipo=%s, id_risorsa=%s, employment_type=%s", tipo, id_risorsa, employment_type)
     else:
-        print(f"[DEBUG] Creo notifica DB: tipo={tipo}, id_risorsa={id_risorsa}, employment_type=None")
+        logger.debug("Creo notifica DB: tipo=%s, id_risorsa=%s, employment_type=None", tipo, id_risorsa)
 
     result = await db.notifiche.insert_one(notifica_doc_data)
     notifica_id_str = str(result.inserted_id)
-    print(f"[DEBUG] Notifica salvata DB: {notifica_doc_data}")
+    # Aggiorna i contatori non lette dei destinatari (badge O(1))
+    await unread_counters.increment_unread(db, tipo, branch, employment_type)
+    logger.debug("Notifica salvata DB: %s", notifica_doc_data)
 
     if destinatario_user_id:
         # Invia notifica WebSocket mirata all'utente destinatario
@@ -56,9 +64,21 @@ async def crea_notifica(
         }
         try:
             await broadcast_message(payload_ws, target_user_id=destinatario_user_id)
-            print(f"[DEBUG] Inviato WS new_notification a {destinatario_user_id} per notifica {notifica_id_str}")
+            logger.debug("Inviato WS new_notification a %s per notifica %s", destinatario_user_id, notifica_id_str)
         except Exception as e:
-            print(f"[ERROR] Fallito invio WS new_notification a {destinatario_user_id}: {e}")
+            logger.error("Fallito invio WS new_notification a %s: %s", destinatario_user_id, e)
+
+
+# 🔹 Elimina notifiche mantenendo allineati i contatori non lette
+async def elimina_notifiche(db, filtro: dict) -> int:
+    notifiche = await db.notifiche.find(
+        filtro, {"tipo": 1, "branch": 1, "employment_type": 1, "letta_da": 1}
+    ).to_list(None)
+    if not notifiche:
+        return 0
+    await unread_counters.discount_deleted(db, notifiche)
+    result = await db.notifiche.delete_many({"_id": {"$in": [n["_id"] for n in notifiche]}})
+    return result.deleted_count
 
 
 # Funzione specializzata per le notifiche dei commenti
@@ -132,7 +152,7 @@ def get_emp_type_conditions(user_emp_type):
 
 
 # 🔹 Pagina con elenco completo delle notifiche non lette
-@notifiche_router.get("/notifiche", response_class=HTMLResponse)
+@notifiche_router.get("/notifiche", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def notifiche_page(request: Request, user=Depends(get_current_user)):
     db = request.app.state.db
     employment_type = user.get("employment_type")
@@ -170,9 +190,9 @@ async def notifiche_inline(request: Request, user=Depends(get_current_user)):
             "letta_da": {"$ne": str(user["_id"])},
             "$or": get_emp_type_conditions(employment_type)
         }
-    print(f"[DEBUG SERVER] Filtro notifiche inline applicato: {q}")
+    logger.debug("Filtro notifiche inline applicato: %s", q)
     notifiche_trovate_nel_db = await db.notifiche.find(q).sort("created_at", -1).to_list(3)
-    print(f"[DEBUG SERVER] Notifiche effettivamente trovate dal DB per inline: {notifiche_trovate_nel_db}")
+    logger.debug("Notifiche effettivamente trovate dal DB per inline: %s", notifiche_trovate_nel_db)
     return request.app.state.templates.TemplateResponse(
         "notifiche/inline_partial.html",
         {"request": request, "notifiche": notifiche_trovate_nel_db},
@@ -183,29 +203,84 @@ async def notifiche_inline(request: Request, user=Depends(get_current_user)):
 @notifiche_router.post("/notifiche/{id}/letta")
 async def segna_letta(id: str, request: Request, user=Depends(get_current_user)):
     db = request.app.state.db
-    await db.notifiche.update_one(
-        {"_id": ObjectId(id)}, {"$addToSet": {"letta_da": str(user["_id"])}}
+    # Decrementa il contatore solo se la notifica non era già letta
+    notifica = await db.notifiche.find_one_and_update(
+        {"_id": ObjectId(id), "letta_da": {"$ne": str(user["_id"])}},
+        {"$addToSet": {"letta_da": str(user["_id"])}},
+        projection={"tipo": 1}
     )
+    if notifica:
+        await unread_counters.decrement_unread(db, user["_id"], notifica["tipo"])
     return JSONResponse({"ok": True}, headers={"HX-Trigger": "refresh-notifiche"})
 
 
+# Badge della navbar: chiave del badge → tipi di notifica conteggiati
+NAV_BADGES = {
+    "link": ("link",),
+    "contatto": ("contatto",),
+    "documento": ("documento",),
+    "news": ("news",),
+    "ai_news": ("ai_news",),
+    "ai_interaction": ("commento", "risposta", "menzione"),
+}
+
+
+# 🔹 Tutti i badge della navbar in un'unica richiesta
+@notifiche_router.get("/notifiche/badges")
+async def notifiche_badges(request: Request, user=Depends(get_current_user)):
+    if not isinstance(user, dict):
+        return Response(status_code=204)
+
+    # Stessi contatori di prima (nessuna scrittura su notifiche_unread): 304
+    # senza leggere Mongo. La variante HTMX/JSON fa parte dell'ETag.
+    hx = request.headers.get("HX-Request") == "true"
+    etag = change_counters.partial_etag(
+        "badges", user,
+        collections=[unread_counters.COLLECTION],
+        keyed=[(unread_counters.COLLECTION, user["_id"])],
+        extra="html" if hx else "json",
+    )
+    not_modified = change_counters.not_modified(request, etag, "badges")
+    if not_modified:
+        return not_modified
+
+    # Un solo look-up sui contatori per-utente (ricostruiti con un $group per tipo se mancanti)
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    badges = {key: unread_counters.sum_counts(counts, tipi) for key, tipi in NAV_BADGES.items()}
+
+    # Chiamata fetch/API: JSON
+    if not hx:
+        return change_counters.with_etag(JSONResponse(badges), etag)
+
+    # Chiamata HTMX: swap out-of-band di tutti i container dei badge
+    def badge(key):
+        return badges[key] or ""
+
+    resp = request.app.state.templates.TemplateResponse(
+        "components/nav_badges_oob.html",
+        {
+            "request": request,
+            "u": user,
+            "oob": True,
+            "unread_links_count": badge("link"),
+            "unread_contatti_count": badge("contatto"),
+            "new_docs_count": badge("documento"),
+            "unread_news_count": badge("news"),
+            "unread_ai_news_count": badge("ai_news"),
+            "unread_ai_interaction_count": badge("ai_interaction"),
+        }
+    )
+    return change_counters.with_etag(resp, etag)
+
+
 # 🔹 Endpoint per il pallino rosso nel menu
 @notifiche_router.get("/notifiche/count/{tipo}", response_class=HTMLResponse)
 async def notifiche_count(tipo: str, request: Request, user=Depends(get_current_user)):
     if not user:
         return Response(status_code=204)
     
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-    
-    q = {
-        "tipo": tipo,
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])},
-        "$or": get_emp_type_conditions(employment_type)
-    }
-    count = await db.notifiche.count_documents(q)
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    count = counts.get(tipo, 0)
     
     # Se il conteggio è 0, restituisci stringa vuota
     if count == 0:
@@ -230,6 +305,7 @@ async def mark_all_read(tipo: str, request: Request, user=Depends(get_current_us
         filtro,
         {"$addToSet": {"letta_da": str(user["_id"])}}
     )
+    await unread_counters.reset_unread(db, user["_id"], tipo)
     return {"ok": True}
 
 
@@ -256,16 +332,8 @@ async def ultima_notifica(request: Request, user=Depends(get_current_user), tipo
 # 🔹 Endpoint per ottenere il conteggio delle notifiche di tipo "link"
 @notifiche_router.get("/notifiche/count/link", response_class=HTMLResponse)
 async def notifiche_count_link(request: Request, user=Depends(get_current_user)):
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-    q = {
-        "tipo": "link",
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])},
-        "$or": get_emp_type_conditions(employment_type)
-    }
-    count = await db.notifiche.count_documents(q)
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    count = counts.get("link", 0)
     # NOTA PER LO SVILUPPATORE:
     # L'elemento HTML che effettua la chiamata hx-get a questo endpoint
     # (e che quindi carica il partial "components/nav_links_badge.html")
@@ -283,16 +351,8 @@ async def notifiche_count_link(request: Request, user=Depends(get_current_user))
 # 🔹 Endpoint per ottenere il conteggio delle notifiche di tipo "contatto"
 @notifiche_router.get("/notifiche/count/contatto", response_class=HTMLResponse)
 async def notifiche_count_contatto(request: Request, user=Depends(get_current_user)):
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-    q = {
-        "tipo": "contatto",
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])},
-        "$or": get_emp_type_conditions(employment_type)
-    }
-    count = await db.notifiche.count_documents(q)
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    count = counts.get("contatto", 0)
     return request.app.state.templates.TemplateResponse(
         "components/nav_contatti_badge.html",
         {"request": request, "unread_contatti_count": "" if count == 0 else count, "u": user}
@@ -302,21 +362,8 @@ async def notifiche_count_contatto(request: Request, user=Depends(get_current_us
 # 🔹 Endpoint per ottenere il conteggio delle notifiche di tipo "documento"
 @notifiche_router.get("/notifiche/count/documento", response_class=HTMLResponse)
 async def notifiche_count_documento(request: Request, user=Depends(get_current_user)):
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-    q = {
-        "tipo": "documento",
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])} ,
-        "$or": [
-            {"employment_type": {"$in": [employment_type, "*"]}},
-            {"employment_type": employment_type},
-            {"employment_type": "*"},
-            {"employment_type": {"$exists": False}}
-        ]
-    }
-    count = await db.notifiche.count_documents(q)
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    count = counts.get("documento", 0)
     return request.app.state.templates.TemplateResponse(
         "components/nav_documenti_badge.html",
         {"request": request, "new_docs_count": "" if count == 0 else count, "u": user}
@@ -326,16 +373,8 @@ async def notifiche_count_documento(request: Request, user=Depends(get_current_u
 # 🔹 Endpoint per ottenere il conteggio delle notifiche di tipo "news"
 @notifiche_router.get("/notifiche/count/news", response_class=HTMLResponse)
 async def notifiche_count_news(request: Request, user=Depends(get_current_user)):
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-    q = {
-        "tipo": "news",
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])},
-        "$or": get_emp_type_conditions(employment_type)
-    }
-    count = await db.notifiche.count_documents(q)
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    count = counts.get("news", 0)
     return request.app.state.templates.TemplateResponse(
         "components/nav_news_badge.html",
         {"request": request, "unread_news_count": "" if count == 0 else count, "u": user}
@@ -347,21 +386,12 @@ async def notifiche_count_ai_interaction(request: Request, user=Depends(get_curr
     if not user:
         return Response(status_code=204)
 
-    db = request.app.state.db
-    employment_type = user.get("employment_type")
-    branch = user.get("branch")
-
     interaction_types = ["commento", "risposta", "menzione"]
 
-    q = {
-        "tipo": {"$in": interaction_types},
-        # Assumiamo che le notifiche per commenti/risposte/menzioni ereditino il branch dalla news AI
-        # e che la visibilità sia quindi basata su quello e sull'employment type dell'utente.
-        "branch": {"$in": ["*", branch]},
-        "letta_da": {"$ne": str(user["_id"])},
-        "$or": get_emp_type_conditions(employment_type)
-    }
-    count = await db.notifiche.count_documents(q)
+    # Le notifiche per commenti/risposte/menzioni ereditano il branch dalla news AI:
+    # la visibilità (e quindi il contatore) segue branch ed employment type dell'utente.
+    counts = await unread_counters.load_unread_counts(request.app.state.db, user)
+    count = unread_counters.sum_counts(counts, interaction_types)
 
     return request.app.state.templates.TemplateResponse(
         "components/nav_ai_news_badge.html",
@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse
-from app.deps import get_current_user
+from app.deps import get_current_user, get_unread_counts
 
 organigramma_router = APIRouter()
 
-@organigramma_router.get("/organigramma", response_class=HTMLResponse)
+@organigramma_router.get("/organigramma", response_class=HTMLResponse, dependencies=[Depends(get_unread_counts)])
 async def organigramma_page(request: Request, user=Depends(get_current_user)):
     return request.app.state.templates.TemplateResponse(
         "organigramma.html",
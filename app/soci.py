@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse
-from app.deps import require_admin, get_current_user
+from app.deps import require_admin, get_current_user, get_unread_counts
 
 soci_router = APIRouter()
 
-@soci_router.get("/soci", response_class=HTMLResponse, dependencies=[Depends(require_admin)])
+@soci_router.get("/soci", response_class=HTMLResponse, dependencies=[Depends(require_admin), Depends(get_unread_counts)])
 async def soci_page(request: Request, user=Depends(get_current_user)):
     return request.app.state.templates.TemplateResponse(
         "soci.html",
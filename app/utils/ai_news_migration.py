@@ -1,92 +1,242 @@
+"""
+Migrazioni dello schema AI news.
+
+Ogni migrazione è un passo versionato di `MIGRATIONS`; `run_migrations`
+esegue in ordine i passi non ancora completati e ne registra lo stato nella
+collection `migrations` (un documento per passo):
+
+    {"_id": "001_ai_news_views_indexes", "version": 1, "status": "done",
+     "checkpoint": None, "result": {...},
+     "runs": [{"started_at": ..., "elapsed_s": 1.8, "processed": 5400, "docs_per_s": 3000.0}]}
+
+I passi scorrono la collection in ordine di `_id` e scrivono con una
+`bulk_write` ogni `MIGRATION_BATCH_SIZE` documenti, salvando dopo ogni batch
+l'ultimo `_id` elaborato (`checkpoint`): se un passo si interrompe, la
+prossima esecuzione riparte da lì invece che dall'inizio.
+
+Di default girano solo i passi di `MIGRATIONS`, idempotenti sullo schema
+attuale (oggi: pulizia delle view duplicate e indici di `ai_news_views`).
+I passi di `OPT_IN_MIGRATIONS` riscrivono documenti esistenti (formato
+legacy, categorie dedotte dai tag, profondità dei commenti) e vanno chiesti
+per nome: `run_migrations(db, include=("ai_news_comment_depths",))`.
+
+Le funzioni dei passi si possono ancora chiamare da sole
+(`await migrate_comment_depths(db)`): senza `MigrationRun` non salvano
+checkpoint.
+"""
+
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
-from datetime import datetime
-from typing import List, Dict
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
 from app.models.ai_news_model import AINewsDB
 
-async def categorize_by_tags(tags: List[str]) -> str:
-    """Determina la categoria in base ai tag esistenti."""
+# --- Configurazione ---
+
+MIGRATIONS_COLLECTION = "migrations"
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "500"))
+
+
+# --- Esecuzione a batch con checkpoint ---
+
+class MigrationRun:
+    """Stato di un passo in esecuzione: checkpoint e contatori."""
+
+    def __init__(self, db, key: Optional[str] = None, checkpoint: Any = None, batch_size: int = MIGRATION_BATCH_SIZE):
+        self.db = db
+        self.key = key              # None: esecuzione singola, nessun checkpoint salvato
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.processed = 0
+        self.written = 0
+        self.started = time.perf_counter()
+
+    async def save_checkpoint(self, last_id: Any) -> None:
+        self.checkpoint = last_id
+        if self.key is None:
+            return
+        await self.db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": self.key},
+            {"$set": {"checkpoint": last_id, "processed": self.processed, "updated_at": datetime.utcnow()}}
+        )
+
+    def throughput(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "processed": self.processed,
+            "written": self.written,
+            "elapsed_s": round(elapsed, 2),
+            "docs_per_s": round(self.processed / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+async def bulk_apply(
+    run: MigrationRun,
+    collection: str,
+    query: Dict[str, Any],
+    make_op: Callable[[Dict[str, Any]], Any],
+    projection: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Scorre `query` in ordine di `_id` a partire dal checkpoint; `make_op(doc)`
+    restituisce l'operazione da eseguire (o None). Una `bulk_write` per batch.
+    """
+    coll = run.db[collection]
+    if run.checkpoint is not None:
+        query = {"$and": [query, {"_id": {"$gt": run.checkpoint}}]}
+
+    ops: List[Any] = []
+    in_batch = 0
+    last_id = None
+    async for doc in coll.find(query, projection).sort("_id", 1):
+        run.processed += 1
+        in_batch += 1
+        last_id = doc["_id"]
+        op = make_op(doc)
+        if op is not None:
+            ops.append(op)
+        if in_batch >= run.batch_size:
+            await _flush(coll, ops, run)
+            await run.save_checkpoint(last_id)
+            ops, in_batch = [], 0
+
+    await _flush(coll, ops, run)
+    if in_batch:
+        await run.save_checkpoint(last_id)
+
+
+async def _flush(coll, ops: List[Any], run: MigrationRun) -> None:
+    if ops:
+        await coll.bulk_write(ops, ordered=False)
+        run.written += len(ops)
+
+
+# --- Passi ---
+
+TECH_TAGS = {"tech", "technical", "coding", "development", "programming", "software", "ai", "ml"}
+BUSINESS_TAGS = {"business", "company", "enterprise", "strategy", "management", "organization"}
+OTHER_TAGS = {"resource", "event", "faq", "guide", "tutorial", "announcement"}
+
+
+def _category_for(tags: List[str]) -> str:
     tags = [tag.lower() for tag in tags]
-    
-    # Definizione dei tag per categoria
-    tech_tags = {"tech", "technical", "coding", "development", "programming", "software", "ai", "ml"}
-    business_tags = {"business", "company", "enterprise", "strategy", "management", "organization"}
-    other_tags = {"resource", "event", "faq", "guide", "tutorial", "announcement"}
-    
-    # Controlla le corrispondenze
-    if any(tag in tech_tags for tag in tags):
+    if any(tag in TECH_TAGS for tag in tags):
         return "technical"
-    if any(tag in business_tags for tag in tags):
+    if any(tag in BUSINESS_TAGS for tag in tags):
         return "business"
-    if any(tag in other_tags for tag in tags):
+    if any(tag in OTHER_TAGS for tag in tags):
         return "other"
     return "generic"
 
-async def migrate_news_categories(db: AsyncIOMotorClient) -> Dict[str, int]:
+
+async def categorize_by_tags(tags: List[str]) -> str:
+    """Determina la categoria in base ai tag esistenti."""
+    return _category_for(tags)
+
+
+async def migrate_news_categories(db: AsyncIOMotorClient, run: Optional[MigrationRun] = None) -> Dict[str, int]:
     """Migra le news esistenti aggiungendo categorie e statistiche aggiornate."""
-    news_collection = db.get_collection("ai_news")
+    run = run or MigrationRun(db)
     stats = {"generic": 0, "technical": 0, "business": 0, "other": 0}
-    
-    async for news in news_collection.find({}):
-        # Determina la categoria
-        category = await categorize_by_tags(news.get("tags", []))
+
+    def make_op(news):
+        category = _category_for(news.get("tags", []))
         stats[category] += 1
-        
-        # Calcola total_interactions
-        current_stats = news.get("stats", {})
-        total_interactions = sum([
-            current_stats.get("views", 0),
-            current_stats.get("likes", 0),
-            current_stats.get("comments", 0)
-        ])
-        
-        # Aggiorna il documento
-        await news_collection.update_one(
-            {"_id": news["_id"]},
-            {
-                "$set": {
-                    "category": category,
-                    "stats.replies": 0,  # Inizializza il conteggio delle risposte
-                    "stats.total_interactions": total_interactions
-                }
-            }
-        )
-    
+
+        current_stats = news.get("stats") or {}
+        update = {
+            "category": category,
+            "stats.total_interactions": sum([
+                current_stats.get("views", 0),
+                current_stats.get("likes", 0),
+                current_stats.get("comments", 0)
+            ])
+        }
+        # Il conteggio delle risposte si inizializza solo se manca: rieseguire non lo azzera
+        if "replies" not in current_stats:
+            update["stats.replies"] = 0
+        return UpdateOne({"_id": news["_id"]}, {"$set": update})
+
+    await bulk_apply(run, "ai_news", {}, make_op, {"tags": 1, "stats": 1})
     return stats
 
-async def migrate_comment_depths(db):
+
+_MISSING = object()
+
+
+def comment_depths(parents: Dict[Any, Any]) -> Dict[Any, Optional[int]]:
+    """
+    Profondità di ogni commento dalla mappa `_id -> parent_id`. Le catene che
+    finiscono su un genitore inesistente (o in un ciclo) hanno profondità None.
+    """
+    depths: Dict[Any, Optional[int]] = {}
+    for start in parents:
+        chain = []
+        visited = set()
+        node = start
+        while node is not None and node not in depths:
+            if node not in parents or node in visited:
+                node = _MISSING
+                break
+            visited.add(node)
+            chain.append(node)
+            node = parents[node]
+
+        if node is None:
+            depth = -1
+        elif node is _MISSING:
+            depth = None
+        else:
+            depth = depths[node]
+        for comment_id in reversed(chain):
+            depth = None if depth is None else depth + 1
+            depths[comment_id] = depth
+    return depths
+
+
+async def migrate_comment_depths(db, run: Optional[MigrationRun] = None) -> Dict[str, int]:
     """Aggiorna i commenti esistenti con il campo depth."""
-    comments_collection = db.get_collection("comments")
-    stats = {"root": 0, "replies": 0}
-    # Prima passata: imposta depth=0 per i commenti root
-    await comments_collection.update_many(
-        {"parent_id": None},
-        {"$set": {"depth": 0}}
-    )
-    stats["root"] = await comments_collection.count_documents({"parent_id": None})
-    # Seconda passata: aggiorna depth per le risposte
-    async for comment in comments_collection.find({"parent_id": {"$ne": None}}):
-        parent = await comments_collection.find_one({"_id": comment["parent_id"]})
-        if parent:
-            depth = parent.get("depth", 0) + 1
-            await comments_collection.update_one(
-                {"_id": comment["_id"]},
-                {"$set": {"depth": depth}}
-            )
-            stats["replies"] += 1
+    run = run or MigrationRun(db)
+    stats = {"root": 0, "replies": 0, "orphans": 0}
+
+    # Una sola lettura (solo _id e parent_id) al posto di un find_one per risposta
+    parents = {}
+    async for comment in db.ai_news_comments.find({}, {"parent_id": 1}):
+        parents[comment["_id"]] = comment.get("parent_id")
+    depths = comment_depths(parents)
+
+    def make_op(comment):
+        depth = depths.get(comment["_id"])
+        if depth is None:
+            stats["orphans"] += 1
+            return None
+        stats["root" if depth == 0 else "replies"] += 1
+        if comment.get("depth") == depth:
+            return None
+        return UpdateOne({"_id": comment["_id"]}, {"$set": {"depth": depth}})
+
+    await bulk_apply(run, "ai_news_comments", {}, make_op, {"depth": 1})
     return stats
 
+
 async def run_migration(db: AsyncIOMotorClient):
     """Esegue la migrazione completa."""
     news_stats = await migrate_news_categories(db)
     comment_stats = await migrate_comment_depths(db)
     return {"news": news_stats, "comments": comment_stats}
 
-async def migrate_existing_news(db):
+
+async def migrate_existing_news(db, run: Optional[MigrationRun] = None) -> Dict[str, int]:
     """Migra i documenti esistenti al nuovo schema."""
-    cursor = db.ai_news.find({})
-    async for doc in cursor:
-        # Prepara il nuovo formato
+    run = run or MigrationRun(db)
+    stats = {"migrated": 0}
+
+    def make_op(doc):
+        # Prepara il nuovo formato; file nel blob store, categoria e contatori restano quelli salvati
         new_doc = {
             "_id": doc["_id"],
             "title": doc["title"],
@@ -104,13 +254,21 @@ async def migrate_existing_news(db):
             "show_on_home": doc.get("show_on_home", False),
             "author_id": doc.get("author_id", ObjectId()),
             "uploaded_at": doc.get("uploaded_at", datetime.utcnow()),
-            "stats": {"views": 0, "likes": 0, "comments": 0},
-            "metadata": {}
+            "stats": doc.get("stats") or {"views": 0, "likes": 0, "comments": 0},
+            "metadata": doc.get("metadata") or {}
         }
-        # Aggiorna il documento
-        await db.ai_news.replace_one({"_id": doc["_id"]}, new_doc)
+        for field in ("blob", "sha256", "size", "category"):
+            if field in doc:
+                new_doc[field] = doc[field]
+        stats["migrated"] += 1
+        return ReplaceOne({"_id": doc["_id"]}, new_doc)
+
+    # Solo i documenti ancora nel vecchio formato (senza `content`)
+    await bulk_apply(run, "ai_news", {"content": {"$exists": False}}, make_op)
+    return stats
+
 
-async def clean_duplicate_views(db):
+async def clean_duplicate_views(db) -> int:
     """Rimuove le visualizzazioni duplicate mantenendo solo la più recente per ogni coppia user_id/news_id"""
     pipeline = [
         {
@@ -129,46 +287,151 @@ async def clean_duplicate_views(db):
             }
         }
     ]
-    
+
     # Trova i duplicati
     duplicates = await db.ai_news_views.aggregate(pipeline).to_list(length=None)
-    
+
     if duplicates:
         print(f"Trovati {len(duplicates)} gruppi di visualizzazioni duplicate")
-        for dup in duplicates:
-            # Mantieni solo il documento più recente
-            last_doc = dup["last_doc"]
-            await db.ai_news_views.delete_many({
-                "user_id": last_doc["user_id"],
-                "news_id": last_doc["news_id"],
-                "_id": {"$ne": last_doc["_id"]}
+        # Mantieni solo il documento più recente, una bulk_write per batch di gruppi
+        ops = [
+            DeleteMany({
+                "user_id": dup["last_doc"]["user_id"],
+                "news_id": dup["last_doc"]["news_id"],
+                "_id": {"$ne": dup["last_doc"]["_id"]}
             })
-        print("Pulizia completata")
-    else:
-        print("Nessun duplicato trovato")
+            for dup in duplicates
+        ]
+        removed = 0
+        for i in range(0, len(ops), MIGRATION_BATCH_SIZE):
+            result = await db.ai_news_views.bulk_write(ops[i:i + MIGRATION_BATCH_SIZE], ordered=False)
+            removed += result.deleted_count
+        print(f"Pulizia completata: {removed} visualizzazioni rimosse")
+        return removed
+    print("Nessun duplicato trovato")
+    return 0
+
 
-async def create_ai_news_views_indexes(db):
+async def create_ai_news_views_indexes(db, run: Optional[MigrationRun] = None) -> Dict[str, int]:
     """Crea gli indici necessari per la collection ai_news_views"""
     # Prima pulisci i duplicati
-    await clean_duplicate_views(db)
-    
+    removed = await clean_duplicate_views(db)
+
     print("Creazione indice unique su user_id + news_id...")
     # Indice composto unique per user_id + news_id
     await db.ai_news_views.create_index(
         [("user_id", 1), ("news_id", 1)],
-        unique=True, 
+        unique=True,
         background=True
     )
 
     print("Creazione indice TTL su last_view...")
     # Indice TTL su last_view per pulizia automatica dopo 90 giorni
     await db.ai_news_views.create_index(
-        "last_view", 
+        "last_view",
         expireAfterSeconds=60*60*24*90  # 90 giorni
     )
+    return {"duplicates_removed": removed}
+
+
+# --- Registro ed esecuzione ---
+
+Step = Tuple[int, str, Callable[..., Awaitable[Dict[str, Any]]]]
+
+# (versione, nome, passo): i passi già completati non vengono rieseguiti.
+# Solo passi idempotenti sullo schema attuale: girano a ogni esecuzione.
+MIGRATIONS: List[Step] = [
+    (1, "ai_news_views_indexes", create_ai_news_views_indexes),
+]
+
+# Passi che riscrivono documenti esistenti: solo se richiesti con `include`.
+# Le news create dal form non hanno `content`, quindi lo schema legacy le
+# toccherebbe tutte; la ricategorizzazione sovrascrive le categorie scelte
+# dagli admin.
+OPT_IN_MIGRATIONS: List[Step] = [
+    (101, "ai_news_legacy_schema", migrate_existing_news),
+    (102, "ai_news_recategorize", migrate_news_categories),
+    (103, "ai_news_comment_depths", migrate_comment_depths),
+]
+
+
+def _selected_steps(include: Tuple[str, ...] = ()) -> List[Step]:
+    unknown = set(include) - {name for _, name, _ in OPT_IN_MIGRATIONS}
+    if unknown:
+        raise ValueError(f"Migrazioni sconosciute: {', '.join(sorted(unknown))}")
+    return MIGRATIONS + [step for step in OPT_IN_MIGRATIONS if step[1] in include]
+
+
+def _key(version: int, name: str) -> str:
+    return f"{version:03d}_{name}"
+
+
+async def migration_status(db) -> List[Dict[str, Any]]:
+    """Stato di ogni passo registrato (per script e diagnostica)."""
+    states = {s["_id"]: s async for s in db[MIGRATIONS_COLLECTION].find({})}
+    return [
+        {
+            "version": version,
+            "name": name,
+            "status": states.get(_key(version, name), {}).get("status", "pending"),
+            "checkpoint": states.get(_key(version, name), {}).get("checkpoint"),
+        }
+        for version, name, _ in MIGRATIONS + OPT_IN_MIGRATIONS
+    ]
+
+
+async def run_migrations(
+    db,
+    batch_size: int = MIGRATION_BATCH_SIZE,
+    redo: Tuple[int, ...] = (),
+    include: Tuple[str, ...] = (),
+) -> List[Dict[str, Any]]:
+    """Esegue le migrazioni necessarie (più i passi opzionali nominati in `include`)"""
+    steps = _selected_steps(include)
+    states_coll = db[MIGRATIONS_COLLECTION]
+    states = {s["_id"]: s async for s in states_coll.find({})}
+    report = []
+
+    for version, name, step in steps:
+        key = _key(version, name)
+        state = states.get(key) or {}
+        if state.get("status") == "done" and version not in redo:
+            print(f"[{key}] già eseguita")
+            continue
+
+        # Un passo interrotto riparte dal checkpoint, uno rieseguito dall'inizio
+        checkpoint = state.get("checkpoint") if state.get("status") != "done" else None
+        started_at = datetime.utcnow()
+        await states_coll.update_one(
+            {"_id": key},
+            {"$set": {"version": version, "name": name, "status": "running",
+                      "checkpoint": checkpoint, "started_at": started_at}},
+            upsert=True
+        )
+        print(f"[{key}] avvio" + (f" dal checkpoint {checkpoint}" if checkpoint is not None else ""))
+
+        run = MigrationRun(db, key, checkpoint, batch_size)
+        try:
+            result = await step(db, run)
+        except Exception as exc:
+            await states_coll.update_one(
+                {"_id": key},
+                {"$set": {"status": "failed", "error": str(exc)},
+                 "$push": {"runs": {"started_at": started_at, **run.throughput(), "error": str(exc)}}}
+            )
+            print(f"[{key}] errore dopo {run.processed} documenti: {exc}")
+            raise
+
+        throughput = run.throughput()
+        await states_coll.update_one(
+            {"_id": key},
+            {"$set": {"status": "done", "checkpoint": None, "error": None,
+                      "finished_at": datetime.utcnow(), "result": result},
+             "$push": {"runs": {"started_at": started_at, **throughput}}}
+        )
+        print(f"[{key}] completata: {throughput['processed']} documenti, {throughput['written']} scritture "
+              f"in {throughput['elapsed_s']}s ({throughput['docs_per_s']} doc/s) {result}")
+        report.append({"key": key, "result": result, **throughput})
 
-async def run_migrations(db):
-    """Esegue tutte le migrazioni necessarie"""
-    print("Inizializzazione migrazione ai_news_views...")
-    await create_ai_news_views_indexes(db)
-    print("Migrazioni completate con successo!")
\ No newline at end of file
+    print("Migrazioni completate con successo!")
+    return report
@@ -0,0 +1,250 @@
+# app/utils/blob_store.py
+
+"""
+Archivio dei file indirizzato per contenuto (SHA-256).
+
+I file caricati per `documents` e `ai_news` venivano salvati con il nome
+sanificato sotto `media/docs`: lo stesso PDF caricato per più filiali
+occupava spazio più volte, e un upload con lo stesso nome sovrascriveva
+silenziosamente il file precedente. Qui ogni contenuto è salvato una sola
+volta in
+
+    media/blobs/ab/cd/abcd...   (SHA-256 esadecimale)
+
+e la collection `blobs` conta i riferimenti:
+
+    {"_id": "<sha256>", "size": 123, "content_type": "application/pdf",
+     "refcount": 2, "created_at": ...}
+
+I documenti puntano al contenuto con il campo `blob` (lo SHA-256) e tengono
+in `filename` il nome da mostrare al download. Un upload di un contenuto
+già presente incrementa solo `refcount`; l'eliminazione dell'ultimo
+riferimento rimuove il file. Lo SHA-256 è anche l'ETag forte dei download.
+
+I documenti caricati prima dell'archivio (senza `blob`) restano leggibili
+dal vecchio percorso finché `scripts/migrate_blob_store.py` non li importa.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fastapi import UploadFile
+from pymongo import ReturnDocument
+
+from app.utils.uploads import StoredUpload, stream_to_temp, UPLOAD_CHUNK_SIZE
+
+logger = logging.getLogger("intranet")
+
+# --- Configurazione ---
+
+BLOB_STORE_DIR = Path(os.getenv("BLOB_STORE_DIR", "media/blobs"))
+COLLECTION = "blobs"
+
+# Collection che referenziano i blob (campo `blob`)
+REFERRING_COLLECTIONS = ("documents", "ai_news")
+
+_stats = {"stored": 0, "deduplicated": 0, "released": 0, "deleted": 0}
+
+
+def blob_path(sha256: str) -> Path:
+    return BLOB_STORE_DIR / sha256[:2] / sha256[2:4] / sha256
+
+
+def _tmp_dir() -> Path:
+    return BLOB_STORE_DIR / "tmp"
+
+
+async def _add_ref(db, sha256: str, size: int, content_type: Optional[str]) -> bool:
+    """+1 riferimento; True se il blob è nuovo."""
+    result = await db[COLLECTION].update_one(
+        {"_id": sha256},
+        {
+            "$inc": {"refcount": 1},
+            "$setOnInsert": {"size": size, "content_type": content_type, "created_at": datetime.utcnow()},
+        },
+        upsert=True
+    )
+    return result.upserted_id is not None
+
+
+async def _commit(db, tmp_path: Path, size: int, sha256: str, content_type: Optional[str]) -> StoredUpload:
+    """
+    Registra il riferimento e sposta il temporaneo nel percorso del blob.
+    Il riferimento viene scritto prima di controllare il file: se un
+    `release` concorrente dell'ultimo riferimento sta eliminando il file,
+    lo ritrova dopo averlo spostato e lo rimette al suo posto (vedi `release`).
+    """
+    dest = blob_path(sha256)
+    try:
+        await _add_ref(db, sha256, size, content_type)
+        if dest.exists():
+            _stats["deduplicated"] += 1
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, dest)
+            _stats["stored"] += 1
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return StoredUpload(dest, size, sha256)
+
+
+async def put_upload(db, file: UploadFile, max_bytes: Optional[int] = None) -> StoredUpload:
+    """
+    Salva un upload nell'archivio (streaming, vedi `app.utils.uploads`) e
+    aggiunge un riferimento. Solleva `UploadTooLarge` oltre `max_bytes`.
+    """
+    tmp_path, size, sha256 = await stream_to_temp(file, _tmp_dir(), max_bytes)
+    return await _commit(db, tmp_path, size, sha256, file.content_type)
+
+
+def _copy_and_hash(source: Path, tmp_path: Path):
+    hasher = hashlib.sha256()
+    size = 0
+    with source.open("rb") as src, tmp_path.open("wb") as out:
+        while True:
+            chunk = src.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            hasher.update(chunk)
+            out.write(chunk)
+    return size, hasher.hexdigest()
+
+
+async def put_file(db, source: Path, content_type: Optional[str] = None) -> StoredUpload:
+    """Importa un file già su disco (usato dalla migrazione); l'originale non viene toccato."""
+    _tmp_dir().mkdir(parents=True, exist_ok=True)
+    tmp_path = _tmp_dir() / f".import-{uuid.uuid4().hex}.part"
+    try:
+        size, sha256 = await asyncio.to_thread(_copy_and_hash, source, tmp_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return await _commit(db, tmp_path, size, sha256, content_type)
+
+
+async def release(db, sha256: Optional[str]) -> bool:
+    """
+    -1 riferimento; all'ultimo elimina il record e il file.
+    Restituisce True se il blob è stato eliminato.
+    """
+    if not sha256:
+        return False
+    blob = await db[COLLECTION].find_one_and_update(
+        {"_id": sha256, "refcount": {"$gt": 0}},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    _stats["released"] += 1
+    if not blob or blob["refcount"] > 0:
+        return False
+    # Elimina solo se nel frattempo nessuno ha aggiunto un riferimento
+    deleted = await db[COLLECTION].delete_one({"_id": sha256, "refcount": {"$lte": 0}})
+    if not deleted.deleted_count:
+        return False
+
+    # Un `_commit` concorrente può aver ricreato il record dopo il delete e
+    # aver contato come deduplicato il file ancora presente: il file viene
+    # prima spostato in una tombstone, poi si ricontrolla il record e, se
+    # esiste di nuovo, il file torna al suo posto invece di essere eliminato.
+    path = blob_path(sha256)
+    tombstone = path.with_name(f"{path.name}.deleted-{uuid.uuid4().hex[:8]}")
+    try:
+        os.replace(path, tombstone)
+    except FileNotFoundError:
+        _stats["deleted"] += 1
+        return True
+    if await db[COLLECTION].find_one({"_id": sha256}, {"_id": 1}):
+        if path.exists():
+            # Nel frattempo il `_commit` ha scritto il suo file (stesso contenuto)
+            tombstone.unlink(missing_ok=True)
+        else:
+            os.replace(tombstone, path)
+        logger.info("[BLOB] %s riusato durante l'eliminazione, file mantenuto", sha256[:12])
+        return False
+    tombstone.unlink(missing_ok=True)
+    _stats["deleted"] += 1
+    return True
+
+
+def resolve(doc: Dict[str, Any], legacy_dir: Path, filename: Optional[str] = None) -> Optional[Path]:
+    """Percorso su disco del file di `doc`: il blob se presente, altrimenti il vecchio percorso."""
+    if doc.get("blob"):
+        return blob_path(doc["blob"])
+    filename = filename or doc.get("filename")
+    return legacy_dir / filename if filename else None
+
+
+def strong_etag(doc: Dict[str, Any]) -> Optional[str]:
+    """ETag forte dei download: lo SHA-256 del contenuto, se noto."""
+    sha256 = doc.get("blob") or doc.get("sha256")
+    return f'"{sha256}"' if sha256 else None
+
+
+# --- Manutenzione ---
+
+async def recount(db, apply: bool = False) -> Dict[str, List[Any]]:
+    """
+    Confronta `refcount` con i riferimenti reali in REFERRING_COLLECTIONS.
+    Con `apply` corregge i contatori, elimina i blob senza riferimenti e i
+    file orfani su disco. Restituisce le differenze trovate.
+    """
+    actual: Dict[str, int] = {}
+    for coll in REFERRING_COLLECTIONS:
+        pipeline = [
+            {"$match": {"blob": {"$type": "string"}}},
+            {"$group": {"_id": "$blob", "n": {"$sum": 1}}},
+        ]
+        async for row in db[coll].aggregate(pipeline):
+            actual[row["_id"]] = actual.get(row["_id"], 0) + row["n"]
+
+    report: Dict[str, List[Any]] = {"fixed": [], "unreferenced": [], "missing_files": [], "orphan_files": []}
+    known = set()
+    async for blob in db[COLLECTION].find({}, {"refcount": 1}):
+        sha256 = blob["_id"]
+        known.add(sha256)
+        refs = actual.get(sha256, 0)
+        if refs == 0:
+            report["unreferenced"].append(sha256)
+            if apply:
+                await db[COLLECTION].delete_one({"_id": sha256})
+                blob_path(sha256).unlink(missing_ok=True)
+        elif blob.get("refcount") != refs:
+            report["fixed"].append((sha256, blob.get("refcount"), refs))
+            if apply:
+                await db[COLLECTION].update_one({"_id": sha256}, {"$set": {"refcount": refs}})
+        if refs and not blob_path(sha256).exists():
+            report["missing_files"].append(sha256)
+
+    # Riferimenti a blob senza record: si ricrea il record se il file c'è
+    for sha256 in set(actual) - known:
+        path = blob_path(sha256)
+        if not path.exists():
+            report["missing_files"].append(sha256)
+            continue
+        report["fixed"].append((sha256, None, actual[sha256]))
+        if apply:
+            await db[COLLECTION].update_one(
+                {"_id": sha256},
+                {"$set": {"refcount": actual[sha256]},
+                 "$setOnInsert": {"size": path.stat().st_size, "content_type": None, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+
+    if BLOB_STORE_DIR.exists():
+        for path in BLOB_STORE_DIR.glob("??/??/*"):
+            if path.name not in known and path.name not in actual:
+                report["orphan_files"].append(str(path))
+                if apply:
+                    path.unlink(missing_ok=True)
+    return report
+
+
+def store_stats() -> Dict[str, int]:
+    return dict(_stats)
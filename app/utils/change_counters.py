@@ -0,0 +1,134 @@
+# app/utils/change_counters.py
+
+"""
+Contatori di modifica per collection ed ETag dei partial HTMX.
+
+I partial (`/news/partial`, `/documents/list/partial`, `/links/list`,
+`/notifiche/badges`, ...) vengono richiesti di nuovo a ogni evento
+WebSocket di refresh e quasi sempre restituiscono lo stesso HTML. Ogni
+worker tiene in memoria un contatore per collection, incrementato dalle
+rotte che scrivono:
+
+    await change_counters.collection_changed("documents", doc_id)
+
+L'incremento viaggia sul backend pub/sub dei WebSocket (vedi
+`publish_invalidation`), quindi arriva a tutti i worker. L'ETag di un
+partial combina i contatori delle collection da cui dipende con ciò che
+dell'utente influisce sul contenuto (ruolo, filiale, tipo di contratto):
+
+    etag = change_counters.partial_etag("documents_list", current_user, ["documents"])
+    not_modified = change_counters.not_modified(request, etag, "documents_list")
+    if not_modified:
+        return not_modified          # 304: nessuna query, nessun render
+    ...
+    return change_counters.with_etag(response, etag)
+
+Nell'ETag entrano anche un identificativo del processo (i contatori di
+worker diversi non sono confrontabili) e una finestra temporale di
+`PARTIAL_ETAG_MAX_AGE` secondi, che limita quanto può restare in cache una
+modifica fatta fuori dalle rotte (script, migrazioni).
+"""
+
+import hashlib
+import os
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+
+from app.ws_broadcast import on_invalidate, publish_invalidation
+
+# --- Configurazione ---
+
+PARTIAL_ETAG_MAX_AGE = int(os.getenv("PARTIAL_ETAG_MAX_AGE", "300"))
+
+# Collection con contatori anche per chiave: una modifica con chiave
+# incrementa solo quello della chiave (es. i badge di un singolo utente)
+PER_KEY_COLLECTIONS = {"notifiche_unread"}
+
+_PROCESS_ID = uuid.uuid4().hex[:8]
+
+_versions: Counter = Counter()                      # collection -> versione
+_key_versions: Counter = Counter()                  # (collection, chiave) -> versione
+_stats: Dict[str, Counter] = {"not_modified": Counter(), "rendered": Counter()}
+
+
+@on_invalidate
+def _on_invalidate(data: Dict[str, Any]) -> None:
+    collection, key = data.get("collection"), data.get("key")
+    if not collection:
+        return
+    if collection in PER_KEY_COLLECTIONS and key:
+        _key_versions[(collection, key)] += 1
+    else:
+        _versions[collection] += 1
+
+
+async def collection_changed(collection: str, key: Any = None) -> None:
+    """Da chiamare dopo una scrittura su `collection` (in tutti i worker)."""
+    await publish_invalidation(collection, str(key) if key is not None else None)
+
+
+# --- ETag ---
+
+def partial_etag(
+    name: str,
+    user: Dict[str, Any],
+    collections: Iterable[str] = (),
+    keyed: Iterable[Tuple[str, Any]] = (),
+    extra: str = "",
+) -> str:
+    """
+    ETag debole del partial `name` per l'utente: versioni delle
+    `collections` e delle coppie (collection, chiave) in `keyed`, più il
+    pubblico dell'utente e l'eventuale variante `extra`.
+    """
+    versions = [str(_versions[c]) for c in collections]
+    versions += [str(_key_versions[(c, str(k))]) for c, k in keyed]
+    audience = f"{user.get('role')}|{user.get('branch')}|{user.get('employment_type')}|{extra}"
+    digest = hashlib.blake2b(audience.encode(), digest_size=6).hexdigest()
+    window = int(time.time() // PARTIAL_ETAG_MAX_AGE) if PARTIAL_ETAG_MAX_AGE > 0 else 0
+    return f'W/"{name}-{_PROCESS_ID}.{window}-{".".join(versions)}-{digest}"'
+
+
+def _matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (t.strip() for t in header.split(","))
+
+
+def not_modified(request: Request, etag: str, name: str) -> Optional[Response]:
+    """Risposta 304 se il client ha già la versione `etag`, altrimenti None."""
+    if _matches(request, etag):
+        _stats["not_modified"][name] += 1
+        return Response(status_code=304, headers=_cache_headers(etag))
+    _stats["rendered"][name] += 1
+    return None
+
+
+def _cache_headers(etag: str) -> Dict[str, str]:
+    # private: il contenuto dipende dall'utente; no-cache: il browser
+    # rivalida sempre (If-None-Match) invece di riusare la copia in silenzio
+    return {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "HX-Request"}
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.headers.update(_cache_headers(etag))
+    return response
+
+
+def etag_stats() -> Dict[str, Any]:
+    names = set(_stats["not_modified"]) | set(_stats["rendered"])
+    return {
+        "versions": dict(_versions),
+        "partials": {
+            name: {
+                "not_modified": _stats["not_modified"][name],
+                "rendered": _stats["rendered"][name],
+            }
+            for name in sorted(names)
+        },
+    }
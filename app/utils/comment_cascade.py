@@ -0,0 +1,115 @@
+# app/utils/comment_cascade.py
+
+"""
+Eliminazione a cascata di un commento AI news.
+
+`delete_comment` caricava le risposte dirette, le eliminava, inviava un
+messaggio `reply/delete` per ciascuna, eliminava il commento, aggiornava
+`stats.comments`, ricontava con `count_documents` e infine aggiornava il
+genitore: molte andate e ritorni col database, N broadcast, e le risposte
+alle risposte restavano orfane.
+
+`delete_comment_tree` fa tutto in un'unica transazione:
+
+1. un `$graphLookup` sull'indice `parent_id` raccoglie gli `_id` dell'intero
+   sottoalbero (risposte a ogni livello);
+2. un solo `delete_many` li elimina insieme al commento;
+3. `stats.comments` della news e `replies_count` del genitore si aggiornano
+   con `find_one_and_update`, che restituisce già i nuovi totali.
+
+Il risultato contiene tutto ciò che serve all'unico evento `comment/delete`
+(`reply_ids`, `total_comments`, `parent_replies_count`).
+
+Le transazioni richiedono un replica set: su un mongod standalone la prima
+operazione fallisce con `IllegalOperation` (prima di qualsiasi scrittura) e
+da lì in poi gli stessi passi vengono eseguiti senza sessione.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger("intranet")
+
+# Codice MongoDB di IllegalOperation ("Transaction numbers are only allowed on a replica set ...")
+_ILLEGAL_OPERATION = 20
+
+_transactions_supported: Optional[bool] = None
+
+
+async def subtree_ids(db, comment_id: Any, session=None) -> List[Any]:
+    """`_id` di tutte le risposte (a ogni livello) sotto `comment_id`, con un solo $graphLookup."""
+    pipeline = [
+        {"$match": {"_id": comment_id}},
+        {"$graphLookup": {
+            "from": "ai_news_comments",
+            "startWith": "$_id",
+            "connectFromField": "_id",
+            "connectToField": "parent_id",
+            "as": "descendants",
+        }},
+        {"$project": {"ids": "$descendants._id"}},
+    ]
+    rows = await db.ai_news_comments.aggregate(pipeline, session=session).to_list(1)
+    return rows[0]["ids"] if rows else []
+
+
+async def _delete_tree(db, comment: Dict[str, Any], session=None) -> Optional[Dict[str, Any]]:
+    reply_ids = await subtree_ids(db, comment["_id"], session)
+
+    result = await db.ai_news_comments.delete_many(
+        {"_id": {"$in": [comment["_id"], *reply_ids]}}, session=session
+    )
+    if not result.deleted_count:
+        return None                 # già eliminato da un'altra richiesta
+
+    news = await db.ai_news.find_one_and_update(
+        {"_id": comment["news_id"]},
+        {"$inc": {"stats.comments": -result.deleted_count}},
+        return_document=ReturnDocument.AFTER,
+        projection={"stats.comments": 1},
+        session=session
+    )
+
+    parent_replies_count = None
+    if comment.get("parent_id"):
+        parent = await db.ai_news_comments.find_one_and_update(
+            {"_id": comment["parent_id"]},
+            {"$inc": {"replies_count": -1}},
+            return_document=ReturnDocument.AFTER,
+            projection={"replies_count": 1},
+            session=session
+        )
+        if parent:
+            parent_replies_count = parent.get("replies_count", 0)
+
+    return {
+        "reply_ids": reply_ids,
+        "deleted_count": result.deleted_count,
+        "total_comments": max(0, ((news or {}).get("stats") or {}).get("comments", 0)),
+        "parent_replies_count": parent_replies_count,
+    }
+
+
+async def delete_comment_tree(db, comment: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Elimina `comment` e tutte le sue risposte aggiornando i contatori.
+    Restituisce None se il commento non esiste più.
+    """
+    global _transactions_supported
+    if _transactions_supported is not False:
+        try:
+            async with await db.client.start_session() as session:
+                async def callback(s):
+                    return await _delete_tree(db, comment, s)
+                result = await session.with_transaction(callback)
+            _transactions_supported = True
+            return result
+        except OperationFailure as exc:
+            if exc.code != _ILLEGAL_OPERATION:
+                raise
+            _transactions_supported = False
+            logger.warning("MongoDB senza replica set: eliminazione commenti senza transazione")
+    return await _delete_tree(db, comment)
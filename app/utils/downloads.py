@@ -0,0 +1,218 @@
+# app/utils/downloads.py
+
+"""
+Invio dei file di documenti e AI news.
+
+Le rotte di download/anteprima restituivano un `FileResponse` semplice: i
+viewer PDF che chiedono il file a pezzi (`Range`) dovevano riscaricarlo
+tutto, e ogni riapertura rileggeva il file intero. `file_response` aggiunge:
+
+- richieste parziali `Range: bytes=...` (206, un solo intervallo; 416 se
+  fuori dal file), con `If-Range`;
+- richieste condizionali `If-None-Match` / `If-Modified-Since` (304);
+- `Cache-Control: private, max-age=..., immutable` per i file dell'archivio
+  per contenuto (il contenuto di un blob non cambia mai), `private, no-cache`
+  per i vecchi file su percorso (il browser rivalida a ogni apertura).
+
+Con `DOWNLOAD_ACCEL` il worker non invia i byte: dopo i controlli di
+autorizzazione della rotta risponde con l'header per il proxy davanti
+all'app, che serve il file (Range compreso) da una location interna:
+
+- `nginx`:    `X-Accel-Redirect: <DOWNLOAD_ACCEL_PREFIX><percorso sotto MEDIA_ROOT>`
+- `sendfile`: `X-Sendfile: <percorso assoluto>` (Apache mod_xsendfile, lighttpd)
+
+Esempio nginx:
+
+    location /_protected/ {
+        internal;
+        alias /srv/intranet/media/;
+    }
+"""
+
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# --- Configurazione ---
+
+DOWNLOAD_ACCEL = os.getenv("DOWNLOAD_ACCEL", "").lower()          # "", "nginx", "sendfile"
+DOWNLOAD_ACCEL_PREFIX = os.getenv("DOWNLOAD_ACCEL_PREFIX", "/_protected/")
+MEDIA_ROOT = Path(os.getenv("MEDIA_ROOT", "media"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+IMMUTABLE_MAX_AGE = int(os.getenv("DOWNLOAD_IMMUTABLE_MAX_AGE", str(365 * 24 * 3600)))
+
+_RANGE_RE = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$")
+
+_stats = {"full": 0, "partial": 0, "not_modified": 0, "unsatisfiable": 0, "accel": 0}
+
+
+# --- Header ---
+
+def content_disposition(filename: str, inline: bool = False) -> str:
+    """Content-Disposition con `filename*` (RFC 5987) per i nomi non ASCII."""
+    kind = "inline" if inline else "attachment"
+    ascii_name = filename.encode("ascii", "replace").decode().replace("?", "_").replace('"', "")
+    if ascii_name == filename:
+        return f'{kind}; filename="{filename}"'
+    return f"{kind}; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Confronto debole (RFC 9110 §13.1.2): `W/` non conta."""
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for tag in header.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == bare:
+            return True
+    return False
+
+
+def _not_modified_since(header: str, mtime: float) -> bool:
+    try:
+        since = parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return False
+    return int(mtime) <= since
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    (inizio, fine) inclusivi di un `Range: bytes=...` a intervallo singolo.
+    None se l'header non è interpretabile (si risponde con il file intero);
+    solleva ValueError se l'intervallo è fuori dal file (416).
+    """
+    match = _RANGE_RE.match(header)
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if size == 0:
+        # Un file vuoto non ha byte da restituire per nessun intervallo
+        raise ValueError("file vuoto")
+    if not first:
+        # Suffisso: gli ultimi N byte
+        length = int(last)
+        if length == 0:
+            raise ValueError("range vuoto")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range fuori dal file")
+    return start, end
+
+
+async def _iter_file(path: Path, start: int, length: int):
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _accel_headers(path: Path) -> Optional[Dict[str, str]]:
+    if DOWNLOAD_ACCEL == "sendfile":
+        return {"X-Sendfile": str(path.resolve())}
+    if DOWNLOAD_ACCEL == "nginx":
+        try:
+            relative = path.resolve().relative_to(MEDIA_ROOT.resolve())
+        except ValueError:
+            return None           # fuori da MEDIA_ROOT: lo serve l'app
+        return {"X-Accel-Redirect": DOWNLOAD_ACCEL_PREFIX + quote(relative.as_posix())}
+    return None
+
+
+# --- Risposta ---
+
+def file_response(
+    request: Request,
+    path: Path,
+    filename: str,
+    media_type: Optional[str] = None,
+    etag: Optional[str] = None,
+    immutable: bool = False,
+    inline: bool = False,
+) -> Response:
+    """
+    Risposta per `path` (già autorizzato dalla rotta) con Range, 304 e
+    cache. `etag` è l'ETag forte del contenuto se noto (SHA-256), altrimenti
+    se ne calcola uno debole da mtime e dimensione; `immutable` va usato
+    solo per i file indirizzati per contenuto.
+    """
+    stat = path.stat()
+    media_type = media_type or "application/octet-stream"
+    etag = etag or f'W/"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": f"private, max-age={IMMUTABLE_MAX_AGE}, immutable" if immutable else "private, no-cache",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": content_disposition(filename, inline),
+    }
+
+    # If-None-Match ha la precedenza; If-Modified-Since vale solo senza di esso
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if (if_none_match and _etag_matches(if_none_match, etag)) or (
+        not if_none_match and if_modified_since and _not_modified_since(if_modified_since, stat.st_mtime)
+    ):
+        _stats["not_modified"] += 1
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "Content-Disposition"})
+
+    accel = _accel_headers(path)
+    if accel:
+        # Il proxy gestisce Range e invia i byte; Content-Type lo prende da qui
+        _stats["accel"] += 1
+        return Response(status_code=200, media_type=media_type, headers={**headers, **accel})
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range: il range vale solo se la copia del client è ancora quella
+    # attuale (confronto forte: un ETag W/ non basta)
+    if range_header and if_range:
+        if_range = if_range.strip()
+        if if_range != last_modified and (if_range != etag or etag.startswith("W/")):
+            range_header = None
+
+    if range_header:
+        try:
+            byte_range = _parse_range(range_header, stat.st_size)
+        except ValueError:
+            _stats["unsatisfiable"] += 1
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}", "Accept-Ranges": "bytes"})
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            _stats["partial"] += 1
+            return StreamingResponse(
+                _iter_file(path, start, length),
+                status_code=206,
+                media_type=media_type,
+                headers={
+                    **headers,
+                    "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                    "Content-Length": str(length),
+                },
+            )
+
+    _stats["full"] += 1
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+
+def download_stats() -> Dict[str, int]:
+    return dict(_stats)
@@ -0,0 +1,295 @@
+# app/utils/home_feed.py
+
+"""
+Feed della home materializzato per segmento di pubblico.
+
+La home (`/`) e i partial `/home/highlights/partial` e
+`/home/news_ticker/partial` mostrano le news e gli elementi "in evidenza"
+(`home_highlights`) visibili all'utente. I segmenti di pubblico sono pochi
+(filiale × tipo di contratto, più gli admin che vedono tutto), quindi invece
+di interrogare Mongo a ogni richiesta il modulo tiene in memoria:
+
+- lo store di news e highlights, caricato una volta e poi aggiornato un
+  elemento alla volta;
+- per ogni segmento già richiesto, le liste pronte per i template e un ETag
+  calcolato dal contenuto (cambia solo se cambia quello che il segmento vede).
+
+Gli handler che scrivono `news` o `home_highlights` chiamano
+`news_changed` / `highlight_changed`: l'invalidazione viaggia sul backend
+pub/sub dei WebSocket (vedi `publish_invalidation`), quindi raggiunge tutti
+i worker. Ogni worker marca l'elemento come da ricaricare e alla richiesta
+successiva rilegge da Mongo solo gli elementi marcati.
+
+Come rete di sicurezza per le scritture che non passano dagli handler
+(script, migrazioni) lo store viene ricaricato per intero ogni
+`HOME_FEED_MAX_AGE` secondi.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from app.ws_broadcast import on_invalidate, publish_invalidation
+
+logger = logging.getLogger("intranet")
+
+# --- Configurazione ---
+
+HOME_FEED_MAX_AGE = float(os.getenv("HOME_FEED_MAX_AGE", "300"))
+
+ADMIN_SEGMENT = ("*admin*", None)
+
+# Le revisioni sono contatori del singolo processo: l'id del processo entra
+# nell'ETag, così due worker non producono lo stesso ETag per feed diversi
+_PROCESS_ID = uuid.uuid4().hex[:8]
+
+# --- Store in memoria ---
+
+_news: Dict[str, Dict[str, Any]] = {}            # _id -> news
+_highlights: Dict[str, Dict[str, Any]] = {}      # "tipo:object_id" -> highlight
+_revisions: Dict[str, int] = {}                  # chiave store -> revisione
+_revision_counter = 0
+_dirty_news: Set[str] = set()
+_dirty_highlights: Set[str] = set()
+_loaded_at: Optional[datetime] = None
+_lock = asyncio.Lock()
+_segments: Dict[Tuple[str, Optional[str]], "SegmentFeed"] = {}
+_stats = {"full_loads": 0, "item_reloads": 0, "segment_builds": 0, "hits": 0}
+
+
+def highlight_key(item_type: str, object_id: Any) -> str:
+    return f"{item_type}:{object_id}"
+
+
+def _normalize_highlight(h: Dict[str, Any]) -> Dict[str, Any]:
+    """_id/object_id come stringhe e `id` legacy rinominato in object_id."""
+    h["_id"] = str(h["_id"])
+    if "id" in h:
+        h.setdefault("object_id", h["id"])
+        del h["id"]
+    if "object_id" in h:
+        h["object_id"] = str(h["object_id"])
+    return h
+
+
+def _bump(key: str) -> None:
+    global _revision_counter
+    _revision_counter += 1
+    _revisions[key] = _revision_counter
+
+
+def _store_news(news_id: str, doc: Optional[Dict[str, Any]]) -> None:
+    key = f"news:{news_id}"
+    if doc is None:
+        _news.pop(news_id, None)
+        _revisions.pop(key, None)
+    else:
+        _news[news_id] = doc
+        _bump(key)
+
+
+def _store_highlight(key: str, doc: Optional[Dict[str, Any]]) -> None:
+    if doc is None:
+        _highlights.pop(key, None)
+        _revisions.pop(key, None)
+    else:
+        _highlights[key] = doc
+        _bump(key)
+
+
+async def _load_all(db) -> None:
+    global _loaded_at
+    # Le invalidazioni arrivate finora sono coperte dal caricamento completo;
+    # quelle che arrivano durante le query restano marcate per il giro dopo
+    _dirty_news.clear()
+    _dirty_highlights.clear()
+    news = await db.news.find({}).to_list(length=None)
+    highlights = await db.home_highlights.find({"type": {"$ne": "news"}}).to_list(length=None)
+    _news.clear()
+    _highlights.clear()
+    _revisions.clear()
+    for doc in news:
+        _store_news(str(doc["_id"]), doc)
+    for doc in highlights:
+        doc = _normalize_highlight(doc)
+        _store_highlight(highlight_key(doc.get("type"), doc.get("object_id")), doc)
+    _loaded_at = datetime.utcnow()
+    _stats["full_loads"] += 1
+    logger.info(f"[HOME] Feed caricato: {len(_news)} news, {len(_highlights)} highlights")
+
+
+def _object_id_or_none(value: str) -> Optional[ObjectId]:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+async def _reload_dirty(db) -> None:
+    """Rilegge solo gli elementi invalidati (una query per collection)."""
+    news_ids, highlight_keys = set(_dirty_news), set(_dirty_highlights)
+    _dirty_news.difference_update(news_ids)
+    _dirty_highlights.difference_update(highlight_keys)
+
+    if news_ids:
+        oids = [oid for oid in map(_object_id_or_none, news_ids) if oid is not None]
+        found = {str(doc["_id"]): doc for doc in await db.news.find({"_id": {"$in": oids}}).to_list(length=None)}
+        for news_id in news_ids:
+            _store_news(news_id, found.get(news_id))
+
+    if highlight_keys:
+        pairs = [key.split(":", 1) for key in highlight_keys]
+        conditions = [{"type": item_type, "object_id": object_id} for item_type, object_id in pairs]
+        docs = await db.home_highlights.find({"$or": conditions}).to_list(length=None)
+        found = {}
+        for doc in docs:
+            doc = _normalize_highlight(doc)
+            found[highlight_key(doc.get("type"), doc.get("object_id"))] = doc
+        for key in highlight_keys:
+            _store_highlight(key, found.get(key))
+
+    _stats["item_reloads"] += len(news_ids) + len(highlight_keys)
+    # I segmenti si ricostruiscono dallo store alla prossima richiesta: se il
+    # contenuto visibile non è cambiato l'ETag resta lo stesso
+    _segments.clear()
+
+
+async def _sync(db) -> None:
+    async with _lock:
+        expired = _loaded_at is None or (datetime.utcnow() - _loaded_at).total_seconds() > HOME_FEED_MAX_AGE
+        if expired:
+            await _load_all(db)
+            _segments.clear()
+        elif _dirty_news or _dirty_highlights:
+            await _reload_dirty(db)
+
+
+# --- Invalidazione ---
+
+@on_invalidate
+def _on_invalidate(data: Dict[str, Any]) -> None:
+    global _loaded_at
+    collection, key = data.get("collection"), data.get("key")
+    if collection == "news" and key:
+        _dirty_news.add(key)
+    elif collection == "home_highlights" and key:
+        _dirty_highlights.add(key)
+    elif collection in ("news", "home_highlights"):
+        # Invalidazione senza chiave: ricarica completa
+        _loaded_at = None
+
+
+async def news_changed(news_id: Any) -> None:
+    """Da chiamare dopo aver creato, modificato o eliminato una news."""
+    await publish_invalidation("news", str(news_id))
+
+
+async def highlight_changed(item_type: str, object_id: Any) -> None:
+    """Da chiamare dopo aver scritto o eliminato un elemento di `home_highlights`."""
+    await publish_invalidation("home_highlights", highlight_key(item_type, object_id))
+
+
+# --- Segmenti ---
+
+def segment_key(user: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    if user.get("role") == "admin":
+        return ADMIN_SEGMENT
+    return (user.get("branch") or "", user.get("employment_type") or None)
+
+
+def _visible(item: Dict[str, Any], branch: str, employment_type: Optional[str]) -> bool:
+    """Stesse regole del vecchio filtro Mongo di `home_highlights_partial`."""
+    item_branch = item.get("branch")
+    if item_branch != "*" and (not branch or item_branch != branch):
+        return False
+    item_types = item.get("employment_type")
+    if item_types is None or item_types == []:
+        return True
+    if not isinstance(item_types, list):
+        item_types = [item_types]
+    return "*" in item_types or (employment_type is not None and employment_type in item_types)
+
+
+def _sort_news(news: List[Tuple[str, Dict[str, Any]]]) -> None:
+    """Pinnate prima, poi priorità crescente, poi più recenti (come il vecchio sort Mongo)."""
+    news.sort(key=lambda kv: kv[1].get("created_at") or datetime.min, reverse=True)
+    news.sort(key=lambda kv: (
+        not kv[1].get("pinned", False),
+        kv[1]["priority"] if kv[1].get("priority") is not None else float("-inf"),
+    ))
+
+
+class SegmentFeed:
+    """Liste pronte per i template di un segmento di pubblico."""
+
+    __slots__ = ("highlights", "news_items", "ticker", "etag", "valid_until")
+
+    def __init__(self, key: Tuple[str, Optional[str]], now: datetime):
+        if key == ADMIN_SEGMENT:
+            news = list(_news.items())
+            highlights = list(_highlights.items())
+        else:
+            branch, employment_type = key
+            news = [(k, n) for k, n in _news.items() if _visible(n, branch, employment_type)]
+            highlights = [(k, h) for k, h in _highlights.items() if _visible(h, branch, employment_type)]
+
+        highlights.sort(key=lambda kv: kv[1].get("created_at") or datetime.min, reverse=True)
+        self.highlights = [h for _, h in highlights]
+        self.ticker = sorted((n for _, n in news), key=lambda n: n.get("created_at") or datetime.min, reverse=True)
+
+        live = [(k, n) for k, n in news if not n.get("expires_at") or n["expires_at"] > now]
+        _sort_news(live)
+        self.news_items = [n for _, n in live]
+        # Il segmento va ricostruito quando scade la prossima news
+        upcoming = [n["expires_at"] for _, n in live if n.get("expires_at")]
+        self.valid_until = min(upcoming) if upcoming else None
+
+        digest = hashlib.blake2b(digest_size=12)
+        for store_key, _ in highlights:
+            digest.update(f"h{store_key}@{_revisions.get(store_key)};".encode())
+        for news_id, _ in news:
+            digest.update(f"n{news_id}@{_revisions.get(f'news:{news_id}')};".encode())
+        digest.update(f"live={len(live)}".encode())
+        self.etag = f"{_PROCESS_ID}.{digest.hexdigest()}"
+
+
+async def get_segment_feed(db, user: Dict[str, Any]) -> SegmentFeed:
+    """Feed del segmento dell'utente, senza query se lo store è aggiornato."""
+    await _sync(db)
+    now = datetime.utcnow()
+    key = segment_key(user)
+    feed = _segments.get(key)
+    if feed is None or (feed.valid_until is not None and feed.valid_until <= now):
+        feed = _segments[key] = SegmentFeed(key, now)
+        _stats["segment_builds"] += 1
+    else:
+        _stats["hits"] += 1
+    return feed
+
+
+def user_etag(feed: SegmentFeed, user: Dict[str, Any], template: str) -> str:
+    """
+    ETag di un partial della home per l'utente: contenuto del segmento più
+    le card pinnate dell'utente (rese nello stesso partial).
+    """
+    pins = ",".join(f"{p.get('type')}:{p.get('id')}" for p in user.get("pinned_items") or [])
+    pins_digest = hashlib.blake2b(pins.encode(), digest_size=6).hexdigest()
+    return f'W/"{template}-{feed.etag}-{pins_digest}"'
+
+
+def feed_stats() -> Dict[str, Any]:
+    return {
+        **_stats,
+        "news": len(_news),
+        "highlights": len(_highlights),
+        "segments": len(_segments),
+        "pending_invalidations": len(_dirty_news) + len(_dirty_highlights),
+        "loaded_at": _loaded_at.isoformat() if _loaded_at else None,
+    }
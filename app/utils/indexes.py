@@ -0,0 +1,255 @@
+# app/utils/indexes.py
+
+"""
+Registro dichiarativo degli indici MongoDB.
+
+Ogni collection elenca gli indici che le query delle rotte si aspettano.
+`reconcile_indexes` confronta il registro con `index_information()` e crea
+quelli mancanti: viene chiamato nel lifespan dell'app e dallo script
+`scripts/manage_indexes.py`, che può anche eliminare gli indici non
+dichiarati (`--prune`) e stampare il report `explain()` delle query tipo
+(`--explain`) per trovare quelle che fanno ancora COLLSCAN.
+
+Gli indici `unique` riflettono i punti in cui il codice assume già
+l'unicità (upsert per email, like per utente, highlight per risorsa): se
+nel database ci sono duplicati la creazione fallisce e viene riportata,
+senza bloccare l'avvio.
+"""
+
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger("intranet")
+
+# --- Registro ---
+
+INDEXES: Dict[str, List[Dict[str, Any]]] = {
+    "users": [
+        {"keys": [("email", ASCENDING)], "unique": True},
+    ],
+    "notifiche": [
+        # badge e "segna come lette" per tipo
+        {"keys": [("tipo", ASCENDING), ("branch", ASCENDING), ("created_at", DESCENDING)]},
+        # pagina /notifiche e dropdown: ultime notifiche visibili per filiale
+        {"keys": [("branch", ASCENDING), ("created_at", DESCENDING)]},
+    ],
+    "notifiche_unread": [
+        # increment_unread / discount_deleted aggiornano per audience
+        {"keys": [("branch", ASCENDING), ("employment_type", ASCENDING)]},
+    ],
+    "ai_news": [
+        {"keys": [("uploaded_at", DESCENDING)]},
+        {"keys": [("employment_type", ASCENDING), ("uploaded_at", DESCENDING)]},
+        # ricerca /api/ai-news?search=: stemming italiano, accenti ignorati
+        {
+            "keys": [("title", TEXT), ("tags", TEXT), ("description", TEXT)],
+            "name": "ai_news_text",
+            "default_language": "italian",
+            "weights": {"title": 10, "tags": 5, "description": 1},
+        },
+    ],
+    "ai_news_comments": [
+        # paginazione keyset dei commenti e delle risposte
+        {"keys": [("news_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)]},
+        {"keys": [("parent_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)]},
+    ],
+    "ai_news_likes": [
+        {"keys": [("news_id", ASCENDING), ("user_id", ASCENDING)], "unique": True},
+        # stato "mi piace" di una pagina di news per l'utente corrente
+        {"keys": [("user_id", ASCENDING), ("news_id", ASCENDING)]},
+    ],
+    "ai_news_comment_likes": [
+        {"keys": [("comment_id", ASCENDING), ("user_id", ASCENDING)], "unique": True},
+    ],
+    "ai_news_reply_likes": [
+        {"keys": [("reply_id", ASCENDING), ("user_id", ASCENDING)], "unique": True},
+    ],
+    "ai_news_views": [
+        # stesso indice creato da ai_news_migration (debounce delle view)
+        {"keys": [("user_id", ASCENDING), ("news_id", ASCENDING)], "unique": True},
+        {"keys": [("last_view", ASCENDING)], "expireAfterSeconds": 60 * 60 * 24 * 90},
+    ],
+    "documents": [
+        {"keys": [("branch", ASCENDING), ("uploaded_at", DESCENDING)]},
+    ],
+    "links": [
+        {"keys": [("branch", ASCENDING), ("created_at", DESCENDING)]},
+    ],
+    "contatti": [
+        {"keys": [("branch", ASCENDING), ("created_at", DESCENDING)]},
+    ],
+    "news": [
+        {"keys": [("branch", ASCENDING), ("created_at", DESCENDING)]},
+    ],
+    "home_highlights": [
+        {"keys": [("type", ASCENDING), ("object_id", ASCENDING)], "unique": True},
+    ],
+}
+
+# Query tipo delle rotte, usate dal report explain()
+QUERY_PROBES: List[Dict[str, Any]] = [
+    {"route": "GET /notifiche", "collection": "notifiche",
+     "filter": {"branch": {"$in": ["*", "HQE"]}, "letta_da": {"$ne": "u"}}, "sort": [("created_at", DESCENDING)]},
+    {"route": "POST /notifiche/mark-read/{tipo}", "collection": "notifiche",
+     "filter": {"tipo": "news", "branch": {"$in": ["*", "HQE"]}}},
+    {"route": "GET /ai-news", "collection": "ai_news",
+     "filter": {}, "sort": [("uploaded_at", DESCENDING)]},
+    {"route": "GET /api/ai-news/{id}/comments", "collection": "ai_news_comments",
+     "filter": {"news_id": ObjectId()}, "sort": [("created_at", ASCENDING), ("_id", ASCENDING)]},
+    {"route": "GET /api/ai-news/{id}/comments/{cid}/replies", "collection": "ai_news_comments",
+     "filter": {"news_id": ObjectId(), "parent_id": ObjectId()}, "sort": [("created_at", ASCENDING), ("_id", ASCENDING)]},
+    {"route": "POST /api/ai-news/{id}/like", "collection": "ai_news_likes",
+     "filter": {"news_id": ObjectId(), "user_id": ObjectId()}},
+    {"route": "POST /api/ai-news/{id}/view", "collection": "ai_news_views",
+     "filter": {"user_id": "u", "news_id": ObjectId()}},
+    {"route": "GET /documents", "collection": "documents",
+     "filter": {"branch": {"$in": ["*", "HQE"]}}, "sort": [("uploaded_at", DESCENDING)]},
+    {"route": "GET /contatti", "collection": "contatti",
+     "filter": {"branch": {"$in": ["*", "HQE"]}}, "sort": [("created_at", DESCENDING)]},
+    {"route": "GET /news", "collection": "news",
+     "filter": {"branch": {"$in": ["*", "HQE"]}}, "sort": [("created_at", DESCENDING)]},
+    {"route": "DELETE /documents/{id} (highlight)", "collection": "home_highlights",
+     "filter": {"type": "document", "object_id": "x"}},
+    {"route": "POST /login", "collection": "users",
+     "filter": {"email": "user@hqe.it"}},
+    {"route": "increment_unread", "collection": "notifiche_unread",
+     "filter": {"branch": "HQE", "employment_type": {"$in": ["TD"]}}},
+]
+
+_INDEX_OPTIONS = ("unique", "expireAfterSeconds", "default_language", "weights", "partialFilterExpression", "sparse")
+
+
+def index_name(spec: Dict[str, Any]) -> str:
+    """Nome esplicito o quello di default generato da MongoDB (es. email_1)."""
+    if spec.get("name"):
+        return spec["name"]
+    return "_".join(f"{field}_{direction}" for field, direction in spec["keys"])
+
+
+def _is_text(keys) -> bool:
+    return any(direction == TEXT for _, direction in keys)
+
+
+def _same_index(spec: Dict[str, Any], info: Dict[str, Any]) -> bool:
+    """True se l'indice esistente `info` soddisfa la specifica."""
+    if _is_text(spec["keys"]):
+        # MongoDB memorizza gli indici text come _fts/_ftsx: confrontiamo pesi e lingua
+        return (
+            dict(info.get("weights", {})) == spec.get("weights", {f: 1 for f, _ in spec["keys"]})
+            and info.get("default_language", "english") == spec.get("default_language", "english")
+        )
+    if [tuple(k) for k in info["key"]] != [tuple(k) for k in spec["keys"]]:
+        return False
+    return all(info.get(opt) == spec.get(opt) for opt in ("unique", "expireAfterSeconds")
+               if spec.get(opt) is not None or info.get(opt) is not None)
+
+
+def _status(collection: str, name: str, status: str, detail: str = "") -> Dict[str, str]:
+    return {"collection": collection, "index": name, "status": status, "detail": detail}
+
+
+async def reconcile_indexes(db, apply: bool = True, prune: bool = False,
+                            collections: Optional[List[str]] = None) -> List[Dict[str, str]]:
+    """
+    Allinea gli indici al registro e restituisce un report per indice:
+    ok | created | missing (apply=False) | conflict | failed | extra | dropped.
+    `prune` elimina gli indici non dichiarati e ricrea quelli in conflitto.
+    """
+    report: List[Dict[str, str]] = []
+    for coll_name, specs in INDEXES.items():
+        if collections and coll_name not in collections:
+            continue
+        coll = db[coll_name]
+        existing = await coll.index_information()
+        matched = {"_id_"}
+
+        for spec in specs:
+            name = index_name(spec)
+            is_text = _is_text(spec["keys"])
+            # Indice equivalente già presente (anche con un altro nome)?
+            same = next((n for n, info in existing.items()
+                         if (is_text == ("_fts" in dict(info["key"]))) and _same_index(spec, info)), None)
+            if same:
+                matched.add(same)
+                report.append(_status(coll_name, name, "ok", "" if same == name else f"come {same}"))
+                continue
+
+            # Stesso nome (o secondo indice text) con definizione diversa
+            clash = name if name in existing else next(
+                (n for n, info in existing.items() if is_text and "_fts" in dict(info["key"])), None)
+            if clash:
+                if not (apply and prune):
+                    matched.add(clash)
+                    report.append(_status(coll_name, name, "conflict", f"{clash} ha una definizione diversa"))
+                    continue
+                await coll.drop_index(clash)
+                existing.pop(clash)
+                report.append(_status(coll_name, clash, "dropped", "definizione diversa"))
+
+            if not apply:
+                report.append(_status(coll_name, name, "missing"))
+                continue
+            options = {opt: spec[opt] for opt in _INDEX_OPTIONS if opt in spec}
+            try:
+                await coll.create_index(spec["keys"], name=name, **options)
+                matched.add(name)
+                report.append(_status(coll_name, name, "created"))
+            except OperationFailure as e:
+                # Tipicamente duplicati che impediscono un indice unique
+                report.append(_status(coll_name, name, "failed", str(e.details.get("errmsg", e)) if e.details else str(e)))
+
+        for extra in sorted(set(existing) - matched):
+            if apply and prune:
+                await coll.drop_index(extra)
+                report.append(_status(coll_name, extra, "dropped", "non nel registro"))
+            else:
+                report.append(_status(coll_name, extra, "extra", "non nel registro"))
+    return report
+
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Stage del piano vincente, in profondità (es. ['FETCH', 'IXSCAN'])."""
+    stages = [plan.get("stage", "?")]
+    for child_key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(child_key), dict):
+            stages += _plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+
+async def explain_report(db) -> List[Dict[str, Any]]:
+    """Esegue explain() sulle QUERY_PROBES e segnala quelle che fanno COLLSCAN."""
+    report = []
+    for probe in QUERY_PROBES:
+        cursor = db[probe["collection"]].find(probe["filter"])
+        if probe.get("sort"):
+            cursor = cursor.sort(probe["sort"])
+        explained = await cursor.explain()
+        winning = explained.get("queryPlanner", {}).get("winningPlan", {})
+        stages = _plan_stages(winning)
+        report.append({
+            "route": probe["route"],
+            "collection": probe["collection"],
+            "stages": " > ".join(stages),
+            "collscan": "COLLSCAN" in stages,
+        })
+    return report
+
+
+async def ensure_indexes(db) -> None:
+    """Da chiamare all'avvio: crea gli indici mancanti e logga i problemi."""
+    started = datetime.utcnow()
+    report = await reconcile_indexes(db, apply=True, prune=False)
+    for row in report:
+        if row["status"] == "created":
+            logger.info(f"[INDEX] Creato {row['collection']}.{row['index']}")
+        elif row["status"] in ("conflict", "failed"):
+            logger.warning(f"[INDEX] {row['status']} {row['collection']}.{row['index']}: {row['detail']}")
+    elapsed = (datetime.utcnow() - started).total_seconds()
+    logger.info(f"[INDEX] Registro indici verificato in {elapsed:.2f}s")
@@ -0,0 +1,68 @@
+# app/utils/keyset.py
+
+"""
+Paginazione keyset su (created_at, _id).
+
+Invece di `.skip(n)` (che su thread lunghi legge e scarta n documenti a ogni
+pagina) si riparte dall'ultimo elemento della pagina precedente:
+
+    created_at > t  OR  (created_at == t AND _id > id)
+
+Il punto di ripartenza viaggia verso il client come token opaco
+(base64url di un piccolo JSON), da ripassare come `?cursor=`.
+"""
+
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+
+def encode_cursor(doc: dict) -> str:
+    """Token opaco che punta subito dopo `doc`."""
+    raw = json.dumps({"t": doc["created_at"].isoformat(), "id": str(doc["_id"])}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Dict[str, Any]:
+    """Decodifica un token; 400 se non è valido."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return {"created_at": datetime.fromisoformat(data["t"]), "_id": ObjectId(data["id"])}
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursore di paginazione non valido")
+
+
+def after_cursor(base_filter: Dict[str, Any], cursor: Optional[str]) -> Dict[str, Any]:
+    """Aggiunge a `base_filter` la condizione "dopo il cursore" (ordine crescente)."""
+    if not cursor:
+        return base_filter
+    pos = decode_cursor(cursor)
+    return {
+        **base_filter,
+        "$or": [
+            {"created_at": {"$gt": pos["created_at"]}},
+            {"created_at": pos["created_at"], "_id": {"$gt": pos["_id"]}},
+        ],
+    }
+
+
+async def fetch_page(collection, base_filter: Dict[str, Any], cursor: Optional[str], page_size: int):
+    """
+    Una pagina in ordine (created_at, _id) crescente.
+    Restituisce (documenti, next_cursor); next_cursor è None sull'ultima pagina.
+    Legge page_size + 1 documenti per sapere se ce ne sono altri senza contarli.
+    """
+    docs = await (
+        collection.find(after_cursor(base_filter, cursor))
+        .sort([("created_at", 1), ("_id", 1)])
+        .limit(page_size + 1)
+        .to_list(page_size + 1)
+    )
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    return docs, (encode_cursor(docs[-1]) if has_more and docs else None)
@@ -0,0 +1,214 @@
+# app/utils/log_pipeline.py
+
+"""
+Logging non bloccante con record strutturati.
+
+Il logger "intranet" scriveva direttamente su un RotatingFileHandler a
+livello DEBUG: ogni riga era una write sincrona (con lock) sul thread
+dell'event loop, e il file ruotava ogni MB decine di volte al giorno.
+
+`setup_logging` collega al logger un solo `QueueHandler`: la chiamata di
+log mette il record in coda e torna subito; un `QueueListener` in un thread
+a parte formatta e scrive su file e console. Prima di entrare in coda il
+record riceve:
+
+- `request_id`: l'id della richiesta HTTP corrente (header `X-Request-ID`
+  del proxy o generato da `RequestIdMiddleware`, restituito nella risposta);
+- il campionamento per modulo (`LOG_SAMPLING="deps=0.05,ws_broadcast=0.1"`):
+  dei record DEBUG/INFO di quei moduli ne passa solo la frazione indicata;
+  WARNING e superiori passano sempre.
+
+Con `LOG_FORMAT=json` (default per il file) ogni riga è un oggetto JSON:
+
+    {"ts": "...", "level": "DEBUG", "module": "documents", "request_id": "5f0c...",
+     "msg": "Upload documento 'Ferie' da utente 64f..."}
+
+Le chiamate di debug usano gli argomenti %-style
+(`logger.debug("... %s", valore)`): con `LOG_LEVEL` sopra DEBUG il record
+non viene nemmeno creato.
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional
+
+# --- Configurazione ---
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "intranet.log")
+LOG_FILE_FORMAT = os.getenv("LOG_FORMAT", "json")              # json | text
+LOG_CONSOLE_LEVEL = os.getenv("LOG_CONSOLE_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Coda limitata: se il thread di scrittura resta indietro i record in più
+# vengono scartati invece di far crescere la memoria
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+
+def _parse_sampling(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        module, _, rate = item.partition("=")
+        try:
+            rates[module.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+LOG_SAMPLING = _parse_sampling(os.getenv("LOG_SAMPLING", ""))
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_listener: Optional[QueueListener] = None
+_stats = {"dropped_full": 0, "sampled_out": 0}
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+# --- Filtri (eseguiti nel thread chiamante, prima della coda) ---
+
+class RequestContextFilter(logging.Filter):
+    """Aggiunge `request_id` al record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Tiene solo una frazione dei record DEBUG/INFO dei moduli in LOG_SAMPLING."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.module)
+        if rate is None or random.random() < rate:
+            return True
+        _stats["sampled_out"] += 1
+        return False
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """QueueHandler che scarta (e conta) invece di bloccare con la coda piena."""
+
+    def prepare(self, record):
+        # Il QueueHandler standard formatta messaggio e traceback qui, nel
+        # thread chiamante, e azzera exc_info: il record va in coda così com'è
+        # e la formattazione (incluso il campo "exc" del JSON) la fa il listener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats["dropped_full"] += 1
+
+
+# --- Formato ---
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "module": record.module,
+            "request_id": getattr(record, "request_id", None),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _text_formatter() -> logging.Formatter:
+    return logging.Formatter("%(asctime)s [%(levelname)s] %(module)s %(request_id)s %(message)s", datefmt="%H:%M:%S")
+
+
+# --- Setup ---
+
+def setup_logging(logger_name: str = "intranet") -> logging.Logger:
+    """Configura il logger con QueueHandler + QueueListener (idempotente)."""
+    global _listener
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    if _listener is not None:
+        return logger
+
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if LOG_FILE_FORMAT == "json" else _text_formatter())
+
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    console_handler.setLevel(LOG_CONSOLE_LEVEL)
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    if LOG_SAMPLING:
+        queue_handler.addFilter(SamplingFilter(LOG_SAMPLING))
+
+    logger.handlers = [queue_handler]
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    return logger
+
+
+def stop_logging() -> None:
+    """Svuota la coda e ferma il thread di scrittura (alla chiusura dell'app)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_stats() -> Dict[str, int]:
+    return {**_stats, "queued": _listener.queue.qsize() if _listener else 0}
+
+
+# --- Middleware ASGI ---
+
+class RequestIdMiddleware:
+    """Imposta l'id della richiesta (da `X-Request-ID` o nuovo) e lo restituisce nella risposta."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = _request_id.set(request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _request_id.reset(token)
@@ -0,0 +1,76 @@
+# app/utils/markdown_render.py
+
+"""
+Render Markdown -> HTML sanitizzato, condiviso da filtro Jinja e API.
+
+`markdown_filter` (main.py) e `markdown_preview` (ai_news.py) creavano un
+nuovo `MarkdownIt` a ogni chiamata e poi passavano l'output a
+`bleach.clean`, che a sua volta costruisce un Cleaner nuovo ogni volta. Qui
+parser e sanitizer sono creati una volta sola, e l'HTML prodotto finisce in
+una cache LRU di `MARKDOWN_CACHE_SIZE` voci con chiave l'hash del testo.
+
+Per i contenuti salvati (commenti AI news) l'HTML viene anche memorizzato
+nel documento al salvataggio:
+
+    comment["content_html"] = render_markdown(comment["content"])
+
+e i template usano `content_html` quando c'è, senza rielaborare nulla.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from bleach.sanitizer import Cleaner
+
+try:
+    from markdown_it import MarkdownIt
+except ImportError:
+    MarkdownIt = None
+
+# --- Configurazione ---
+
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "2048"))
+
+ALLOWED_TAGS = [
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul', 'p', 'pre', 'br', 'span',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6'
+]
+ALLOWED_ATTRIBUTES = {'a': ['href', 'title', 'target'], 'span': ['class']}
+
+_md = MarkdownIt("commonmark", {"breaks": True, "html": False}) if MarkdownIt else None
+_cleaner = Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, strip=True)
+
+_cache: "OrderedDict[bytes, str]" = OrderedDict()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _render(text: str) -> str:
+    if _md is None:
+        return "<em>Markdown non disponibile</em>"
+    return _cleaner.clean(_md.render(text))
+
+
+def render_markdown(text: Optional[str], cache: bool = True) -> str:
+    """HTML sanitizzato di `text`; con `cache=False` (anteprime) non tocca la LRU."""
+    text = text or ""
+    if not cache or MARKDOWN_CACHE_SIZE <= 0:
+        return _render(text)
+
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    html = _cache.get(key)
+    if html is not None:
+        _cache.move_to_end(key)
+        _stats["hits"] += 1
+        return html
+
+    _stats["misses"] += 1
+    html = _cache[key] = _render(text)
+    if len(_cache) > MARKDOWN_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return html
+
+
+def markdown_stats() -> Dict[str, int]:
+    return {**_stats, "size": len(_cache), "max_size": MARKDOWN_CACHE_SIZE}
@@ -5,6 +5,10 @@ from fastapi import Response
 from fastapi.templating import Jinja2Templates
 from typing import Dict, Any, Literal
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 # --- Tipi e Costanti Centralizzate ---
 
 # Eccezione custom per una gestione degli errori più specifica
@@ -55,11 +59,10 @@ def create_action_notification_payload(
     source_user_id: str
 ) -> Dict[str, Any]:
     """Crea un payload standardizzato per i toast WebSocket destinati agli utenti."""
-    print(f"[DEBUG] Creazione payload notifica:")
-    print(f"[DEBUG] - Action: {action}")
-    print(f"[DEBUG] - Resource: {resource}")
-    print(f"[DEBUG] - Resource name: {resource_name}")
-    print(f"[DEBUG] - Source user ID: {source_user_id}")
+    logger.debug(
+        "Creazione payload notifica: action=%s resource=%s name=%s source_user_id=%s",
+        action, resource, resource_name, source_user_id
+    )
 
     if action not in NOTIFICATION_LEVELS:
         raise InvalidActionError(f"Azione non valida fornita: {action}")
@@ -78,7 +81,7 @@ def create_action_notification_payload(
             'source_user_id': source_user_id
         }
     }
-    print(f"[DEBUG] Payload generato: {payload}")
+    logger.debug("Payload generato: %s", payload)
     return payload
 
 def create_admin_confirmation_trigger(
@@ -0,0 +1,135 @@
+# app/utils/passwords.py
+
+"""
+Hash e verifica delle password bcrypt fuori dall'event loop.
+
+`bcrypt.verify` / `bcrypt.hash` costano ~250 ms di CPU ciascuno: chiamati
+direttamente negli handler async (login, cambio password, creazione utenti)
+bloccavano tutte le altre richieste e i WebSocket del worker. Qui girano in
+un ThreadPoolExecutor dedicato (l'estensione C di bcrypt rilascia il GIL):
+
+- al più `PASSWORD_WORKERS` calcoli contemporanei;
+- al più `PASSWORD_MAX_QUEUE` richieste in attesa: oltre, `PasswordPoolBusy`
+  (la rotta risponde 503) invece di allungare la coda all'infinito;
+- tempi di attesa e di calcolo in `password_stats()`.
+
+Il costo è `BCRYPT_ROUNDS`. `verify_and_update` restituisce anche un nuovo
+hash quando quello salvato ha un costo diverso: il login aggiorna così le
+password in modo trasparente dopo un cambio di `BCRYPT_ROUNDS`.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from passlib.hash import bcrypt
+
+# --- Configurazione ---
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_MAX_QUEUE = int(os.getenv("PASSWORD_MAX_QUEUE", "64"))
+
+_hasher = bcrypt.using(rounds=BCRYPT_ROUNDS)
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+_slots: Optional[asyncio.Semaphore] = None
+_waiting = 0
+
+_stats: Dict[str, Any] = {
+    "hashes": 0, "verifies": 0, "rehashed": 0, "rejected_busy": 0,
+    "max_waiting": 0, "wait_ms": 0.0, "max_wait_ms": 0.0, "work_ms": 0.0,
+}
+
+
+class PasswordPoolBusy(Exception):
+    """Troppe operazioni sulle password in coda."""
+
+
+async def _run(fn, *args):
+    """Esegue `fn` nel pool rispettando limite di concorrenza e di coda."""
+    global _slots, _waiting
+    if _slots is None:
+        _slots = asyncio.Semaphore(PASSWORD_WORKERS)
+    if _waiting >= PASSWORD_MAX_QUEUE:
+        _stats["rejected_busy"] += 1
+        raise PasswordPoolBusy()
+
+    queued_at = time.perf_counter()
+    _waiting += 1
+    _stats["max_waiting"] = max(_stats["max_waiting"], _waiting)
+    try:
+        await _slots.acquire()
+    finally:
+        _waiting -= 1
+    try:
+        started = time.perf_counter()
+        wait_ms = (started - queued_at) * 1000
+        _stats["wait_ms"] += wait_ms
+        _stats["max_wait_ms"] = max(_stats["max_wait_ms"], wait_ms)
+        result = await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+        _stats["work_ms"] += (time.perf_counter() - started) * 1000
+        return result
+    finally:
+        _slots.release()
+
+
+def needs_rehash(pass_hash: str) -> bool:
+    """True se l'hash non usa il costo (o la variante) attuale. Non calcola bcrypt."""
+    try:
+        parsed = bcrypt.from_string(pass_hash)
+    except ValueError:
+        return False
+    return parsed.rounds != BCRYPT_ROUNDS or parsed.ident != _hasher.default_ident
+
+
+def _verify(password: str, pass_hash: str) -> bool:
+    try:
+        return bcrypt.verify(password, pass_hash)
+    except ValueError:          # hash malformato o assente
+        return False
+
+
+def _verify_and_update(password: str, pass_hash: str) -> Tuple[bool, Optional[str]]:
+    if not _verify(password, pass_hash):
+        return False, None
+    if needs_rehash(pass_hash):
+        return True, _hasher.hash(password)
+    return True, None
+
+
+async def hash_password(password: str) -> str:
+    _stats["hashes"] += 1
+    return await _run(_hasher.hash, password)
+
+
+async def verify_password(password: str, pass_hash: Optional[str]) -> bool:
+    _stats["verifies"] += 1
+    if not pass_hash:
+        return False
+    return await _run(_verify, password, pass_hash)
+
+
+async def verify_and_update(password: str, pass_hash: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """(password corretta, nuovo hash da salvare se il costo è cambiato, altrimenti None)."""
+    _stats["verifies"] += 1
+    if not pass_hash:
+        return False, None
+    ok, new_hash = await _run(_verify_and_update, password, pass_hash)
+    if new_hash:
+        _stats["rehashed"] += 1
+    return ok, new_hash
+
+
+def password_stats() -> Dict[str, Any]:
+    ops = _stats["hashes"] + _stats["verifies"] - _stats["rejected_busy"]
+    return {
+        **_stats,
+        "waiting": _waiting,
+        "workers": PASSWORD_WORKERS,
+        "max_queue": PASSWORD_MAX_QUEUE,
+        "rounds": BCRYPT_ROUNDS,
+        "avg_wait_ms": round(_stats["wait_ms"] / ops, 2) if ops else 0.0,
+        "avg_work_ms": round(_stats["work_ms"] / ops, 2) if ops else 0.0,
+    }
@@ -0,0 +1,229 @@
+# app/utils/photos.py
+
+"""
+Elaborazione delle foto profilo fuori dall'event loop.
+
+`upload_foto` apriva, convertiva e salvava l'immagine con Pillow dentro
+l'handler async: per tutta la durata della conversione il worker non serviva
+nessun altro utente. E salvava un solo JPEG a piena risoluzione, mostrato
+poi a 40-48 px nelle liste commenti e nella ricerca utenti.
+
+Qui la conversione gira in un ProcessPoolExecutor di `PHOTO_WORKERS`
+processi; al più `PHOTO_MAX_PENDING` elaborazioni possono essere in corso o
+in attesa, oltre il limite `process_photo` solleva `PhotoBusy` (503) invece
+di accodare senza fine. Per ogni foto vengono generate le varianti
+quadrate `PHOTO_SIZES` in WebP e JPEG:
+
+    media/foto/<user_id>-<versione>-<lato>.webp|jpg
+
+La versione è un hash del file caricato: ogni nuova foto ha URL nuovi, quindi
+`/media/foto` può essere servita con cache lunga e `immutable` (vedi
+`VersionedPhotoFiles`). Nei template si usa la macro `avatar` di
+`components/avatar.html`, che passa al browser tutte le varianti
+(`srcset`) con il lato mostrato (`sizes`).
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi.staticfiles import StaticFiles
+
+logger = logging.getLogger("intranet")
+
+# --- Configurazione ---
+
+FOTO_DIR = Path("media/foto")
+PHOTO_SIZES: Tuple[int, ...] = tuple(int(s) for s in os.getenv("PHOTO_SIZES", "32,64,256").split(","))
+PHOTO_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}      # estensione -> formato Pillow
+PHOTO_QUALITY = int(os.getenv("PHOTO_QUALITY", "82"))
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", "2"))
+PHOTO_MAX_PENDING = int(os.getenv("PHOTO_MAX_PENDING", "8"))
+# "spawn": niente fork di un processo con i thread di Motor già avviati
+PHOTO_MP_START = os.getenv("PHOTO_MP_START", "spawn")
+# Limite ai pixel dell'originale (decompression bomb)
+PHOTO_MAX_PIXELS = int(os.getenv("PHOTO_MAX_PIXELS", str(40_000_000)))
+PHOTO_CACHE_MAX_AGE = 365 * 24 * 3600
+
+DEFAULT_AVATAR = "/static/img/avatar-default.png"
+
+_VERSIONED_RE = re.compile(r"^[^/]+-[0-9a-f]{12}-\d+\.(webp|jpg)$")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_pending: Optional[asyncio.Semaphore] = None
+_stats = {"processed": 0, "rejected_busy": 0, "invalid": 0}
+
+
+class PhotoBusy(Exception):
+    """Troppe foto in elaborazione: riprovare più tardi."""
+
+
+class InvalidPhoto(Exception):
+    """Il file non è un'immagine leggibile."""
+
+
+# --- Lavoro nei processi del pool ---
+
+def _render_variants(data: bytes, directory: str, stem: str, sizes: Tuple[int, ...], quality: int, max_pixels: int) -> Dict[str, Any]:
+    """Eseguita in un processo del pool: decodifica, ritaglia e salva le varianti."""
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        img = Image.open(io.BytesIO(data))
+        img = ImageOps.exif_transpose(img)     # foto da smartphone ruotate
+        img = img.convert("RGB")               # PNG con trasparenza, CMYK, ...
+    except Exception as exc:                   # Pillow solleva tipi diversi per formato
+        raise InvalidPhoto(str(exc)) from None
+
+    side = min(img.size)
+    square = ImageOps.fit(img, (side, side), method=Image.LANCZOS)
+
+    written = []
+    for size in sizes:
+        variant = square if size >= side else square.resize((size, size), Image.LANCZOS)
+        for ext, fmt in PHOTO_FORMATS.items():
+            path = Path(directory) / f"{stem}-{size}.{ext}"
+            tmp_path = path.with_name(f".{path.name}.part")
+            options = {"quality": quality}
+            if fmt == "JPEG":
+                options.update(optimize=True, progressive=True)
+            else:
+                options.update(method=4)
+            variant.save(tmp_path, format=fmt, **options)
+            os.replace(tmp_path, path)
+            written.append(path.name)
+    return {"files": written, "width": img.size[0], "height": img.size[1]}
+
+
+# --- Pool ---
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor, _pending
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=PHOTO_WORKERS, mp_context=multiprocessing.get_context(PHOTO_MP_START)
+        )
+        _pending = asyncio.Semaphore(PHOTO_MAX_PENDING)
+    return _executor
+
+
+def shutdown_pool() -> None:
+    """Da chiamare alla chiusura dell'app."""
+    global _executor, _pending
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = _pending = None
+
+
+def photo_version(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=6).hexdigest()
+
+
+async def process_photo(user_id: Any, data: bytes) -> str:
+    """
+    Genera le varianti della foto di `user_id` e restituisce la nuova
+    versione. Le varianti precedenti non vengono toccate: le rimuove il
+    chiamante con `remove_version`, dopo aver salvato la nuova versione nel
+    documento utente e solo per la versione che il documento aveva prima.
+    Due upload concorrenti dello stesso utente non si cancellano così a
+    vicenda i file appena scritti (nemmeno da worker diversi).
+    """
+    pool = _pool()
+    if _pending.locked():
+        _stats["rejected_busy"] += 1
+        raise PhotoBusy()
+
+    version = photo_version(data)
+    FOTO_DIR.mkdir(parents=True, exist_ok=True)
+    async with _pending:
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                pool, _render_variants, data, str(FOTO_DIR), f"{user_id}-{version}",
+                PHOTO_SIZES, PHOTO_QUALITY, PHOTO_MAX_PIXELS
+            )
+        except InvalidPhoto:
+            _stats["invalid"] += 1
+            raise
+
+    _stats["processed"] += 1
+    logger.info("[FOTO] %s: versione %s, %d varianti", user_id, version, len(result["files"]))
+    return version
+
+
+def remove_version(user_id: Any, version: Optional[str]) -> int:
+    """Elimina le varianti di una versione; con `version=None` il vecchio `<user_id>.jpg`."""
+    if not version:
+        legacy = FOTO_DIR / f"{user_id}.jpg"
+        if legacy.exists():
+            legacy.unlink(missing_ok=True)
+            return 1
+        return 0
+    removed = 0
+    for path in FOTO_DIR.glob(f"{user_id}-{version}-*"):
+        path.unlink(missing_ok=True)
+        removed += 1
+    return removed
+
+
+def remove_photos(user_id: Any, keep: Optional[str] = None) -> int:
+    """Elimina le varianti (e il vecchio `<user_id>.jpg`) dell'utente, tranne la versione `keep`."""
+    removed = 0
+    for path in FOTO_DIR.glob(f"{user_id}*"):
+        if keep and path.name.startswith(f"{user_id}-{keep}-"):
+            continue
+        if path.name == f"{user_id}.jpg" or path.name.startswith(f"{user_id}-"):
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+# --- URL ---
+
+def _best_size(size: int) -> int:
+    """La variante più piccola che copre `size` px."""
+    for candidate in sorted(PHOTO_SIZES):
+        if candidate >= size:
+            return candidate
+    return max(PHOTO_SIZES)
+
+
+def photo_url(user: Optional[Dict[str, Any]], size: int = 64, ext: str = "jpg") -> str:
+    """URL della variante per un lato mostrato di `size` px, o l'avatar predefinito."""
+    if not user or not user.get("_id"):
+        return DEFAULT_AVATAR
+    version = user.get("photo_version")
+    if version:
+        return f"/media/foto/{user['_id']}-{version}-{_best_size(size)}.{ext}"
+    # Foto caricate prima delle varianti (JPEG unico, se esiste)
+    return user.get("avatar") or f"/media/foto/{user['_id']}.jpg"
+
+
+def photo_srcset(user: Dict[str, Any], ext: str = "jpg") -> str:
+    """`srcset` con tutte le varianti: il browser sceglie in base a `sizes` e densità dello schermo."""
+    base = f"/media/foto/{user['_id']}-{user['photo_version']}"
+    return ", ".join(f"{base}-{size}.{ext} {size}w" for size in sorted(PHOTO_SIZES))
+
+
+def photo_stats() -> Dict[str, Any]:
+    return {**_stats, "workers": PHOTO_WORKERS, "max_pending": PHOTO_MAX_PENDING, "sizes": list(PHOTO_SIZES)}
+
+
+# --- File statici ---
+
+class VersionedPhotoFiles(StaticFiles):
+    """`/media/foto`: cache lunga e immutable per i file con versione nel nome."""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304) and _VERSIONED_RE.match(Path(path).name):
+            response.headers["Cache-Control"] = f"private, max-age={PHOTO_CACHE_MAX_AGE}, immutable"
+        return response
@@ -0,0 +1,227 @@
+# app/utils/query_profiler.py
+
+"""
+Profilazione delle query MongoDB per rotta.
+
+- `CommandProfiler` è un listener di command monitoring di PyMongo
+  (registrato sul client Motor): per ogni comando completato somma la
+  durata al profilo della richiesta corrente.
+- `instrument_templates` misura il tempo di render Jinja delle
+  TemplateResponse.
+- `QueryProfilerMiddleware` (ASGI) apre un profilo per ogni richiesta HTTP,
+  aggiunge l'header `Server-Timing` (visibile nei DevTools del browser) e
+  aggrega per rotta numero di comandi, tempo DB, comando più lento, tempo di
+  render e istogrammi dei tempi.
+
+Il profilo viaggia in una ContextVar: Motor esegue PyMongo in un thread pool
+copiando il contesto, quindi i callback del listener vedono il profilo della
+richiesta che ha lanciato la query.
+
+Le statistiche aggregate si leggono da GET /admin/metrics/queries.
+"""
+
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from pymongo import monitoring
+
+# --- Configurazione ---
+
+QUERY_PROFILING = os.getenv("QUERY_PROFILING", "1") == "1"
+# Limite alle rotte distinte tracciate (le richieste senza rotta finiscono in "<altro>")
+QUERY_PROFILING_MAX_ROUTES = int(os.getenv("QUERY_PROFILING_MAX_ROUTES", "500"))
+
+# Estremi superiori (ms) dei bucket degli istogrammi
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+
+class RequestProfile:
+    """Tempi DB e render di una singola richiesta."""
+
+    __slots__ = ("commands", "db_ms", "slowest_ms", "slowest_command", "render_ms", "_lock")
+
+    def __init__(self):
+        self.commands = 0
+        self.db_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_command: Optional[str] = None
+        self.render_ms = 0.0
+        self._lock = threading.Lock()
+
+    def add_command(self, name: str, collection: Optional[str], duration_ms: float) -> None:
+        with self._lock:
+            self.commands += 1
+            self.db_ms += duration_ms
+            if duration_ms > self.slowest_ms:
+                self.slowest_ms = duration_ms
+                self.slowest_command = f"{name} {collection}" if collection else name
+
+
+_current: ContextVar[Optional[RequestProfile]] = ContextVar("query_profile", default=None)
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current.get()
+
+
+# --- Listener PyMongo ---
+
+class CommandProfiler(monitoring.CommandListener):
+    """Attribuisce la durata di ogni comando Mongo alla richiesta corrente."""
+
+    def __init__(self):
+        # request_id -> collection: l'evento di completamento non la riporta,
+        # serve per indicare il comando più lento come "find users"
+        self._collections: Dict[int, str] = {}
+
+    def started(self, event):
+        if _current.get() is None:
+            return
+        target = event.command.get(event.command_name)
+        if isinstance(target, str):
+            self._collections[event.request_id] = target
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event) -> None:
+        collection = self._collections.pop(event.request_id, None)
+        profile = _current.get()
+        if profile is not None:
+            profile.add_command(event.command_name, collection, event.duration_micros / 1000)
+
+
+def event_listeners() -> List[monitoring.CommandListener]:
+    """Listener da passare ad AsyncIOMotorClient(event_listeners=...)."""
+    return [CommandProfiler()] if QUERY_PROFILING else []
+
+
+# --- Template ---
+
+def instrument_templates(templates) -> None:
+    """Misura il render Jinja di `templates.TemplateResponse` (render eseguito nel costruttore)."""
+    if not QUERY_PROFILING:
+        return
+    original = templates.TemplateResponse
+
+    def timed_template_response(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            profile = _current.get()
+            if profile is not None:
+                profile.render_ms += (time.perf_counter() - start) * 1000
+
+    templates.TemplateResponse = timed_template_response
+
+
+# --- Aggregati per rotta ---
+
+def _empty_histogram() -> List[int]:
+    return [0] * len(HISTOGRAM_BUCKETS_MS)
+
+
+def _observe(histogram: List[int], value_ms: float) -> None:
+    for i, upper in enumerate(HISTOGRAM_BUCKETS_MS):
+        if value_ms <= upper:
+            histogram[i] += 1
+            return
+
+
+_routes: Dict[str, Dict[str, Any]] = {}
+
+
+def _record_request(route: str, profile: RequestProfile, total_ms: float) -> None:
+    if route not in _routes and len(_routes) >= QUERY_PROFILING_MAX_ROUTES:
+        route = "<altro>"
+    stats = _routes.get(route)
+    if stats is None:
+        stats = _routes[route] = {
+            "requests": 0, "commands": 0, "max_commands": 0,
+            "db_ms": 0.0, "render_ms": 0.0, "total_ms": 0.0,
+            "slowest_ms": 0.0, "slowest_command": None,
+            "db_hist": _empty_histogram(), "total_hist": _empty_histogram(),
+        }
+    stats["requests"] += 1
+    stats["commands"] += profile.commands
+    stats["max_commands"] = max(stats["max_commands"], profile.commands)
+    stats["db_ms"] += profile.db_ms
+    stats["render_ms"] += profile.render_ms
+    stats["total_ms"] += total_ms
+    if profile.slowest_ms > stats["slowest_ms"]:
+        stats["slowest_ms"] = profile.slowest_ms
+        stats["slowest_command"] = profile.slowest_command
+    _observe(stats["db_hist"], profile.db_ms)
+    _observe(stats["total_hist"], total_ms)
+
+
+def query_stats(reset: bool = False) -> Dict[str, Any]:
+    """Aggregati per rotta, ordinati per tempo DB totale."""
+    buckets = ["inf" if b == float("inf") else b for b in HISTOGRAM_BUCKETS_MS]
+    routes = []
+    for route, s in _routes.items():
+        n = s["requests"] or 1
+        routes.append({
+            "route": route,
+            "requests": s["requests"],
+            "avg_commands": round(s["commands"] / n, 2),
+            "max_commands": s["max_commands"],
+            "avg_db_ms": round(s["db_ms"] / n, 2),
+            "avg_render_ms": round(s["render_ms"] / n, 2),
+            "avg_total_ms": round(s["total_ms"] / n, 2),
+            "total_db_ms": round(s["db_ms"], 1),
+            "slowest_command": s["slowest_command"],
+            "slowest_command_ms": round(s["slowest_ms"], 2),
+            "db_histogram_ms": dict(zip(map(str, buckets), s["db_hist"])),
+            "total_histogram_ms": dict(zip(map(str, buckets), s["total_hist"])),
+        })
+    routes.sort(key=lambda r: r["total_db_ms"], reverse=True)
+    if reset:
+        _routes.clear()
+    return {"enabled": QUERY_PROFILING, "routes": routes}
+
+
+# --- Middleware ASGI ---
+
+class QueryProfilerMiddleware:
+    """Apre un RequestProfile per richiesta, aggiunge Server-Timing e aggrega per rotta."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not QUERY_PROFILING:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile()
+        token = _current.set(profile)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                total_ms = (time.perf_counter() - start) * 1000
+                timing = (
+                    f'db;dur={profile.db_ms:.1f};desc="{profile.commands} cmd", '
+                    f"render;dur={profile.render_ms:.1f}, "
+                    f"app;dur={total_ms:.1f}"
+                )
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            # Il router valorizza scope["route"]: aggreghiamo sul path template
+            route = getattr(scope.get("route"), "path", None) or "<altro>"
+            _record_request(f"{scope['method']} {route}", profile, (time.perf_counter() - start) * 1000)
@@ -3,10 +3,14 @@
 # nei controller delle risorse (es. links.py, documents.py) utilizzando
 # gli helper in notification_helpers.py.
 
+import logging
+
+logger = logging.getLogger("intranet")
+
 async def save_and_notify(*args, **kwargs):
     """
     Questa funzione è un guscio vuoto per mantenere la compatibilità
     durante il refactoring. Verrà rimossa a breve.
     """
-    print("[DEPRECATED] La funzione save_and_notify è stata chiamata ma è obsoleta. Ignorata.")
+    logger.warning("[DEPRECATED] La funzione save_and_notify è stata chiamata ma è obsoleta. Ignorata.")
     pass
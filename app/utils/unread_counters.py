@@ -0,0 +1,160 @@
+# app/utils/unread_counters.py
+
+"""
+Contatori per-utente delle notifiche non lette.
+
+I badge della navbar contavano le notifiche con
+`letta_da: {$ne: user_id}`: un match negativo su un array che cresce, che
+nessun indice serve bene. Qui manteniamo invece un documento per utente
+nella collection `notifiche_unread`:
+
+    {
+        "_id": "<user_id>",
+        "branch": "HQE",
+        "employment_type": "TD",
+        "counts": {"link": 2, "news": 0, "commento": 1, ...}
+    }
+
+Il documento è aggiornato da `crea_notifica` (+1 a tutti gli utenti che
+vedono la notifica), da `segna_letta` (-1) e dalle rotte che segnano come
+lette tutte le notifiche di un tipo (azzeramento). Il conteggio di un badge
+diventa quindi un `find_one` per chiave primaria.
+
+Se il documento manca, o se branch/employment_type dell'utente sono cambiati,
+viene ricostruito con un'unica aggregazione sulla collection `notifiche`.
+
+Ogni modifica incrementa i contatori di `change_counters` (globale per gli
+incrementi a più utenti, per utente per letture e azzeramenti), da cui
+dipende l'ETag di `/notifiche/badges`.
+"""
+
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from app.utils import change_counters
+
+COLLECTION = "notifiche_unread"
+
+
+def _employment_type_list(employment_type: Any) -> List[str]:
+    """Normalizza employment_type (None, stringa o lista) in una lista."""
+    if not employment_type:
+        return []
+    if isinstance(employment_type, str):
+        return [employment_type]
+    return list(employment_type)
+
+
+def audience_filter(branch: Optional[str], employment_type: Any) -> Dict[str, Any]:
+    """
+    Filtro sui documenti contatore che individua gli utenti destinatari di
+    una notifica con i `branch`/`employment_type` indicati.
+    Stesse regole di visibilità delle query storiche sui badge.
+    """
+    filtro: Dict[str, Any] = {}
+    if branch and branch != "*":
+        filtro["branch"] = branch
+    emp_types = _employment_type_list(employment_type)
+    if emp_types and "*" not in emp_types:
+        filtro["employment_type"] = {"$in": emp_types}
+    return filtro
+
+
+def visibility_filter(user: dict) -> Dict[str, Any]:
+    """Filtro sulla collection `notifiche` delle notifiche visibili all'utente."""
+    conds = [
+        {"employment_type": {"$exists": False}},
+        {"employment_type": []},
+        {"employment_type": {"$in": ["*"]}}
+    ]
+    if user.get("employment_type"):
+        conds.append({"employment_type": {"$in": [user["employment_type"]]}})
+    return {
+        "branch": {"$in": ["*", user.get("branch")]},
+        "$or": conds,
+    }
+
+
+async def rebuild_unread_counts(db, user: dict) -> Dict[str, int]:
+    """Ricalcola da zero i contatori di un utente (una sola aggregazione)."""
+    user_id = str(user["_id"])
+    pipeline = [
+        {"$match": {**visibility_filter(user), "letta_da": {"$ne": user_id}}},
+        {"$group": {"_id": "$tipo", "n": {"$sum": 1}}},
+    ]
+    counts = {row["_id"]: row["n"] async for row in db.notifiche.aggregate(pipeline) if row["_id"]}
+    await db[COLLECTION].replace_one(
+        {"_id": user_id},
+        {
+            "_id": user_id,
+            "branch": user.get("branch"),
+            "employment_type": user.get("employment_type"),
+            "counts": counts,
+            "rebuilt_at": datetime.utcnow(),
+        },
+        upsert=True
+    )
+    return counts
+
+
+async def load_unread_counts(db, user: dict) -> Dict[str, int]:
+    """Restituisce i contatori {tipo: non_lette} dell'utente in O(1)."""
+    state = await db[COLLECTION].find_one({"_id": str(user["_id"])})
+    if (
+        not state
+        or state.get("branch") != user.get("branch")
+        or state.get("employment_type") != user.get("employment_type")
+    ):
+        return await rebuild_unread_counts(db, user)
+    return {tipo: max(0, n) for tipo, n in state.get("counts", {}).items()}
+
+
+def sum_counts(counts: Dict[str, int], tipi: Iterable[str]) -> int:
+    """Somma i contatori di più tipi (es. commento + risposta + menzione)."""
+    return sum(counts.get(tipo, 0) for tipo in tipi)
+
+
+async def increment_unread(db, tipo: str, branch: Optional[str], employment_type: Any) -> None:
+    """+1 sul contatore `tipo` di tutti gli utenti che vedono la notifica."""
+    await db[COLLECTION].update_many(
+        audience_filter(branch, employment_type),
+        {"$inc": {f"counts.{tipo}": 1}}
+    )
+    await change_counters.collection_changed(COLLECTION)
+
+
+async def decrement_unread(db, user_id: Any, tipo: str) -> None:
+    """-1 sul contatore `tipo` di un utente (mai sotto zero)."""
+    await db[COLLECTION].update_one(
+        {"_id": str(user_id), f"counts.{tipo}": {"$gt": 0}},
+        {"$inc": {f"counts.{tipo}": -1}}
+    )
+    await change_counters.collection_changed(COLLECTION, user_id)
+
+
+async def reset_unread(db, user_id: Any, tipo: str) -> None:
+    """Azzera il contatore `tipo` dopo un "segna tutte come lette"."""
+    await db[COLLECTION].update_one(
+        {"_id": str(user_id)},
+        {"$set": {f"counts.{tipo}": 0}}
+    )
+    await change_counters.collection_changed(COLLECTION, user_id)
+
+
+async def discount_deleted(db, notifiche: Iterable[dict]) -> None:
+    """
+    Da chiamare prima di eliminare delle notifiche: toglie ciascuna dal
+    contatore degli utenti che la vedevano e non l'avevano ancora letta.
+    """
+    for n in notifiche:
+        filtro = audience_filter(n.get("branch"), n.get("employment_type"))
+        filtro["_id"] = {"$nin": [str(uid) for uid in n.get("letta_da", [])]}
+        filtro[f"counts.{n['tipo']}"] = {"$gt": 0}
+        await db[COLLECTION].update_many(filtro, {"$inc": {f"counts.{n['tipo']}": -1}})
+    await change_counters.collection_changed(COLLECTION)
+
+
+async def drop_unread_state(db, user_id: Any) -> None:
+    """Elimina i contatori di un utente (es. utente cancellato)."""
+    await db[COLLECTION].delete_one({"_id": str(user_id)})
+    await change_counters.collection_changed(COLLECTION, user_id)
@@ -0,0 +1,93 @@
+# app/utils/uploads.py
+
+"""
+Lettura in streaming dei file caricati.
+
+Le rotte di upload leggevano l'intero file con `await file.read()` prima di
+scriverlo: con qualche PDF da centinaia di MB in parallelo il worker
+esauriva la memoria. `stream_to_temp` copia invece l'`UploadFile` a blocchi
+di `UPLOAD_CHUNK_SIZE` byte in un file temporaneo:
+
+- calcola lo SHA-256 durante la copia;
+- interrompe la copia appena si supera `max_bytes` (`UploadTooLarge`) e
+  rimuove il temporaneo.
+
+È il punto d'ingresso usato da `app.utils.blob_store.put_upload`, che poi
+sposta il temporaneo nel percorso del blob con `os.replace` (atomico sullo
+stesso filesystem: chi legge il file non vede mai una scrittura a metà).
+La memoria usata per upload resta quella di un blocco.
+
+Qui stanno anche `safe_filename` (nome da mostrare al download) e
+`StoredUpload`, l'esito restituito dal blob store.
+"""
+
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import aiofiles
+from fastapi import UploadFile
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))  # 1 MB
+
+
+class UploadTooLarge(Exception):
+    """Il file supera la dimensione massima consentita."""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(f"File oltre il limite di {max_bytes} byte")
+        self.max_bytes = max_bytes
+
+
+class StoredUpload:
+    """Esito di un upload salvato: percorso finale, dimensione e SHA-256."""
+
+    __slots__ = ("path", "size", "sha256")
+
+    def __init__(self, path: Path, size: int, sha256: str):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+
+def safe_filename(filename: Optional[str]) -> str:
+    """Solo il nome (niente percorsi) con i caratteri non sicuri sostituiti da `_`."""
+    name = Path((filename or "").replace("\\", "/")).name
+    name = re.sub(r"[^\w\.-]", "_", name).lstrip(".")
+    return name or "file"
+
+
+async def stream_to_temp(file: UploadFile, directory: Path, max_bytes: Optional[int] = None):
+    """
+    Copia `file` in un temporaneo dentro `directory`.
+    Restituisce (percorso_temporaneo, dimensione, sha256); con `max_bytes`
+    solleva `UploadTooLarge` appena il limite viene superato.
+    """
+    # Dimensione dichiarata dal parser multipart: rifiuto senza copiare nulla
+    declared = getattr(file, "size", None)
+    if max_bytes is not None and declared is not None and declared > max_bytes:
+        raise UploadTooLarge(max_bytes)
+
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = directory / f".upload-{uuid.uuid4().hex}.part"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                hasher.update(chunk)
+                await out.write(chunk)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, size, hasher.hexdigest()
+
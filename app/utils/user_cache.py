@@ -0,0 +1,120 @@
+# app/utils/user_cache.py
+
+"""
+Cache process-local degli utenti autenticati.
+
+`get_current_user` viene risolto da ogni rotta e da ogni partial HTMX: una
+singola pagina può generare 5-10 `find_one` identici sulla collection users.
+Qui teniamo in memoria il documento utente per `USER_CACHE_TTL` secondi,
+indicizzato per `user_id` di sessione, e lo invalidiamo esplicitamente
+quando il documento cambia (modifica profilo, password, pin, foto, delete).
+
+L'invalidazione viaggia sul canale `publish_invalidation` (collection
+"users"), quindi raggiunge tutti i worker: dopo un cambio di ruolo, password
+o una cancellazione nessun processo continua ad autenticare il documento
+vecchio fino alla scadenza del TTL.
+"""
+
+import copy
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from bson import ObjectId
+
+from app.ws_broadcast import on_invalidate, publish_invalidation
+
+# --- Configurazione ---
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))          # secondi
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000"))
+
+# user_id (str) -> (scadenza monotonic, documento utente)
+_cache: Dict[str, Tuple[float, dict]] = {}
+
+# Generazione per utente: se un'invalidazione arriva mentre un look-up è in
+# corso, il risultato (ormai vecchio) non viene salvato in cache.
+_generations: Dict[str, int] = {}
+
+_stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+
+def _evict_if_full(now: float) -> None:
+    """Rimuove le entry scadute e, se non basta, le più vecchie."""
+    if len(_cache) < USER_CACHE_MAX_ENTRIES:
+        return
+    for uid in [uid for uid, (expires, _) in _cache.items() if expires <= now]:
+        del _cache[uid]
+        _stats["evictions"] += 1
+    while len(_cache) >= USER_CACHE_MAX_ENTRIES:
+        # I dict mantengono l'ordine di inserimento: il primo è il più vecchio
+        del _cache[next(iter(_cache))]
+        _stats["evictions"] += 1
+
+
+async def get_user(db, user_id: str) -> Optional[dict]:
+    """
+    Restituisce una copia del documento utente, dalla cache se ancora valida,
+    altrimenti da MongoDB. Restituisce None se l'utente non esiste.
+    """
+    now = time.monotonic()
+    entry = _cache.get(user_id)
+    if entry and entry[0] > now:
+        _stats["hits"] += 1
+        # Copia profonda: le rotte modificano il dict (es. pinned_items)
+        return copy.deepcopy(entry[1])
+
+    _stats["misses"] += 1
+    generation = _generations.get(user_id, 0)
+    user = await db.users.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        _cache.pop(user_id, None)
+        return None
+
+    if _generations.get(user_id, 0) == generation:
+        _evict_if_full(now)
+        _cache[user_id] = (now + USER_CACHE_TTL, user)
+    return copy.deepcopy(user)
+
+
+def _drop(uid: str) -> None:
+    _generations[uid] = _generations.get(uid, 0) + 1
+    if _cache.pop(uid, None) is not None:
+        _stats["invalidations"] += 1
+
+
+@on_invalidate
+def _on_invalidate(data: Dict[str, Any]) -> None:
+    if data.get("collection") != "users":
+        return
+    if data.get("key"):
+        _drop(data["key"])
+    else:
+        for uid in list(_cache):
+            _drop(uid)
+
+
+async def invalidate_user(user_id: Any) -> None:
+    """Invalida la entry di un utente in tutti i worker (accetta ObjectId o stringa)."""
+    uid = str(user_id)
+    # Subito nel worker corrente, poi negli altri tramite pub/sub
+    _drop(uid)
+    await publish_invalidation("users", uid)
+
+
+async def clear() -> None:
+    """Svuota completamente la cache in tutti i worker (es. dopo un import massivo)."""
+    for uid in list(_cache):
+        _drop(uid)
+    await publish_invalidation("users")
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Contatori hit/miss per monitorare il carico sulla collection users."""
+    lookups = _stats["hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "size": len(_cache),
+        "ttl_seconds": USER_CACHE_TTL,
+        "hit_ratio": round(_stats["hits"] / lookups, 4) if lookups else 0.0,
+    }
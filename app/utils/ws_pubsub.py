@@ -0,0 +1,172 @@
+# app/utils/ws_pubsub.py
+
+"""
+Backend pub/sub per il fan-out degli eventi WebSocket.
+
+Le connessioni WebSocket vivono nella memoria del worker uvicorn che le ha
+accettate: un evento prodotto in un worker, consegnato solo localmente, non
+raggiunge i client collegati agli altri. `broadcast_message` quindi non
+consegna direttamente ma pubblica una "busta" sul backend configurato, che
+la fa arrivare a `deliver_local` di ogni worker:
+
+    {
+        "message": "<payload già serializzato>",
+        "type": "comment/add",
+        "coalesce_key": None,
+        "branch": "HQE", "employment_type": ["TD"],
+        "exclude_user_id": "...", "target_user_id": None
+    }
+
+Backend disponibili (`WS_PUBSUB_BACKEND`):
+
+- memory: consegna solo nel processo corrente (un solo worker, default);
+- mongo:  ogni worker scrive l'evento in una capped collection e la legge
+          con un cursore tailable. Nessun broker esterno e nessun replica
+          set richiesto (a differenza dei change stream).
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger("intranet")
+
+# --- Configurazione ---
+
+WS_PUBSUB_BACKEND = os.getenv("WS_PUBSUB_BACKEND", "memory")             # memory | mongo
+WS_EVENTS_COLLECTION = os.getenv("WS_EVENTS_COLLECTION", "ws_events")
+WS_EVENTS_CAP_BYTES = int(os.getenv("WS_EVENTS_CAP_BYTES", str(16 * 1024 * 1024)))
+
+Deliver = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class InProcessBackend:
+    """Consegna immediata nel solo processo corrente."""
+
+    name = "memory"
+
+    def __init__(self, deliver: Deliver):
+        self._deliver = deliver
+        self.stats = {"published": 0, "received": 0}
+
+    async def start(self, db=None) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, envelope: Dict[str, Any]) -> None:
+        self.stats["published"] += 1
+        await self._deliver(envelope)
+
+
+class MongoCappedBackend:
+    """
+    Fan-out tra worker tramite una capped collection MongoDB.
+
+    `publish` consegna subito ai client locali e inserisce l'evento nella
+    collection; un task per worker la segue con un cursore TAILABLE_AWAIT e
+    consegna gli eventi pubblicati dagli altri worker.
+    """
+
+    name = "mongo"
+
+    # Id degli ultimi eventi già consegnati, per non duplicarli quando il
+    # cursore viene riaperto a partire da `ts`.
+    _SEEN_MAX = 1000
+
+    def __init__(self, deliver: Deliver):
+        self._deliver = deliver
+        self.worker_id = uuid.uuid4().hex
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self._seen: Deque[Any] = deque()
+        self._seen_set: Set[Any] = set()
+        self.stats = {"published": 0, "received": 0, "publish_errors": 0, "tail_restarts": 0}
+
+    async def start(self, db=None) -> None:
+        self._db = db
+        try:
+            await db.create_collection(WS_EVENTS_COLLECTION, capped=True, size=WS_EVENTS_CAP_BYTES)
+        except CollectionInvalid:
+            pass  # già creata da un altro worker
+        self._task = asyncio.create_task(self._tail())
+        logger.info(f"[WS] Pub/sub mongo avviato (worker {self.worker_id[:8]})")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def publish(self, envelope: Dict[str, Any]) -> None:
+        self.stats["published"] += 1
+        await self._deliver(envelope)
+        try:
+            await self._db[WS_EVENTS_COLLECTION].insert_one({
+                "origin": self.worker_id,
+                "ts": datetime.utcnow(),
+                "envelope": envelope,
+            })
+        except Exception as e:
+            # Gli altri worker perdono l'evento, i client locali l'hanno già ricevuto
+            self.stats["publish_errors"] += 1
+            logger.error(f"[WS] Errore pubblicazione evento su {WS_EVENTS_COLLECTION}: {e}")
+
+    def _mark_seen(self, event_id: Any) -> bool:
+        """True se l'evento è nuovo."""
+        if event_id in self._seen_set:
+            return False
+        self._seen.append(event_id)
+        self._seen_set.add(event_id)
+        if len(self._seen) > self._SEEN_MAX:
+            self._seen_set.discard(self._seen.popleft())
+        return True
+
+    async def _tail(self) -> None:
+        coll = self._db[WS_EVENTS_COLLECTION]
+        # Si parte da "adesso": gli eventi già in collection sono storia
+        last_ts = datetime.utcnow()
+        while True:
+            cursor = coll.find({"ts": {"$gte": last_ts}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                async for doc in cursor:
+                    last_ts = doc["ts"]
+                    if not self._mark_seen(doc["_id"]) or doc.get("origin") == self.worker_id:
+                        continue
+                    self.stats["received"] += 1
+                    try:
+                        await self._deliver(doc["envelope"])
+                    except Exception as e:
+                        logger.error(f"[WS] Errore consegna evento {doc['_id']}: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[WS] Cursore su {WS_EVENTS_COLLECTION} interrotto: {e}")
+            # Un cursore tailable muore se la collection è vuota o dopo un errore
+            self.stats["tail_restarts"] += 1
+            await asyncio.sleep(1)
+
+
+_BACKENDS = {
+    InProcessBackend.name: InProcessBackend,
+    MongoCappedBackend.name: MongoCappedBackend,
+}
+
+
+def create_backend(deliver: Deliver, name: str = WS_PUBSUB_BACKEND):
+    """Istanzia il backend `name` (default da `WS_PUBSUB_BACKEND`)."""
+    try:
+        return _BACKENDS[name](deliver)
+    except KeyError:
+        raise ValueError(f"WS_PUBSUB_BACKEND sconosciuto: {name!r} (validi: {', '.join(_BACKENDS)})")
@@ -1,16 +1,252 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import List, Dict, Optional
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import asyncio
 import json
 import logging
+import os
 import base64
 from datetime import datetime
-from bson import ObjectId
 from itsdangerous import URLSafeSerializer, TimestampSigner, BadSignature
+from app.utils import ws_pubsub
 
 logger = logging.getLogger("intranet")
 
-# Lista globale delle connessioni attive
-active_ws_connections: List[WebSocket] = []
+# --- Configurazione code di invio ---
+
+# Messaggi in attesa per connessione prima di applicare la policy
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "100"))
+# Tempo massimo (secondi) per una singola send prima di considerare il client lento
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+# Cosa fare quando la coda di un client è piena:
+#   drop_oldest -> scarta il messaggio più vecchio in coda
+#   coalesce    -> sostituisce un messaggio in coda con la stessa chiave
+#                  (stesso tipo ed elemento), altrimenti scarta il più vecchio
+#   disconnect  -> chiude la connessione (il client si riconnette e ricarica)
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+
+_ws_stats = {
+    "enqueued": 0,
+    "sent": 0,
+    "dropped": 0,
+    "coalesced": 0,
+    "slow_disconnects": 0,
+    "send_errors": 0,
+}
+
+
+class ConnectionSender:
+    """
+    Coda di uscita limitata di una singola WebSocket, svuotata da un task
+    dedicato. `broadcast_message` si limita ad accodare: un client lento
+    rallenta solo sé stesso, non gli altri né la richiesta HTTP che ha
+    generato l'evento.
+    """
+
+    def __init__(self, websocket: WebSocket, on_close=None):
+        self.websocket = websocket
+        self._on_close = on_close
+        self._queue: Deque[Tuple[Optional[str], str]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def enqueue(self, message: str, coalesce_key: Optional[str] = None) -> bool:
+        """Accoda un messaggio; restituisce False se è stato scartato."""
+        if self.closed:
+            return False
+
+        if coalesce_key and WS_SLOW_CONSUMER_POLICY == "coalesce":
+            for i, (key, _) in enumerate(self._queue):
+                if key == coalesce_key:
+                    # Ancora in coda: basta inviare la versione più recente
+                    self._queue[i] = (coalesce_key, message)
+                    _ws_stats["coalesced"] += 1
+                    return True
+
+        if len(self._queue) >= WS_SEND_QUEUE_MAX:
+            if WS_SLOW_CONSUMER_POLICY == "disconnect":
+                logger.warning(f"[WS] Client lento ({self._email()}), coda piena: disconnessione")
+                _ws_stats["slow_disconnects"] += 1
+                self._close_slow()
+                return False
+            self._queue.popleft()
+            _ws_stats["dropped"] += 1
+
+        self._queue.append((coalesce_key, message))
+        _ws_stats["enqueued"] += 1
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._writer())
+        return True
+
+    async def _writer(self) -> None:
+        while not self.closed:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, message = self._queue.popleft()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(message), timeout=WS_SEND_TIMEOUT)
+                _ws_stats["sent"] += 1
+            except asyncio.TimeoutError:
+                logger.warning(f"[WS] Invio a {self._email()} oltre {WS_SEND_TIMEOUT}s: disconnessione")
+                _ws_stats["slow_disconnects"] += 1
+                self._close_slow()
+            except Exception as e:
+                logger.error(f"[WS] Errore durante l'invio a {self._email()}: {e}")
+                _ws_stats["send_errors"] += 1
+                self.close()
+
+    def _email(self) -> Optional[str]:
+        return self.websocket.state.user.get("email")
+
+    def _close_slow(self) -> None:
+        self.close()
+        # 1013 = "Try Again Later": il client si riconnette da solo
+        asyncio.ensure_future(self._safe_close(code=1013))
+
+    async def _safe_close(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        """Ferma il writer e scarta i messaggi in coda (idempotente)."""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        if self._on_close is not None:
+            self._on_close(self.websocket)
+
+# --- Registro delle Connessioni Attive ---
+
+class ConnectionRegistry:
+    """
+    Connessioni WebSocket attive, indicizzate per user id, branch e
+    employment_type. Un invio mirato a un utente è un look-up O(1); un
+    broadcast filtrato tocca solo i bucket che corrispondono ai filtri.
+
+    Le WebSocket di Starlette non sono hashabili (sono Mapping), quindi gli
+    indici contengono `id(websocket)`.
+    """
+
+    def __init__(self):
+        self._connections: Dict[int, WebSocket] = {}
+        self._by_user: Dict[str, Set[int]] = {}
+        self._by_branch: Dict[Optional[str], Set[int]] = {}
+        self._by_employment_type: Dict[Optional[str], Set[int]] = {}
+        self._admins: Set[int] = set()
+        self._senders: Dict[int, ConnectionSender] = {}
+
+    @staticmethod
+    def _index_add(index: Dict, key, conn_id: int) -> None:
+        index.setdefault(key, set()).add(conn_id)
+
+    @staticmethod
+    def _index_discard(index: Dict, key, conn_id: int) -> None:
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.discard(conn_id)
+            if not bucket:
+                del index[key]
+
+    def add(self, websocket: WebSocket) -> None:
+        """Registra una connessione; `websocket.state.user` deve essere già valorizzato."""
+        user_info = websocket.state.user
+        conn_id = id(websocket)
+        self._connections[conn_id] = websocket
+        self._senders[conn_id] = ConnectionSender(websocket, on_close=self.remove)
+        self._index_add(self._by_user, str(user_info.get("_id")), conn_id)
+        self._index_add(self._by_branch, user_info.get("branch"), conn_id)
+        self._index_add(self._by_employment_type, user_info.get("employment_type"), conn_id)
+        if user_info.get("role") == "admin":
+            self._admins.add(conn_id)
+
+    def remove(self, websocket: WebSocket) -> None:
+        """Rimuove una connessione (idempotente)."""
+        conn_id = id(websocket)
+        if self._connections.pop(conn_id, None) is None:
+            return
+        sender = self._senders.pop(conn_id, None)
+        if sender is not None:
+            sender.close()
+        user_info = websocket.state.user
+        self._index_discard(self._by_user, str(user_info.get("_id")), conn_id)
+        self._index_discard(self._by_branch, user_info.get("branch"), conn_id)
+        self._index_discard(self._by_employment_type, user_info.get("employment_type"), conn_id)
+        self._admins.discard(conn_id)
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def __bool__(self) -> bool:
+        return bool(self._connections)
+
+    def __contains__(self, websocket: WebSocket) -> bool:
+        return id(websocket) in self._connections
+
+    def __iter__(self) -> Iterator[WebSocket]:
+        return iter(list(self._connections.values()))
+
+    def sender(self, websocket: WebSocket) -> Optional[ConnectionSender]:
+        return self._senders.get(id(websocket))
+
+    def queue_depths(self) -> List[int]:
+        return [len(s) for s in self._senders.values()]
+
+    def _resolve(self, conn_ids: Iterable[int]) -> List[WebSocket]:
+        return [self._connections[c] for c in conn_ids if c in self._connections]
+
+    def for_user(self, user_id: str) -> List[WebSocket]:
+        """Tutte le connessioni (schede/dispositivi) di un utente."""
+        return self._resolve(self._by_user.get(str(user_id), ()))
+
+    def select(
+        self,
+        branch: Optional[str] = None,
+        employment_type: Optional[List[str]] = None,
+        exclude_user_id: Optional[str] = None,
+        exclude_admins: bool = False
+    ) -> List[WebSocket]:
+        """
+        Connessioni che passano i filtri branch/employment_type.
+        `branch` None o "*" e `employment_type` vuoto o contenente "*" non filtrano.
+        """
+        candidates: Optional[Set[int]] = None
+
+        if branch and branch != "*":
+            candidates = set(self._by_branch.get(branch, ()))
+
+        if employment_type and "*" not in employment_type:
+            by_emp: Set[int] = set()
+            for emp in employment_type:
+                by_emp |= self._by_employment_type.get(emp, set())
+            candidates = by_emp if candidates is None else candidates & by_emp
+
+        if candidates is None:
+            candidates = set(self._connections)
+
+        if exclude_user_id:
+            candidates -= self._by_user.get(str(exclude_user_id), set())
+        if exclude_admins:
+            candidates -= self._admins
+
+        return self._resolve(candidates)
+
+
+# Registro globale delle connessioni attive
+active_ws_connections = ConnectionRegistry()
 
 # --- Gestione Serializer per Cookie di Sessione ---
 
@@ -73,8 +309,9 @@ async def get_ws_user(websocket: WebSocket) -> Optional[Dict]:
         logger.warning("[WS AUTH] 'user_id' non trovato nei dati di sessione.")
         return None
 
-    db = websocket.app.state.db
-    user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Import locale: user_cache registra i suoi handler di invalidazione su questo modulo
+    from app.utils import user_cache
+    user = await user_cache.get_user(websocket.app.state.db, user_id)
     if not user:
         logger.error(f"[WS AUTH] Utente con id '{user_id}' non trovato nel database.")
     return user
@@ -82,8 +319,98 @@ async def get_ws_user(websocket: WebSocket) -> Optional[Dict]:
 
 # --- Funzioni di Broadcast ---
 
+# Eventi "ultimo valore vince": se uno è ancora in coda per un client lento,
+# basta inviargli il più recente (policy `coalesce`).
+COALESCIBLE_TYPES = {"view/update", "stats:ai_news", "comment/like_update"}
+
+
+def _coalesce_key(payload: Any) -> Optional[str]:
+    if not isinstance(payload, dict) or payload.get("type") not in COALESCIBLE_TYPES:
+        return None
+    data = payload.get("data") or payload
+    target = data.get("comment_id") or data.get("parent_id") or data.get("news_id")
+    return f"{payload['type']}:{target}"
+
+
+def ws_metrics() -> Dict[str, Any]:
+    """Contatori delle code di invio WebSocket di questo processo."""
+    depths = active_ws_connections.queue_depths()
+    return {
+        **_ws_stats,
+        "connections": len(active_ws_connections),
+        "queued_messages": sum(depths),
+        "max_queue_depth": max(depths, default=0),
+        "queue_limit": WS_SEND_QUEUE_MAX,
+        "policy": WS_SLOW_CONSUMER_POLICY,
+        "pubsub_backend": pubsub.name,
+        "pubsub": dict(pubsub.stats),
+    }
+
+
+class EncodedMessage:
+    """
+    Payload WebSocket già serializzato: il JSON viene prodotto una volta sola
+    e la stessa stringa finisce nella coda di ogni destinatario (e nella
+    busta pub/sub verso gli altri worker).
+    """
+
+    __slots__ = ("text", "type", "coalesce_key")
+
+    def __init__(self, text: str, type: Optional[str] = None, coalesce_key: Optional[str] = None):
+        self.text = text
+        self.type = type
+        self.coalesce_key = coalesce_key
+
+
+def encode_message(payload: Any) -> Optional[EncodedMessage]:
+    """Serializza un payload per `broadcast_message`; None se è vuoto."""
+    if isinstance(payload, EncodedMessage):
+        return payload
+    if not payload:
+        return None
+    text = json.dumps(payload, ensure_ascii=False)
+    if not text or text == "{}":
+        return None
+    payload_type = payload.get("type") if isinstance(payload, dict) else None
+    return EncodedMessage(text, payload_type, _coalesce_key(payload))
+
+
+# Eventi raccolti da `broadcast_batch()` nel task corrente (None = nessun batch)
+_pending_batch: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("ws_pending_batch", default=None)
+
+
+@asynccontextmanager
+async def broadcast_batch():
+    """
+    Raggruppa i broadcast del blocco in un unico frame per destinatario:
+
+        async with broadcast_batch():
+            await broadcast_message(toast, branch=..., exclude_user_id=...)
+            await broadcast_resource_event("add", item_type=..., ...)
+
+    Ogni client riceve `{"type": "batch", "events": [...]}` con i soli
+    eventi che i filtri gli destinano, nell'ordine di invio (un evento
+    singolo viene inviato così com'è). Gli eventi vengono pubblicati anche
+    se il blocco solleva un'eccezione.
+    """
+    if _pending_batch.get() is not None:
+        # Batch annidato: confluisce in quello esterno
+        yield
+        return
+    events: List[Dict[str, Any]] = []
+    token = _pending_batch.set(events)
+    try:
+        yield
+    finally:
+        _pending_batch.reset(token)
+        if len(events) == 1:
+            await pubsub.publish(events[0])
+        elif events:
+            await pubsub.publish({"batch": events})
+
+
 async def broadcast_message(
-    payload: Dict,
+    payload: Union[Dict, EncodedMessage],
     branch: Optional[str] = None,
     employment_type: Optional[List[str]] = None,
     exclude_user_id: Optional[str] = None,
@@ -93,110 +420,194 @@ async def broadcast_message(
     Invia un messaggio WebSocket a utenti filtrati o a un utente specifico.
     - Se target_user_id è fornito, invia solo a quell'utente.
     - Altrimenti, applica filtri branch/employment_type ed esclude exclude_user_id.
+    Il messaggio è serializzato una volta (o arriva già come `EncodedMessage`)
+    e pubblicato sul backend pub/sub (vedi `app.utils.ws_pubsub`), che lo
+    consegna a `deliver_local` di ogni worker. Dentro `broadcast_batch()`
+    viene invece accodato al batch corrente.
     """
+    message = encode_message(payload)
+    if message is None:
+        logger.error(f"[WS] Payload vuoto ({payload!r}), annullamento broadcast.")
+        return
+
+    envelope = {
+        "message": message.text,
+        "type": message.type,
+        "coalesce_key": message.coalesce_key,
+        "branch": branch,
+        "employment_type": employment_type,
+        "exclude_user_id": exclude_user_id,
+        "target_user_id": target_user_id,
+    }
+    batch = _pending_batch.get()
+    if batch is not None:
+        batch.append(envelope)
+        return
+    await pubsub.publish(envelope)
+
+
+def _select_recipients(envelope: Dict[str, Any]) -> List[WebSocket]:
+    """Connessioni locali destinatarie di un evento pubblicato."""
+    target_user_id = envelope.get("target_user_id")
+    if target_user_id:
+        # Invio mirato: solo le connessioni dell'utente indicato
+        recipients = active_ws_connections.for_user(target_user_id)
+    else:
+        # Non inviare notifiche di tipo 'new_notification' (toast) agli admin,
+        # a meno che non siano il target_user_id esplicito (gestito sopra).
+        recipients = active_ws_connections.select(
+            branch=envelope.get("branch"),
+            employment_type=envelope.get("employment_type"),
+            exclude_user_id=envelope.get("exclude_user_id"),
+            exclude_admins=envelope.get("type") == "new_notification"
+        )
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"[WS] Broadcast type={envelope.get('type')} target={target_user_id} "
+            f"branch={envelope.get('branch')} employment_type={envelope.get('employment_type')} "
+            f"exclude={envelope.get('exclude_user_id')}: "
+            f"{len(recipients)}/{len(active_ws_connections)} destinatari"
+        )
+    return recipients
+
+
+def _enqueue(recipient: WebSocket, message: str, coalesce_key: Optional[str]) -> bool:
+    if recipient.client_state.name != "CONNECTED":
+        return False
+    sender = active_ws_connections.sender(recipient)
+    return sender is not None and sender.enqueue(message, coalesce_key)
+
+
+async def deliver_local(envelope: Dict[str, Any]) -> None:
+    """
+    Consegna un evento pubblicato ai client collegati a questo worker.
+    I destinatari sono selezionati dagli indici di `active_ws_connections`;
+    il messaggio viene solo accodato (vedi `ConnectionSender`), quindi la
+    funzione ritorna senza attendere i client lenti.
+    """
+    if "invalidate" in envelope:
+        _run_invalidation_handlers(envelope["invalidate"])
+        return
+
     if not active_ws_connections:
         logger.debug("[WS] Nessuna connessione attiva")
         return
 
-    if not payload:
-        logger.error("[WS] Tentativo di invio payload vuoto, annullamento broadcast.")
+    if "batch" in envelope:
+        _deliver_batch(envelope["batch"])
         return
 
-    message_to_send = json.dumps(payload, ensure_ascii=False)
+    # Accoda il messaggio: l'invio effettivo lo fa il writer di ogni connessione
+    message_to_send = envelope["message"]
+    coalesce_key = envelope.get("coalesce_key")
+    queued = sum(
+        1 for recipient in _select_recipients(envelope)
+        if _enqueue(recipient, message_to_send, coalesce_key)
+    )
+    logger.debug("[WS] Broadcast accodato: %s destinatari", queued)
 
-    if not message_to_send or message_to_send == "{}": # Aggiunto controllo per stringa JSON vuota
-        logger.error(f"[WS] Messaggio serializzato vuoto o payload originale vuoto ({payload}), annullamento broadcast.")
-        return
 
-    recipients = []
-    
-    logger.debug(f"[WS] Preparazione broadcast:")
-    logger.debug(f"[WS] - Target User ID: {target_user_id}")
-    logger.debug(f"[WS] - Branch filtro: {branch}")
-    logger.debug(f"[WS] - Employment type filtro: {employment_type}")
-    logger.debug(f"[WS] - User ID da escludere: {exclude_user_id}")
-    logger.debug(f"[WS] - Payload completo: {json.dumps(payload, indent=2)}")
-
-    # Itera su una copia per rimuovere in sicurezza le connessioni morte
-    for connection in active_ws_connections[:]:
-        if connection.client_state.name != "CONNECTED":
-            continue
+def _deliver_batch(events: List[Dict[str, Any]]) -> None:
+    """
+    Un frame per destinatario con gli eventi del batch che lo riguardano.
+    I destinatari con lo stesso sottoinsieme di eventi condividono lo stesso
+    frame, costruito concatenando i messaggi già serializzati.
+    """
+    per_recipient: Dict[int, Tuple[WebSocket, List[int]]] = {}
+    for index, event in enumerate(events):
+        for recipient in _select_recipients(event):
+            per_recipient.setdefault(id(recipient), (recipient, []))[1].append(index)
+
+    frames: Dict[Tuple[int, ...], Tuple[str, Optional[str]]] = {}
+    queued = 0
+    for recipient, indexes in per_recipient.values():
+        key = tuple(indexes)
+        frame = frames.get(key)
+        if frame is None:
+            if len(indexes) == 1:
+                event = events[indexes[0]]
+                frame = (event["message"], event.get("coalesce_key"))
+            else:
+                body = ",".join(events[i]["message"] for i in indexes)
+                frame = ('{"type": "batch", "events": [' + body + ']}', None)
+            frames[key] = frame
+        if _enqueue(recipient, *frame):
+            queued += 1
 
-        try:
-            user_info = connection.state.user
-            user_id = str(user_info.get("_id"))
-            user_role = user_info.get("role")
-            user_branch = user_info.get("branch")
-            user_emp_type = user_info.get("employment_type")
-            
-            logger.debug(f"[WS] Valutazione utente {user_info.get('email')}:")
-            logger.debug(f"[WS] - ID: {user_id}")
-            logger.debug(f"[WS] - Ruolo: {user_role}")
-            logger.debug(f"[WS] - Branch: {user_branch}")
-            logger.debug(f"[WS] - Employment Type: {user_emp_type}")
-
-            # Se è specificato un target_user_id, invia solo a quell'utente
-            if target_user_id:
-                if user_id == target_user_id:
-                    logger.debug(f"[WS] - INCLUSO: corrisponde a target_user_id")
-                    recipients.append(connection)
-                else:
-                    logger.debug(f"[WS] - ESCLUSO: non corrisponde a target_user_id")
-                continue # Passa alla prossima connessione
-            
-            # Altrimenti, applica i filtri standard
-            # Filtra per utente escluso
-            if exclude_user_id and user_id == exclude_user_id:
-                logger.debug(f"[WS] - ESCLUSO: è l'utente che ha fatto l'azione")
-                continue
+    logger.debug("[WS] Batch di %s eventi accodato: %s destinatari, %s frame distinti", len(events), queued, len(frames))
 
-            # Non inviare notifiche di tipo 'new_notification' (toast) agli admin,
-            # a meno che non siano il target_user_id esplicito (gestito sopra).
-            if payload.get('type') == 'new_notification' and user_role == 'admin' and not target_user_id:
-                logger.debug(f"[WS] - ESCLUSO: è un admin e questo è un toast di notifica generico")
-                continue
 
-            # Filtra per filiale (solo se non c'è target_user_id)
-            if branch and branch != "*" and user_branch != branch:
-                logger.debug(f"[WS] - ESCLUSO: branch non corrispondente")
-                continue
+# --- Backend pub/sub (fan-out tra worker) ---
 
-            # Filtra per tipo di impiego (solo se non c'è target_user_id)
-            if employment_type and "*" not in employment_type and user_emp_type not in employment_type:
-                logger.debug(f"[WS] - ESCLUSO: employment type non corrispondente")
-                continue
-            
-            logger.debug(f"[WS] - INCLUSO: tutti i filtri (non target) passati")
-            recipients.append(connection)
+pubsub = ws_pubsub.create_backend(deliver_local)
 
-        except Exception as e:
-            logger.error(f"[WS] Errore durante la valutazione dell'utente: {e}")
-            # Rimuovi le connessioni che causano errori
-            active_ws_connections.remove(connection)
-    
-    # Invia il messaggio a tutti i destinatari validi
-    for recipient in recipients:
+
+async def start_pubsub(db) -> None:
+    """Da chiamare nel lifespan dell'app, dopo aver aperto il client Mongo."""
+    await pubsub.start(db)
+
+
+async def stop_pubsub() -> None:
+    await pubsub.stop()
+
+
+# --- Invalidazione delle cache in memoria (tra worker) ---
+
+# Funzioni chiamate in ogni worker per ogni invalidazione pubblicata
+_invalidation_handlers: List[Callable[[Dict[str, Any]], None]] = []
+
+
+def on_invalidate(handler: Callable[[Dict[str, Any]], None]) -> Callable[[Dict[str, Any]], None]:
+    """
+    Registra `handler(data)` per le invalidazioni pubblicate con
+    `publish_invalidation`. Usabile come decoratore; l'handler deve essere
+    veloce e non bloccante (di norma marca qualcosa come da ricaricare).
+    """
+    _invalidation_handlers.append(handler)
+    return handler
+
+
+def _run_invalidation_handlers(data: Dict[str, Any]) -> None:
+    for handler in _invalidation_handlers:
         try:
-            user_info = recipient.state.user
-            logger.debug(f"[WS] Invio a {user_info.get('email')} (ruolo: {user_info.get('role')})")
-            logger.debug(f"[WS] Messaggio inviato: {message_to_send}")
-            await recipient.send_text(message_to_send)
+            handler(data)
         except Exception as e:
-            logger.error(f"[WS] Errore durante l'invio: {e}")
-            if recipient in active_ws_connections:
-                active_ws_connections.remove(recipient)
+            logger.error(f"[WS] Errore handler invalidazione {getattr(handler, '__name__', handler)}: {e}")
 
-    logger.debug(f"[WS] Broadcast completato: {len(recipients)} destinatari")
+
+async def publish_invalidation(collection: str, key: Optional[str] = None) -> None:
+    """
+    Segnala a tutti i worker (compreso quello corrente) che `collection`
+    è cambiata; `key` identifica l'elemento se noto. Viaggia sullo stesso
+    backend pub/sub degli eventi WebSocket ma non raggiunge i client e non
+    entra nei `broadcast_batch()`.
+    """
+    await pubsub.publish({"invalidate": {"collection": collection, "key": key}})
 
 
-async def broadcast_resource_event(event: str, *, item_type: str, item_id: str, user_id: str):
-    """ Helper per inviare eventi di aggiornamento risorse (es. highlights) a tutti. """
-    await broadcast_message({
+async def broadcast_resource_event(
+    event: str,
+    *,
+    item_type: str,
+    item_id: str,
+    user_id: str,
+    data_filter_criteria: Optional[Dict] = None
+):
+    """
+    Helper per inviare eventi di aggiornamento risorse (es. highlights) a tutti.
+    `data_filter_criteria` (branch/employment_type della risorsa) viene
+    inoltrato al client per il filtraggio lato UI.
+    """
+    payload = {
         "type": f"resource/{event}",
         "item": {"type": item_type, "id": item_id},
         "user_id": user_id,
         "timestamp": datetime.utcnow().isoformat()
-    })
+    }
+    if data_filter_criteria:
+        payload["data_filter_criteria"] = data_filter_criteria
+    await broadcast_message(payload)
 
 
 # --- Endpoint WebSocket Principale ---
@@ -221,7 +632,7 @@ async def websocket_main(websocket: WebSocket):
         "role": user.get("role")
     }
     
-    active_ws_connections.append(websocket)
+    active_ws_connections.add(websocket)
     logger.info(f"[WS] Connessione stabilita per: {user.get('email')}. Totale connessioni: {len(active_ws_connections)}")
 
     try:
@@ -230,11 +641,14 @@ async def websocket_main(websocket: WebSocket):
             message = await websocket.receive_json()
             
             # Rispondi all'heartbeat del client per mantenere la connessione viva
+            # (passa dalla coda: un solo task scrive sul socket)
             if message.get("type") == "heartbeat":
-                await websocket.send_json({"type": "heartbeat", "status": "acknowledged"})
+                sender = active_ws_connections.sender(websocket)
+                if sender is not None:
+                    sender.enqueue(json.dumps({"type": "heartbeat", "status": "acknowledged"}), "heartbeat")
             else:
                 # Gestisci altri tipi di messaggi in arrivo se necessario
-                logger.debug(f"[WS] Messaggio ricevuto da {user.get('email')}: {message}")
+                logger.debug("[WS] Messaggio ricevuto da %s: %s", user.get('email'), message)
 
     except WebSocketDisconnect:
         logger.info(f"[WS] Disconnessione per: {user.get('email')}.")
@@ -242,6 +656,5 @@ async def websocket_main(websocket: WebSocket):
         logger.error(f"[WS] Errore inatteso per {user.get('email')}: {e}")
     finally:
         # Pulisci la connessione
-        if websocket in active_ws_connections:
-            active_ws_connections.remove(websocket)
+        active_ws_connections.remove(websocket)
         logger.info(f"[WS] Connessione rimossa. Totale connessioni: {len(active_ws_connections)}")
\ No newline at end of file
@@ -4,7 +4,6 @@ from pathlib import Path
 
 # Percorso assoluto del file .env (nella root del progetto)
 ENV_PATH = Path(__file__).resolve().parent / '.env'  # vecchio percorso
-print(f"\n=== LOADING ENV FILE ===\nPath: {ENV_PATH}\nExists: {ENV_PATH.exists()}\n")
 load_dotenv()  # Carica .env dalla directory corrente
 
 import os
@@ -12,10 +11,6 @@ if "SESSION_SECRET" not in os.environ:
     raise RuntimeError("SESSION_SECRET must be defined")
 SECRET_KEY = os.environ["SESSION_SECRET"]        # ← senza default
 
-print("\n=== APP SECRET KEY ===")
-print(f"First 10 chars: {SECRET_KEY[:10]}")
-print(f"Length: {len(SECRET_KEY)}")
-
 import os, secrets
 import logging
 from contextlib import asynccontextmanager
@@ -24,18 +19,22 @@ from datetime import date, datetime, timedelta
 from bson import ObjectId    
 from app.news import news_router
 from app.links import links_router
-from app.documents import documents_router, BASE_DOCS_DIR
+from app.documents import documents_router, BASE_DOCS_DIR, MAX_FILE_SIZE
+from app.utils.uploads import UploadTooLarge
+from app.utils.downloads import file_response, download_stats
 from app.contatti import contatti_router
-from app.deps import require_admin, get_current_user
+from app.deps import require_admin, get_current_user, get_unread_counts
 from app.notifiche import notifiche_router
 from app.ai_news import ai_news_router
 from app.soci import soci_router
 from app.organigramma import organigramma_router
-from app.ws_broadcast import websocket_main, broadcast_resource_event, get_ws_user
+from app.ws_broadcast import websocket_main, broadcast_resource_event, get_ws_user, ws_metrics, start_pubsub, stop_pubsub
+from app.utils import user_cache, unread_counters, home_feed, change_counters, blob_store, photos, passwords
+from app.utils.indexes import ensure_indexes
+from app.utils import query_profiler
 
 import motor.motor_asyncio
 from bson import ObjectId
-from passlib.hash import bcrypt
 from pydantic import BaseModel, Field
 
 from fastapi import (
@@ -55,53 +54,22 @@ from slowapi.util import get_remote_address
 from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorClient
 from pathlib import Path
 from werkzeug.utils import secure_filename
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
-from markdown_it import MarkdownIt
-import bleach
-from logging.handlers import RotatingFileHandler
-from pymongo import DESCENDING, ASCENDING
+from app.utils.markdown_render import render_markdown, markdown_stats
 
 # --- LOGGING ---------------------------------------------------------
 import logging
 
+from app.utils import log_pipeline
+
 # Configura il logger principale
 logging.basicConfig(level=logging.INFO)
 
-# Crea un logger specifico per l'applicazione
-logger = logging.getLogger("intranet")
-logger.setLevel(logging.INFO)
-
-# Rimuovi gli handler esistenti per evitare duplicati
-logger.handlers = []
-
-# Formattatore per i log su file
-file_formatter = logging.Formatter(
-    '%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%H:%M:%S'
-)
-
-# Formattatore per i log su console (più conciso)
-console_formatter = logging.Formatter(
-    '[%(levelname)s] %(message)s'
-)
-
-# Handler per il file di log
-file_handler = RotatingFileHandler(
-    'intranet.log',
-    maxBytes=1024*1024,  # 1MB
-    backupCount=5
-)
-file_handler.setFormatter(file_formatter)
-file_handler.setLevel(logging.DEBUG)
-
-# Handler per la console
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(console_formatter)
-console_handler.setLevel(logging.INFO)
-
-# Aggiungi gli handler al logger
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+# Logger dell'applicazione: QueueHandler + QueueListener (scritture su file
+# fuori dall'event loop), JSON con request id, livello da LOG_LEVEL
+logger = log_pipeline.setup_logging("intranet")
+logger.debug("File .env: %s (esiste: %s)", ENV_PATH, ENV_PATH.exists())
 
 # Riduci il livello di log per alcuni moduli troppo verbosi
 logging.getLogger("motor").setLevel(logging.WARNING)
@@ -114,6 +82,9 @@ MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/intranet")
 limiter = Limiter(key_func=get_remote_address)
 templates = Jinja2Templates(directory="templates")
 templates.env.globals["datetime"] = datetime
+# Varianti pre-ridimensionate delle foto profilo (components/avatar.html)
+templates.env.globals["photo_url"] = photos.photo_url
+templates.env.globals["photo_srcset"] = photos.photo_srcset
 
 def format_datetime(dt):
     """Formatta una data in formato leggibile"""
@@ -122,64 +93,62 @@ def format_datetime(dt):
     return dt.strftime("%d/%m/%Y %H:%M")
 
 def markdown_filter(text):
-    md = MarkdownIt("commonmark", {"breaks": True, "html": False})
-    html = md.render(text or "")
-    safe_html = bleach.clean(
-        html,
-        tags=[
-            'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 'ul', 'p', 'pre', 'br', 'span', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'
-        ],
-        attributes={'a': ['href', 'title', 'target'], 'span': ['class']},
-        strip=True
-    )
-    return safe_html
+    # Parser e sanitizer condivisi, HTML in cache LRU (app/utils/markdown_render.py)
+    return render_markdown(text)
 
 # Registra i filtri
 templates.env.filters["markdown"] = markdown_filter
 templates.env.filters["format_datetime"] = format_datetime
+# Tempo di render Jinja nel profilo della richiesta (Server-Timing, /admin/metrics/queries)
+query_profiler.instrument_templates(templates)
 
-print("Filtri disponibili:", templates.env.filters.keys())
+logger.debug("Filtri disponibili: %s", list(templates.env.filters.keys()))
 
 # Costanti per i percorsi
 BASE_DOCS_DIR = Path("media/docs")   # cartella radice documenti
-FOTO_DIR = Path("media/foto")        # cartella radice foto profilo
+FOTO_DIR = photos.FOTO_DIR          # cartella radice foto profilo
 
 # Definizione lifespan
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
+    client = motor.motor_asyncio.AsyncIOMotorClient(
+        MONGO_URI, event_listeners=query_profiler.event_listeners()
+    )
     app.state.db = client.get_default_database()
-    await app.state.db.users.create_index("email", unique=True)
+    # Indici dichiarati in app/utils/indexes.py (crea solo quelli mancanti)
+    await ensure_indexes(app.state.db)
+    # Fan-out WebSocket tra worker (WS_PUBSUB_BACKEND=memory|mongo)
+    await start_pubsub(app.state.db)
     yield
+    await stop_pubsub()
+    photos.shutdown_pool()
+    log_pipeline.stop_logging()
     client.close()
 
 # --------------------------- APP INIT ----------------------------------
 app = FastAPI(lifespan=lifespan)                 
 
 app.state.templates = templates
-print("\n=== APP STATE SECRET KEY ===")
-print(f"Setting app.state.secret_key (first 10 chars): {SECRET_KEY[:10]}...")
 app.state.secret_key = SECRET_KEY                
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
+# Foto profilo con versione nel nome: cache lunga (montata prima di /media)
+FOTO_DIR.mkdir(parents=True, exist_ok=True)
+app.mount("/media/foto", photos.VersionedPhotoFiles(directory=FOTO_DIR), name="foto")
 app.mount("/media", StaticFiles(directory="media"), name="media")
 
-print("\n=== MIDDLEWARE SECRET KEY ===")
-print(f"Configuring SessionMiddleware with key (first 10 chars): {SECRET_KEY[:10]}...")
-
-# Stampa il valore esatto della chiave per debug (RIMUOVERE IN PRODUZIONE!)
-print("DEBUG - Actual secret key:", SECRET_KEY)
-
 app.add_middleware(                              
     SessionMiddleware,
     secret_key=SECRET_KEY,
     same_site="lax",
 )
+# Comandi Mongo e tempi per richiesta -> header Server-Timing (QUERY_PROFILING=0 per disattivare)
+app.add_middleware(query_profiler.QueryProfilerMiddleware)
+# Id richiesta nei log e nell'header X-Request-ID (aggiunto per ultimo: è il più esterno)
+app.add_middleware(log_pipeline.RequestIdMiddleware)
 
 # Debug middleware configuration
-print("\n=== SESSION MIDDLEWARE CONFIG ===")
-print("Secret Key Length:", len(SECRET_KEY))
-print("Middleware:", [m.cls.__name__ for m in app.user_middleware])
+logger.debug("Middleware: %s", [m.cls.__name__ for m in app.user_middleware])
 
 app.state.limiter = limiter
 app.add_exception_handler(429, _rate_limit_exceeded_handler)
@@ -247,46 +216,12 @@ class PinIn(BaseModel):
 # --------------------------- ROUTE UI --------------------------------
 from fastapi.responses import RedirectResponse
 
-@app.get("/", response_class=HTMLResponse)
+@app.get("/", response_class=HTMLResponse,
+         dependencies=[Depends(get_unread_counts)])
 async def home(request: Request, user = Depends(get_current_user)):
-    db = request.app.state.db
-    now = datetime.utcnow()
-
-    # --- NUOVA LOGICA PER RECUPERARE LE NEWS ---
-    
-    # 1. Filtro per le news non scadute
-    news_filter = {
-        "$or": [
-            {"expires_at": None},
-            {"expires_at": {"$gt": now}}
-        ]
-    }
-
-    # 2. Logica di ordinamento: Prima le pinnate, poi per priorità, poi per data
-    sort_logic = [("pinned", DESCENDING), ("priority", ASCENDING), ("created_at", DESCENDING)]
-
-    # 3. Esegui la query
-    news_items = await db.news.find(news_filter).sort(sort_logic).to_list(length=None)
-
-    # --- LOGICA PER GLI ALTRI HIGHLIGHTS (documenti, link, etc.) ---
-    highlights_filter = {
-        "type": {"$ne": "news"} 
-    }
-    other_highlights = await db.home_highlights.find(highlights_filter).to_list(length=None)
-    
-    # Uniamo le news con gli altri highlights
-    all_highlights = news_items + other_highlights
-
-    # Converti gli ObjectId in stringhe e uniforma l'uso di object_id
-    for h in all_highlights:
-        if "_id" in h:
-            h["_id"] = str(h["_id"])
-        if "id" in h:
-            if "object_id" not in h:
-                h["object_id"] = str(h["id"])
-            del h["id"]
-        if "object_id" in h:
-            h["object_id"] = str(h["object_id"])
+    # News e highlights del segmento dell'utente, materializzati in memoria
+    # (vedi app/utils/home_feed.py): nessuna query se il feed è aggiornato
+    feed = await home_feed.get_segment_feed(request.app.state.db, user)
 
     # Converti gli ID dei pin in stringhe
     if "pinned_items" in user:
@@ -299,88 +234,50 @@ async def home(request: Request, user = Depends(get_current_user)):
         {
             "request": request,
             "user": user,
-            "highlights": all_highlights,
-            "news_items": news_items
+            "highlights": feed.highlights,
+            "news_items": feed.news_items,
+            "news": feed.ticker
         }
     )
 
 @app.get("/home/highlights/partial", response_class=HTMLResponse)
 async def home_highlights_partial(request: Request, user = Depends(get_current_user)):
-    db = request.app.state.db
-    
-    # Definisci il filtro base per gli highlights in base al ruolo e ai permessi dell'utente
-    user_branch = user.get("branch")
-    user_employment_type = user.get("employment_type")
-
-    highlights_filter = {}
-    if user.get("role") != "admin":
-        conditions = []
-        # Filtro per branch
-        if user_branch:
-            conditions.append({"$or": [{"branch": "*"}, {"branch": user_branch}]})
-        else: # Utente senza branch specifico, può vedere solo quelli per tutti '*'
-            conditions.append({"branch": "*"})
-
-        # Filtro per employment_type
-        if user_employment_type:
-            conditions.append({"$or": [
-                {"employment_type": "*"},
-                {"employment_type": user_employment_type}, # Caso semplice: stringa singola
-                {"employment_type": {"$elemMatch": {"$in": [user_employment_type, "*"]}}}, # Caso lista
-                {"employment_type": {"$exists": False}},
-                {"employment_type": []}
-            ]})
-        else: # Utente senza employment_type specifico
-             conditions.append({"$or": [
-                {"employment_type": "*"},
-                {"employment_type": {"$exists": False}},
-                {"employment_type": []}
-            ]})
-
-        if conditions:
-            highlights_filter["$and"] = conditions
-
-    highlights = await db.home_highlights.find(highlights_filter).sort([("created_at", DESCENDING)]).to_list(length=None)
-    
-    # Converti gli ObjectId in stringhe e uniforma l'uso di object_id
-    for h in highlights:
-        if "_id" in h:
-            h["_id"] = str(h["_id"])
-        if "id" in h:
-            # Converti id in object_id se non esiste già
-            if "object_id" not in h:
-                h["object_id"] = str(h["id"])
-            del h["id"]  # Rimuovi il vecchio id
-        if "object_id" in h:
-            h["object_id"] = str(h["object_id"])
-    
+    # Highlights già filtrati per filiale/tipo di contratto e ordinati per data
+    feed = await home_feed.get_segment_feed(request.app.state.db, user)
+
     # Converti gli ID dei pin in stringhe
     if "pinned_items" in user:
         for pin in user["pinned_items"]:
             if "id" in pin:
                 pin["id"] = str(pin["id"])
-    
-    # Il filtraggio è già stato fatto dalla query MongoDB, quindi `highlights` ora contiene solo quelli pertinenti.
-    # Rimuoviamo il filtraggio Python ridondante.
-    
-    return templates.TemplateResponse(
-        "partials/home_highlights.html", # Assicurati che il nome del template sia corretto
+
+    etag = home_feed.user_etag(feed, user, "highlights")
+    not_modified = change_counters.not_modified(request, etag, "home_highlights")
+    if not_modified:
+        return not_modified
+
+    resp = templates.TemplateResponse(
+        "partials/home_highlights.html",
         {
             "request": request,
             "user": user,
-            "highlights": highlights # Passa direttamente gli highlights filtrati dal DB
+            "highlights": feed.highlights
         }
     )
+    return change_counters.with_etag(resp, etag)
 
 @app.get("/home/news_ticker/partial", response_class=HTMLResponse)
 async def home_news_ticker_partial(request: Request, user=Depends(get_current_user)):
-    db = request.app.state.db
-    news = await db.news.find().to_list(length=None)
-    news = sorted(news, key=lambda x: x["created_at"], reverse=True)
-    return request.app.state.templates.TemplateResponse(
+    feed = await home_feed.get_segment_feed(request.app.state.db, user)
+    etag = f'W/"ticker-{feed.etag}"'
+    not_modified = change_counters.not_modified(request, etag, "home_news_ticker")
+    if not_modified:
+        return not_modified
+    resp = request.app.state.templates.TemplateResponse(
         "partials/news_ticker.html",
-        {"request": request, "news": news, "user": user}
+        {"request": request, "news": feed.ticker, "user": user}
     )
+    return change_counters.with_etag(resp, etag)
 
 # ---- AUTH ----
 @app.get("/login", response_class=HTMLResponse)
@@ -396,11 +293,24 @@ async def login_form(request: Request):
 async def login(request: Request, db=Depends(get_db),
                 email: str = Form(...), password: str = Form(...)):
     user = await db.users.find_one({"email": email.lower()})
-    if not user or not bcrypt.verify(password, user["pass_hash"]):
+    try:
+        # bcrypt nel pool dedicato, non sull'event loop
+        ok, new_hash = await passwords.verify_and_update(password, user["pass_hash"]) if user else (False, None)
+    except passwords.PasswordPoolBusy:
+        return templates.TemplateResponse(
+            "login.html",
+            {"request": request, "error": "Troppi accessi in corso, riprova tra qualche secondo"},
+            status_code=503
+        )
+    if not ok:
         return templates.TemplateResponse(
             "login.html",
             {"request": request, "error": "Credenziali errate"}
         )
+    if new_hash:
+        # Costo bcrypt cambiato (BCRYPT_ROUNDS): aggiorna l'hash, solo se nel frattempo non è cambiato
+        await db.users.update_one({"_id": user["_id"], "pass_hash": user["pass_hash"]}, {"$set": {"pass_hash": new_hash}})
+        await user_cache.invalidate_user(user["_id"])
     request.session["user_id"] = str(user["_id"])
     if user.get("must_change_pw"):
         return RedirectResponse("/me/password?first=1", 303)
@@ -447,7 +357,7 @@ async def change_pw_submit(request: Request, db=Depends(get_db),
     old_pw: str = Form(...), new_pw: str = Form(...),
     user = Depends(get_current_user)
 ):
-    if not bcrypt.verify(old_pw, user["pass_hash"]):
+    if not await passwords.verify_password(old_pw, user["pass_hash"]):
         return templates.TemplateResponse(
             "auth/change_pw.html",
             {"request": request, "error": "Password errata",
@@ -455,14 +365,15 @@ async def change_pw_submit(request: Request, db=Depends(get_db),
         )
     await db.users.update_one(
         {"_id": user["_id"]},
-        {"$set": {"pass_hash": bcrypt.hash(new_pw),
+        {"$set": {"pass_hash": await passwords.hash_password(new_pw),
                   "must_change_pw": False}}
     )
+    await user_cache.invalidate_user(user["_id"])
     return RedirectResponse("/", 303)
 
 # ---- UTENTI (admin) ----
 @app.get("/users", response_class=HTMLResponse,
-         dependencies=[Depends(require_admin)])
+         dependencies=[Depends(require_admin), Depends(get_unread_counts)])
 async def users_page(
     request: Request,
     db = Depends(get_db),
@@ -532,7 +443,7 @@ async def create_user_ui(
             "birth_date": birth_date or None,
             "sex": sex or None,
             "citizenship": citizenship or None,
-            "pass_hash": bcrypt.hash(password),
+            "pass_hash": await passwords.hash_password(password),
             "must_change_pw": True
         })
         return RedirectResponse("/users", 303)
@@ -599,6 +510,7 @@ async def edit_user_submit(
             "citizenship": citizenship or None,
         }}
     )
+    await user_cache.invalidate_user(user_id)
     updated = await db.users.find_one({"_id": ObjectId(user_id)})
 
     resp = templates.TemplateResponse(
@@ -618,6 +530,8 @@ from fastapi import Response
 @app.delete("/users/{user_id}", dependencies=[Depends(require_admin)])
 async def delete_user(user_id: str, db=Depends(get_db)):
     await db.users.delete_one({"_id": ObjectId(user_id)})
+    await user_cache.invalidate_user(user_id)
+    await unread_counters.drop_unread_state(db, user_id)
     return Response(status_code=200)
 
 
@@ -641,7 +555,7 @@ async def api_list(db=Depends(get_db)):
 async def api_create(user: UserIn, db=Depends(get_db)):
     doc = user.dict(exclude={"password"})
     doc["email"] = doc["email"].lower()
-    doc["pass_hash"] = bcrypt.hash(user.password)
+    doc["pass_hash"] = await passwords.hash_password(user.password)
     doc["must_change_pw"] = True
     res = await db.users.insert_one(doc)
     saved = await db.users.find_one({"_id": res.inserted_id})
@@ -653,14 +567,83 @@ async def api_update(user_id: str, patch: UserUpdate, db=Depends(get_db)):
         {"_id": ObjectId(user_id)},
         {"$set": patch.dict(exclude_unset=True)}
     )
+    await user_cache.invalidate_user(user_id)
     updated = await db.users.find_one({"_id": ObjectId(user_id)})
     return {"id": user_id, **to_str_id(updated)}
 
 @admin_api.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def api_delete(user_id: str, db=Depends(get_db)):
     await db.users.delete_one({"_id": ObjectId(user_id)})
+    await user_cache.invalidate_user(user_id)
+    await unread_counters.drop_unread_state(db, user_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
+# ---- METRICHE CACHE UTENTI (admin) ----
+@app.get("/admin/metrics/user-cache", dependencies=[Depends(require_admin)])
+async def user_cache_metrics():
+    """Contatori hit/miss della cache utenti usata da get_current_user."""
+    return JSONResponse(user_cache.cache_stats())
+
+# ---- METRICHE CODE WEBSOCKET (admin) ----
+@app.get("/admin/metrics/ws", dependencies=[Depends(require_admin)])
+async def ws_queue_metrics():
+    """Profondità delle code di invio WebSocket e messaggi scartati/coalescati."""
+    return JSONResponse(ws_metrics())
+
+# ---- METRICHE FEED HOME (admin) ----
+@app.get("/admin/metrics/home-feed", dependencies=[Depends(require_admin)])
+async def home_feed_metrics():
+    """Dimensione dello store del feed home, segmenti materializzati e ricariche."""
+    return JSONResponse(home_feed.feed_stats())
+
+# ---- ETAG DEI PARTIAL HTMX (admin) ----
+@app.get("/admin/metrics/partials", dependencies=[Depends(require_admin)])
+async def partial_etag_metrics():
+    """Versioni per collection e risposte 304/renderizzate per partial."""
+    return JSONResponse(change_counters.etag_stats())
+
+# ---- ARCHIVIO FILE PER CONTENUTO (admin) ----
+@app.get("/admin/metrics/blobs", dependencies=[Depends(require_admin)])
+async def blob_store_metrics():
+    """Blob salvati, upload deduplicati e riferimenti rilasciati da questo worker."""
+    return JSONResponse(blob_store.store_stats())
+
+# ---- DOWNLOAD DI FILE (admin) ----
+@app.get("/admin/metrics/downloads", dependencies=[Depends(require_admin)])
+async def download_metrics():
+    """Risposte complete, parziali (206), 304, 416 e delegate al proxy."""
+    return JSONResponse(download_stats())
+
+# ---- FOTO PROFILO (admin) ----
+@app.get("/admin/metrics/photos", dependencies=[Depends(require_admin)])
+async def photo_metrics():
+    """Foto elaborate, rifiutate per pool pieno e non valide."""
+    return JSONResponse(photos.photo_stats())
+
+# ---- PIPELINE DI LOG (admin) ----
+@app.get("/admin/metrics/logs", dependencies=[Depends(require_admin)])
+async def log_metrics():
+    """Record in coda, scartati per coda piena e scartati dal campionamento."""
+    return JSONResponse(log_pipeline.log_stats())
+
+# ---- CACHE MARKDOWN (admin) ----
+@app.get("/admin/metrics/markdown", dependencies=[Depends(require_admin)])
+async def markdown_metrics():
+    """Hit/miss e dimensione della cache LRU dell'HTML renderizzato."""
+    return JSONResponse(markdown_stats())
+
+# ---- HASH PASSWORD (admin) ----
+@app.get("/admin/metrics/passwords", dependencies=[Depends(require_admin)])
+async def password_metrics():
+    """Coda e tempi del pool bcrypt, rifiuti per coda piena, rehash al login."""
+    return JSONResponse(passwords.password_stats())
+
+# ---- PROFILAZIONE QUERY PER ROTTA (admin) ----
+@app.get("/admin/metrics/queries", dependencies=[Depends(require_admin)])
+async def query_metrics(reset: bool = False):
+    """Comandi Mongo, tempo DB/render e istogrammi per rotta, ordinati per tempo DB."""
+    return JSONResponse(query_profiler.query_stats(reset=reset))
+
 # Register the router with the main app
 app.include_router(admin_api)
 app.include_router(news_router)
@@ -674,7 +657,8 @@ app.include_router(organigramma_router)
 
 
 
-@app.get("/me", response_class=HTMLResponse)
+@app.get("/me", response_class=HTMLResponse,
+         dependencies=[Depends(get_unread_counts)])
 async def profile_page(request: Request, user=Depends(get_current_user)):
     return templates.TemplateResponse(
         "profile.html",
@@ -701,7 +685,8 @@ async def get_docs_coll(
 
 # ---- DOCUMENTI ------------------------------------------------------
 
-@app.get("/documents", response_class=HTMLResponse)
+@app.get("/documents", response_class=HTMLResponse,
+         dependencies=[Depends(get_unread_counts)])
 async def list_documents(
     request: Request,
     current_user = Depends(get_current_user)
@@ -736,6 +721,7 @@ async def list_documents(
         {"tipo": "documento", "letta_da": {"$ne": user_id}},
         {"$push": {"letta_da": user_id}}
     )
+    await unread_counters.reset_unread(db, user_id, "documento")
     resp = request.app.state.templates.TemplateResponse(
         "documents.html",
         {
@@ -790,31 +776,29 @@ async def upload_submit(
     file: UploadFile = File(...),
     docs_coll: AsyncIOMotorCollection = Depends(get_docs_coll),
 ):
-    # 1. salva su disco in media/docs/<branch>/
-    target_dir = DOCS_DIR if branch == "*" else DOCS_DIR / branch
-    target_dir.mkdir(parents=True, exist_ok=True)
-
+    # 1. salva nell'archivio per contenuto (a blocchi, senza duplicati)
     # nome di file sicuro
-    safe_name = secure_filename(file.filename)
-    
-    # path finale del file
-    filepath = target_dir / safe_name
-    
-    # salva il file
-    with filepath.open("wb") as out:
-        content = await file.read()
-        out.write(content)
+    safe_name = secure_filename(file.filename) or "file"
+
+    try:
+        stored = await blob_store.put_upload(request.app.state.db, file, max_bytes=MAX_FILE_SIZE)
+    except UploadTooLarge:
+        raise HTTPException(413, f"File oltre il limite di {MAX_FILE_SIZE // (1024 * 1024)} MB")
 
     # 2. salva metadati in Mongo
     doc = {
         "title": title.strip(),
-        "filename": str(filepath.relative_to(DOCS_DIR)),
+        "filename": safe_name,
+        "blob": stored.sha256,
+        "size": stored.size,
+        "sha256": stored.sha256,
         "branch": branch,
         "tags": [t.strip() for t in tags.split(",")] if tags else [],
         "uploaded_at": datetime.utcnow(),
         "uploader_id": request.state.user["_id"],
     }
-    await docs_coll.insert_one(doc)
+    result = await docs_coll.insert_one(doc)
+    await change_counters.collection_changed("documents", result.inserted_id)
 
     return RedirectResponse("/documents", status_code=303)
 
@@ -831,14 +815,18 @@ async def delete_document(
     if not doc:
         raise HTTPException(404, "Documento non trovato")
 
-    # cancella file fisico, se c'è
-    filepath = DOCS_DIR / doc["filename"]
-    try:
-        filepath.unlink(missing_ok=True)  # Py ≥3.8
-    except Exception as exc:
-        print(f"[WARN] impossibile cancellare file: {exc}")
-
     await docs_coll.delete_one({"_id": doc["_id"]})
+
+    # rilascia il blob (eliminato con l'ultimo riferimento) o il vecchio file
+    if doc.get("blob"):
+        await blob_store.release(docs_coll.database, doc["blob"])
+    else:
+        filepath = BASE_DOCS_DIR / doc["filename"]
+        try:
+            filepath.unlink(missing_ok=True)  # Py ≥3.8
+        except Exception as exc:
+            logger.warning("impossibile cancellare file: %s", exc)
+    await change_counters.collection_changed("documents", doc["_id"])
     return Response(status_code=200, media_type="text/plain")
 
 # ---- DOWNLOAD SICURO -----------------------------------------------
@@ -846,6 +834,7 @@ async def delete_document(
 @app.get("/doc/{doc_id}")
 async def download_document(
     doc_id: str,
+    request: Request,
     user = Depends(get_current_user),
     docs_coll: AsyncIOMotorCollection = Depends(get_docs_coll)
 ):
@@ -858,19 +847,22 @@ async def download_document(
     if user["role"] != "admin" and doc["branch"] not in ("*", user["branch"]):
         raise HTTPException(403, "Non autorizzato")
 
-    filepath = DOCS_DIR / doc["filename"]
-    if not filepath.exists():
+    filepath = blob_store.resolve(doc, BASE_DOCS_DIR)
+    if not filepath or not filepath.exists():
         raise HTTPException(404, "File mancante sul server")
 
-    return FileResponse(
-        path=filepath,
+    return file_response(
+        request, filepath,
+        filename=f"{doc['title']}.pdf",
         media_type="application/pdf",
-        filename=f"{doc['title']}.pdf"
+        etag=blob_store.strong_etag(doc),
+        immutable=bool(doc.get("blob"))
     )
 
 @app.get("/doc/{doc_id}/preview")
 async def preview_document(
     doc_id: str,
+    request: Request,
     user = Depends(get_current_user),
     docs_coll: AsyncIOMotorCollection = Depends(get_docs_coll)
 ):
@@ -881,15 +873,17 @@ async def preview_document(
     if user["role"] != "admin" and doc["branch"] not in ("*", user["branch"]):
         raise HTTPException(403, "Non autorizzato")
 
-    filepath = BASE_DOCS_DIR / doc["filename"]
-    if not filepath.exists():
+    filepath = blob_store.resolve(doc, BASE_DOCS_DIR)
+    if not filepath or not filepath.exists():
         raise HTTPException(404, "File mancante")
 
-    return FileResponse(
-        path=filepath,
-        media_type="application/pdf",
+    return file_response(
+        request, filepath,
         filename=f"{doc['title']}.pdf",
-        headers={"Content-Disposition": "inline"}
+        media_type="application/pdf",
+        etag=blob_store.strong_etag(doc),
+        immutable=bool(doc.get("blob")),
+        inline=True
     )
 
 
@@ -909,7 +903,8 @@ async def get_links_coll(
 #                            LINK  UTILI                             
 # -------------------------------------------------------------------- 
 
-@app.get("/links", response_class=HTMLResponse)
+@app.get("/links", response_class=HTMLResponse,
+         dependencies=[Depends(get_unread_counts)])
 async def links_page(
     request: Request,
     links_coll: AsyncIOMotorCollection = Depends(get_links_coll),
@@ -940,7 +935,9 @@ async def links_page(
         {"tipo": "link", "letta_da": {"$ne": user_id}},
         {"$push": {"letta_da": user_id}}
     )
-    print("Notifiche link segnate come lette:", result.modified_count)
+    logger.debug("Notifiche link segnate come lette: %s", result.modified_count)
+    await unread_counters.reset_unread(request.app.state.db, user_id, "link")
+    request.state.unread_counts["link"] = 0
 
     return templates.TemplateResponse(
         "links/links_index.html",
@@ -958,7 +955,8 @@ async def links_page(
 
 # --------------------------- NEWS ---------------------------
 
-@app.get("/news", response_class=HTMLResponse)
+@app.get("/news", response_class=HTMLResponse,
+         dependencies=[Depends(get_unread_counts)])
 async def news_page(
     request: Request,
     db=Depends(get_db),
@@ -1055,8 +1053,7 @@ async def delete_news(news_id: str, db=Depends(get_db)):
 
 # ---- FOTO PROFILO ------------------------------------------------
 
-from PIL import Image
-import io
+PHOTO_MAX_SIZE = 2 * 1024 * 1024        # 2 MB
 
 @app.post("/me/foto")
 async def upload_foto(
@@ -1065,51 +1062,50 @@ async def upload_foto(
     user = Depends(get_current_user),
     _ = Depends(validate_csrf)         # protezione CSRF
 ):
-    # Leggi contenuto del file
-    contents = await file.read()
-
-    # Controlli sul file
-    MAX_SIZE = 2 * 1024 * 1024          # 2 MB
+    # Controlli sul file (al più PHOTO_MAX_SIZE + 1 byte in memoria)
     if file.content_type not in ("image/jpeg", "image/png"):
         raise HTTPException(400, "Formato non supportato")
-    if len(contents) > MAX_SIZE:
+    contents = await file.read(PHOTO_MAX_SIZE + 1)
+    if len(contents) > PHOTO_MAX_SIZE:
         raise HTTPException(400, "L'immagine supera 2 MB")
 
+    # Varianti WebP/JPEG generate nel process pool, fuori dall'event loop
     try:
-        # Apri l'immagine con Pillow
-        img = Image.open(io.BytesIO(contents))
-        rgb_img = img.convert("RGB")  # Converti in RGB se PNG con trasparenza
-
-        # Salva sempre come JPG
-        path = FOTO_DIR / f"{user['_id']}.jpg"
-        path.parent.mkdir(parents=True, exist_ok=True)
-        rgb_img.save(path, format="JPEG", quality=85)
-
-        # Aggiorna il campo avatar nel documento utente
-        db = request.app.state.db
-        avatar_url = f"/media/foto/{user['_id']}.jpg"
-        await db.users.update_one({"_id": user["_id"]}, {"$set": {"avatar": avatar_url}})
-
-        print("✅ Foto convertita e salvata come JPG:", path)
-        resp = RedirectResponse("/me", status_code=303)
-        resp.headers["Cache-Control"] = "no-store"  # previene caching
-        return resp
-
-    except Exception as e:
-        print("❌ Errore durante la conversione:", e)
+        version = await photos.process_photo(user["_id"], contents)
+    except photos.PhotoBusy:
+        raise HTTPException(503, "Troppe foto in elaborazione, riprova tra poco")
+    except photos.InvalidPhoto as e:
+        logger.warning("Errore durante la conversione della foto: %s", e)
         raise HTTPException(400, "Immagine non valida")
 
+    # Aggiorna versione e avatar (variante piccola, usata nei commenti) nel documento utente
+    db = request.app.state.db
+    fields = {"photo_version": version}
+    fields["avatar"] = photos.photo_url({"_id": user["_id"], **fields}, 64)
+    previous = await db.users.find_one_and_update(
+        {"_id": user["_id"]}, {"$set": fields},
+        projection={"photo_version": 1}, return_document=ReturnDocument.BEFORE
+    )
+    await user_cache.invalidate_user(user["_id"])
+    # Solo la versione sostituita: un upload concorrente ha ancora i suoi file
+    previous_version = (previous or {}).get("photo_version")
+    if previous_version != version:
+        photos.remove_version(user["_id"], previous_version)
+
+    resp = RedirectResponse("/me", status_code=303)
+    resp.headers["Cache-Control"] = "no-store"  # previene caching
+    return resp
+
 @app.post("/me/foto/delete")
 async def delete_foto(
     request: Request,
     user = Depends(get_current_user)
 ):
-    # Cerca tutti i file possibili (jpg, jpeg, png)
-    for ext in ("jpg", "jpeg", "png"):
-        path = FOTO_DIR / f"{user['_id']}.{ext}"
-        if path.exists():
-            path.unlink()
-            break
+    # Varianti e vecchio JPEG unico
+    photos.remove_photos(user["_id"])
+    db = request.app.state.db
+    await db.users.update_one({"_id": user["_id"]}, {"$unset": {"photo_version": "", "avatar": ""}})
+    await user_cache.invalidate_user(user["_id"])
     resp = RedirectResponse("/me", status_code=303)
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
@@ -1124,11 +1120,10 @@ async def delete_foto(
 from fastapi.routing import APIRoute
 
 def stampa_route_registrate():
-    print("\n📋 ROUTE REGISTRATE:")
+    logger.debug("Rotte registrate:")
     for route in app.routes:
         if isinstance(route, APIRoute):
-            metodi = ",".join(route.methods)
-            print(f"{metodi:10} {route.path}")
+            logger.debug("%-10s %s", ",".join(route.methods), route.path)
 
 stampa_route_registrate()  # <--- assicurati che questa riga CI SIA
 
@@ -1154,7 +1149,16 @@ async def htmx_auth_handler(request: Request, exc: HTTPException):
     # Lascia invariati gli altri status (404, 403, ecc.)
     return Response(status_code=exc.status_code, headers=exc.headers)
 
-@app.get("/messaggi", response_class=HTMLResponse)
+@app.exception_handler(passwords.PasswordPoolBusy)
+async def password_pool_busy_handler(request: Request, exc: passwords.PasswordPoolBusy):
+    """Pool bcrypt saturo (cambio password, creazione utenti): 503 invece di 500."""
+    return Response(
+        "Troppe operazioni sulle password in corso, riprova tra qualche secondo",
+        status_code=503, media_type="text/plain", headers={"Retry-After": "5"}
+    )
+
+@app.get("/messaggi", response_class=HTMLResponse,
+         dependencies=[Depends(get_unread_counts)])
 async def messaggi_page(request: Request, user=Depends(get_current_user)):
     return templates.TemplateResponse(
         "messaggi.html",
@@ -1183,12 +1187,13 @@ async def add_pin(item: dict, request: Request, user=Depends(get_current_user)):
         {"$addToSet": {"pinned_items": item}},
         return_document=True
     )
+    await user_cache.invalidate_user(user["_id"])
 
     # aggiorna la copia in sessione, così resta dopo il refresh
     request.session["pinned_items"] = updated_user["pinned_items"]
     
-    print("DEBUG - Session after pin:", request.session["pinned_items"])  # Debug log
-    print("DEBUG - Updated user pinned_items:", updated_user["pinned_items"])  # Debug log
+    logger.debug("Session after pin: %s", request.session["pinned_items"])
+    logger.debug("Updated user pinned_items: %s", updated_user["pinned_items"])
 
     # broadcast
     await broadcast_resource_event(
@@ -1209,12 +1214,13 @@ async def remove_pin(item_type: str, item_id: str, request: Request, user=Depend
         {"$pull": {"pinned_items": {"type": item_type, "id": str(item_id)}}},
         return_document=True
     )
+    await user_cache.invalidate_user(user["_id"])
 
     # aggiorna la copia in sessione, così resta dopo il refresh
     request.session["pinned_items"] = updated_user["pinned_items"]
     
-    print("DEBUG - Session after unpin:", request.session["pinned_items"])  # Debug log
-    print("DEBUG - Updated user pinned_items:", updated_user["pinned_items"])  # Debug log
+    logger.debug("Session after unpin: %s", request.session["pinned_items"])
+    logger.debug("Updated user pinned_items: %s", updated_user["pinned_items"])
 
     # broadcast
     await broadcast_resource_event(
@@ -1273,7 +1279,7 @@ async def get_type_section(type: str, request: Request, user=Depends(get_current
 @app.on_event("startup")
 async def regen_secret_if_dev():
     if os.getenv("DEV_MODE"):
-        print("DEV MODE: Regenerating secret key...")
+        logger.info("DEV MODE: rigenero la chiave di sessione")
         os.environ["SESSION_SECRET"] = secrets.token_urlsafe(32)
 
 # Endpoint WebSocket principale
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Measure the per-request latency of ``GET /api/ai-news`` on a running server.
+
+Usage (single line):
+    python scripts/bench_api_ai_news.py --base-url http://localhost:8000 --email admin@hqe.it --password secret --requests 500 --label after
+
+Run it once against the baseline revision and once against the current one
+(same database, same user) to compare the cost of the authentication
+dependency. Before the badge count moved to the opt-in ``get_unread_counts``
+dependency, every call to ``/api/ai-news`` also paid a
+``notifiche.count_documents`` scan; now it only pays the (cached) user
+look-up and the listing query itself.
+
+Notes
+-----
+* Only the standard library is used: the script logs in through ``/login``
+  with a cookie jar and then reuses the session cookie.
+* A warm-up phase (``--warmup``) is excluded from the statistics so that the
+  user cache and Mongo working set are hot in both runs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.cookiejar
+import statistics
+import time
+import urllib.parse
+import urllib.request
+
+# ---------------------------------------------------------------------
+# helpers
+# ---------------------------------------------------------------------
+
+
+def _login(opener: urllib.request.OpenerDirector, base_url: str, email: str, password: str) -> None:
+    """POST the login form; the session cookie ends up in the opener's jar."""
+    data = urllib.parse.urlencode({"email": email, "password": password}).encode()
+    opener.open(f"{base_url}/login", data=data).read()
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted *samples*."""
+    if not samples:
+        return 0.0
+    k = max(0, min(len(samples) - 1, round(pct / 100 * len(samples)) - 1))
+    return samples[k]
+
+
+def run(base_url: str, email: str, password: str, n_requests: int, warmup: int, label: str) -> None:
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    _login(opener, base_url, email, password)
+
+    url = f"{base_url}/api/ai-news?limit=20"
+    for _ in range(warmup):
+        opener.open(url).read()
+
+    timings_ms: list[float] = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        opener.open(url).read()
+        timings_ms.append((time.perf_counter() - start) * 1000)
+
+    timings_ms.sort()
+    print(f"[{label}] GET /api/ai-news  n={n_requests}")
+    print(f"  mean  {statistics.mean(timings_ms):8.2f} ms")
+    print(f"  p50   {_percentile(timings_ms, 50):8.2f} ms")
+    print(f"  p95   {_percentile(timings_ms, 95):8.2f} ms")
+    print(f"  p99   {_percentile(timings_ms, 99):8.2f} ms")
+    print(f"  max   {timings_ms[-1]:8.2f} ms")
+
+
+# ---------------------------------------------------------------------
+# CLI entrypoint
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency benchmark for /api/ai-news")
+    parser.add_argument("--base-url", default="http://localhost:8000", help="Server base URL")
+    parser.add_argument("--email", required=True, help="Login e-mail")
+    parser.add_argument("--password", required=True, help="Login password")
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests")
+    parser.add_argument("--warmup", type=int, default=50, help="Unmeasured warm-up requests")
+    parser.add_argument("--label", default="run", help="Label printed with the results (e.g. before/after)")
+
+    args = parser.parse_args()
+    run(args.base_url.rstrip("/"), args.email, args.password, args.requests, args.warmup, args.label)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""Micro-benchmark of WebSocket recipient selection with simulated connections.
+
+Usage (single line, from the repository root):
+    python scripts/bench_ws_broadcast.py --connections 5000 --rounds 200
+
+Compares the legacy ``broadcast_message`` strategy (a linear scan of every
+open connection for each event, evaluating filters one by one) with the
+indexed ``ConnectionRegistry`` now used by ``app.ws_broadcast``.
+
+Three scenarios are measured:
+
+* ``targeted``  – ``target_user_id`` set (e.g. a reply notification);
+* ``filtered``  – branch + employment_type filter (e.g. a news for one site);
+* ``global``    – no filter, toast excluded for admins.
+
+Notes
+-----
+* No server or database is needed: connections are plain objects exposing
+  ``state.user``, ``client_state.name`` and an async ``send_text`` that only
+  counts the frames.
+* The ``broadcast_message`` rows time the real function, which selects the
+  recipients and enqueues on each connection's send queue; the selection
+  rows isolate the cost of finding recipients.
+* ``--slow N`` makes N connections take ``--slow-ms`` per frame. With the
+  old sequential ``await send_text`` every broadcast waited for all of
+  them; now only their own queues grow (see ``/admin/metrics/ws``).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app import ws_broadcast  # noqa: E402
+from app.ws_broadcast import ConnectionRegistry  # noqa: E402
+
+BRANCHES = ["HQE", "HQ ITALIA", "HQE SERVIZI", "HQE LAB"]
+EMPLOYMENT_TYPES = ["TD", "TI", "AP", "CO"]
+
+# ---------------------------------------------------------------------
+# helpers
+# ---------------------------------------------------------------------
+
+
+class FakeConnection:
+    """Stand-in for a Starlette WebSocket (unhashable, like the real one)."""
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __init__(self, user: dict, delay: float = 0.0):
+        self.state = SimpleNamespace(user=user)
+        self.client_state = SimpleNamespace(name="CONNECTED")
+        self.delay = delay
+        self.frames = 0
+
+    async def send_text(self, _text: str) -> None:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.frames += 1
+
+    async def close(self, code: int = 1000) -> None:
+        self.client_state.name = "DISCONNECTED"
+
+
+def _make_connections(n: int, n_users: int, seed: int) -> list[FakeConnection]:
+    rnd = random.Random(seed)
+    conns = []
+    for i in range(n):
+        uid = f"user{i % n_users:05d}"
+        conns.append(FakeConnection({
+            "_id": uid,
+            "email": f"{uid}@hqe.it",
+            "branch": rnd.choice(BRANCHES),
+            "employment_type": rnd.choice(EMPLOYMENT_TYPES),
+            "role": "admin" if rnd.random() < 0.02 else "user",
+        }))
+    return conns
+
+
+def legacy_select(connections, payload, branch=None, employment_type=None,
+                  exclude_user_id=None, target_user_id=None):
+    """The pre-registry selection loop of ``broadcast_message`` (debug logging removed)."""
+    recipients = []
+    for connection in connections[:]:
+        if connection.client_state.name != "CONNECTED":
+            continue
+        user_info = connection.state.user
+        user_id = str(user_info.get("_id"))
+        if target_user_id:
+            if user_id == target_user_id:
+                recipients.append(connection)
+            continue
+        if exclude_user_id and user_id == exclude_user_id:
+            continue
+        if payload.get("type") == "new_notification" and user_info.get("role") == "admin":
+            continue
+        if branch and branch != "*" and user_info.get("branch") != branch:
+            continue
+        if employment_type and "*" not in employment_type and user_info.get("employment_type") not in employment_type:
+            continue
+        recipients.append(connection)
+    return recipients
+
+
+def registry_select(registry, payload, branch=None, employment_type=None,
+                    exclude_user_id=None, target_user_id=None):
+    if target_user_id:
+        return registry.for_user(target_user_id)
+    return registry.select(
+        branch=branch,
+        employment_type=employment_type,
+        exclude_user_id=exclude_user_id,
+        exclude_admins=payload.get("type") == "new_notification",
+    )
+
+
+def _time(fn, rounds: int) -> list[float]:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return timings
+
+
+async def _time_async(coro_fn, rounds: int) -> list[float]:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await coro_fn()
+        timings.append((time.perf_counter() - start) * 1_000_000)
+        await asyncio.sleep(0)  # let the writer tasks run between broadcasts
+    return timings
+
+
+async def _drain(registry, timeout: float = 5.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while sum(registry.queue_depths()) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.05)  # sends already dequeued but not yet completed
+
+
+def _report(label: str, timings_us: list[float]) -> None:
+    timings_us.sort()
+    p95 = timings_us[max(0, round(0.95 * len(timings_us)) - 1)]
+    print(f"  {label:<28} mean {statistics.mean(timings_us):10.1f} us   p95 {p95:10.1f} us")
+
+
+# ---------------------------------------------------------------------
+# scenarios
+# ---------------------------------------------------------------------
+
+
+def run(n_connections: int, n_users: int, rounds: int, seed: int, n_slow: int, slow_ms: float) -> None:
+    asyncio.run(_run(n_connections, n_users, rounds, seed, n_slow, slow_ms))
+
+
+async def _run(n_connections: int, n_users: int, rounds: int, seed: int, n_slow: int, slow_ms: float) -> None:
+    connections = _make_connections(n_connections, n_users, seed)
+    for conn in random.Random(seed).sample(connections, n_slow):
+        conn.delay = slow_ms / 1000
+    registry = ConnectionRegistry()
+    for conn in connections:
+        registry.add(conn)
+
+    target = connections[n_connections // 2].state.user["_id"]
+    scenarios = {
+        "targeted": dict(payload={"type": "new_notification"}, target_user_id=target),
+        "filtered": dict(payload={"type": "news/new"}, branch="HQE", employment_type=["TD", "TI"],
+                         exclude_user_id=target),
+        "global": dict(payload={"type": "new_notification"}, branch="*", employment_type=["*"],
+                       exclude_user_id=target),
+    }
+
+    print(f"{n_connections} connections ({n_slow} slow, {slow_ms} ms/frame), "
+          f"{n_users} users, {rounds} rounds per scenario")
+    ws_broadcast.active_ws_connections = registry
+    for name, kwargs in scenarios.items():
+        expected = {id(c) for c in legacy_select(connections, **kwargs)}
+        got = {id(c) for c in registry_select(registry, **kwargs)}
+        assert expected == got, f"{name}: recipient sets differ"
+
+        print(f"\n[{name}] recipients={len(expected)}")
+        _report("selection legacy (scan)", _time(lambda: legacy_select(connections, **kwargs), rounds))
+        _report("selection registry", _time(lambda: registry_select(registry, **kwargs), rounds))
+
+        # Real broadcast_message: selection + enqueue, writers run in background
+        timings = await _time_async(lambda: ws_broadcast.broadcast_message(**kwargs), rounds)
+        _report("broadcast_message (enqueue)", timings)
+        if n_slow:
+            legacy_ms = sum(c.delay for c in expected_conns(connections, expected)) * 1000
+            print(f"  {'sequential send, slow share':<28} ~{legacy_ms:9.1f} ms per broadcast (legacy)")
+
+    await _drain(registry)
+    print("\nqueue metrics:", ws_broadcast.ws_metrics())
+
+
+def expected_conns(connections, ids):
+    return [c for c in connections if id(c) in ids]
+
+
+# ---------------------------------------------------------------------
+# CLI entrypoint
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebSocket broadcast selection benchmark")
+    parser.add_argument("--connections", type=int, default=5000, help="Simulated open connections")
+    parser.add_argument("--users", type=int, default=4000, help="Distinct users (some have several tabs)")
+    parser.add_argument("--rounds", type=int, default=200, help="Broadcasts per scenario")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--slow", type=int, default=0, help="Connections with a slow send")
+    parser.add_argument("--slow-ms", type=float, default=50.0, help="Per-frame delay of slow connections")
+
+    args = parser.parse_args()
+    run(args.connections, args.users, args.rounds, args.seed, args.slow, args.slow_ms)
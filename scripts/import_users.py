@@ -20,6 +20,12 @@ Notes
 * Dates are accepted as dd/mm/yyyy or yyyy-mm-dd and stored as ISO yyyy-mm-dd.
 * The script performs an **upsert** keyed on e‑mail, so it can be run multiple
   times; it will update existing users and create the missing ones.
+* The CSV is streamed and written with one ``bulk_write`` per ``--batch-size``
+  rows. Passwords are hashed in a pool of ``--workers`` processes; the shared
+  default password is hashed only once per run. Use the same ``--rounds`` as
+  the application (``BCRYPT_ROUNDS``), otherwise the first login rehashes.
+* ``--dry-run`` hashes and writes nothing: it prints the users that would be
+  created (``+``) and the fields that would change (``~``).
 """
 
 from __future__ import annotations
@@ -27,12 +33,16 @@ from __future__ import annotations
 import argparse
 import asyncio
 import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from passlib.hash import bcrypt
+from pymongo import UpdateOne
 
 ISO_FMT = "%Y-%m-%d"  # ISO‑8601 we store in Mongo
 
@@ -91,71 +101,201 @@ DEFAULTS = {
 }
 
 
-async def import_users(csv_path: Path, mongo_uri: str, default_pw: str) -> None:
-    """Read *csv_path* and upsert users into Mongo at *mongo_uri*."""
+def build_doc(row: dict[str, str]) -> tuple[Optional[dict], Optional[str]]:
+    """Canonical user document and plain password (or None) for one CSV row."""
+    doc: dict[str, Optional[str]] = {}
+    for key, value in row.items():
+        canonical = CANON_MAP.get(key, key)
+        value = (value or "").strip()
+        if canonical == "email":
+            value = value.lower()
+        if value:
+            doc[canonical] = value
 
-    client = AsyncIOMotorClient(mongo_uri)
-    db = client.get_default_database()
+    # ensure mandatory email
+    if not doc.get("email"):
+        return None, None
+
+    # defaults & transforms
+    doc.setdefault("role", DEFAULTS["role"])
+    doc.setdefault("branch", DEFAULTS["branch"])
+    doc["birth_date"] = _parse_date(doc.get("birth_date")) if doc.get("birth_date") else None
+    doc["sex"] = doc.get("sex", "").upper() or None
+    doc["branch"] = doc["branch"].upper()
+    if "employment_type" in doc:
+        doc["employment_type"] = doc["employment_type"].lower() or None
+
+    return doc, doc.pop("password", None)
 
-    created = updated = skipped = 0
 
+def read_rows(csv_path: Path) -> Iterator[dict[str, str]]:
+    """Stream the CSV one row at a time, with canonicalised header names."""
     with csv_path.open(newline="", encoding="utf-8-sig") as fp:
         # auto‑detect delimiter (comma or semicolon)
         sample = fp.read(4096)
         fp.seek(0)
         dialect = csv.Sniffer().sniff(sample, delimiters=",;")
         reader = csv.DictReader(fp, dialect=dialect)
+        reader.fieldnames = [_to_key(h) for h in reader.fieldnames or []]
+        yield from reader
+
+
+def batched(rows: Iterable[dict[str, str]], size: int) -> Iterator[list[dict[str, str]]]:
+    batch: list[dict[str, str]] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ---------------------------------------------------------------------
+# hashing (runs in the worker processes)
+# ---------------------------------------------------------------------
+
+
+def hash_passwords(passwords: list[str], rounds: int) -> list[str]:
+    """bcrypt-hash a chunk of passwords; one task per chunk keeps IPC overhead low."""
+    hasher = bcrypt.using(rounds=rounds)
+    return [hasher.hash(pw) for pw in passwords]
+
+
+async def hash_batch(pool: ProcessPoolExecutor, passwords: list[str], rounds: int, workers: int) -> list[str]:
+    """Spread *passwords* over the pool and return the hashes in the same order."""
+    loop = asyncio.get_running_loop()
+    step = max(1, -(-len(passwords) // workers))
+    chunks = [passwords[i:i + step] for i in range(0, len(passwords), step)]
+    results = await asyncio.gather(*(loop.run_in_executor(pool, hash_passwords, chunk, rounds) for chunk in chunks))
+    return [h for chunk in results for h in chunk]
+
+
+# ---------------------------------------------------------------------
+# dry run
+# ---------------------------------------------------------------------
+
+# fields that always differ between runs and say nothing about the profile
+DIFF_IGNORED = {"pass_hash", "must_change_pw"}
+
+
+async def diff_batch(db, docs: list[dict], counts: dict[str, int]) -> None:
+    """Print what the upserts of *docs* would change, without writing."""
+    emails = [d["email"] for d in docs]
+    existing = {u["email"]: u async for u in db.users.find({"email": {"$in": emails}})}
+    for doc in docs:
+        current = existing.get(doc["email"])
+        if current is None:
+            counts["created"] += 1
+            print(f"+ {doc['email']}  ({doc.get('name', '')}, {doc['role']}, {doc['branch']})")
+            continue
+        changes = [
+            f"{key}: {current.get(key)!r} -> {value!r}"
+            for key, value in doc.items()
+            if key not in DIFF_IGNORED and current.get(key) != value
+        ]
+        if changes:
+            counts["updated"] += 1
+            print(f"~ {doc['email']}  " + "; ".join(changes))
+        else:
+            counts["unchanged"] += 1
+
+
+# ---------------------------------------------------------------------
+# main routine
+# ---------------------------------------------------------------------
+
+
+async def import_users(
+    csv_path: Path,
+    mongo_uri: str,
+    default_pw: str,
+    batch_size: int = 500,
+    workers: int = 0,
+    rounds: int = 12,
+    dry_run: bool = False,
+) -> None:
+    """Stream *csv_path* and upsert users into Mongo at *mongo_uri* in batches."""
+
+    workers = workers or os.cpu_count() or 1
+    # the pool is started before the Mongo client: no driver threads in the children
+    pool = None if dry_run else ProcessPoolExecutor(max_workers=workers)
+    client = AsyncIOMotorClient(mongo_uri)
+    db = client.get_default_database()
 
-        # ------- header normalisation ----------
-        original_headers = reader.fieldnames or []
-        canon_headers = [_to_key(h) for h in original_headers]
-        reader.fieldnames = canon_headers  # mutate in‑place so DictReader uses them
-
-        # ------- rows ----------
-        for raw in reader:
-            # raw keys are already canonicalised; clone and strip values
-            row = {k: (v or "").strip() for k, v in raw.items()}
-
-            # build base document with canonical keys ONLY
-            doc: dict[str, Optional[str]] = {}
-            for key, value in row.items():
-                canonical = CANON_MAP.get(key, key)
-                if canonical == "email":
-                    value = value.lower()
-                if value:
-                    doc[canonical] = value
-
-            # ensure mandatory email
-            email = doc.get("email")
-            if not email:
-                print("[WARN] skipped row with empty e-mail")
-                skipped += 1
-                continue
-
-            # defaults & transforms
-            doc.setdefault("role", DEFAULTS["role"])
-            doc.setdefault("branch", DEFAULTS["branch"])
-            doc["birth_date"] = _parse_date(doc.get("birth_date")) if doc.get("birth_date") else None
-            doc["sex"] = doc.get("sex", "").upper() or None
-            doc["branch"] = doc["branch"].upper()
-            if "employment_type" in doc:
-                doc["employment_type"] = doc["employment_type"].lower() or None
-
-            # password hash handling
-            password_plain = doc.pop("password", None) or default_pw
-            doc["pass_hash"] = bcrypt.hash(password_plain)
-            doc["must_change_pw"] = True
-
-            # upsert
-            res = await db.users.update_one({"email": email}, {"$set": doc}, upsert=True)
-            if res.upserted_id:
-                created += 1
-            elif res.modified_count:
-                updated += 1
-            else:
-                skipped += 1
-
-    print(f"Created: {created}, Updated: {updated}, Skipped: {skipped}")
+    counts = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "skipped": 0, "hashed": 0}
+    default_hash: Optional[str] = None
+    pending_write: Optional[asyncio.Task] = None
+    started = time.perf_counter()
+
+    async def write(ops: list[UpdateOne]) -> None:
+        res = await db.users.bulk_write(ops, ordered=False)
+        counts["created"] += res.upserted_count
+        counts["updated"] += res.modified_count
+        counts["unchanged"] += res.matched_count - res.modified_count
+
+    print(f"Importing {csv_path} into {db.name} ({'dry run' if dry_run else f'{workers} hashing workers'}, batches of {batch_size})")
+    try:
+        for rows in batched(read_rows(csv_path), batch_size):
+            # keyed by e-mail: a repeated row replaces the earlier one, as the
+            # sequential upserts did, instead of racing it inside the same bulk_write
+            by_email: dict[str, tuple[dict, Optional[str]]] = {}
+            for raw in rows:
+                counts["rows"] += 1
+                doc, password = build_doc(raw)
+                if doc is None:
+                    print("[WARN] skipped row with empty e-mail")
+                    counts["skipped"] += 1
+                    continue
+                if doc["email"] in by_email:
+                    print(f"[WARN] repeated e-mail {doc['email']}, the later row wins")
+                    counts["skipped"] += 1
+                doc["must_change_pw"] = True
+                by_email[doc["email"]] = (doc, password)
+
+            docs = [doc for doc, _ in by_email.values()]
+            own_passwords = [(doc, pw) for doc, pw in by_email.values() if pw]
+
+            if dry_run:
+                await diff_batch(db, docs, counts)
+            elif docs:
+                # the shared default password is hashed once per run, not once per row
+                if default_hash is None and len(own_passwords) < len(docs):
+                    default_hash = (await hash_batch(pool, [default_pw], rounds, 1))[0]
+                    counts["hashed"] += 1
+                hashes = await hash_batch(pool, [pw for _, pw in own_passwords], rounds, workers) if own_passwords else []
+                counts["hashed"] += len(hashes)
+                for doc in docs:
+                    doc["pass_hash"] = default_hash
+                for (doc, _), pass_hash in zip(own_passwords, hashes):
+                    doc["pass_hash"] = pass_hash
+
+                # write this batch while the next one is read and hashed
+                if pending_write is not None:
+                    await pending_write
+                ops = [UpdateOne({"email": d["email"]}, {"$set": d}, upsert=True) for d in docs]
+                pending_write = asyncio.create_task(write(ops))
+
+            elapsed = time.perf_counter() - started
+            print(f"  {counts['rows']} rows  {counts['rows'] / elapsed if elapsed else 0:.0f} rows/s")
+
+        if pending_write is not None:
+            await pending_write
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        client.close()
+
+    elapsed = time.perf_counter() - started
+    verb = "Would create" if dry_run else "Created"
+    print(
+        f"{verb}: {counts['created']}, Updated: {counts['updated']}, Unchanged: {counts['unchanged']}, "
+        f"Skipped: {counts['skipped']}"
+    )
+    print(
+        f"{counts['rows']} rows in {elapsed:.1f}s ({counts['rows'] / elapsed if elapsed else 0:.0f} rows/s, "
+        f"{counts['hashed']} bcrypt hashes at cost {rounds})"
+    )
 
 
 # ---------------------------------------------------------------------
@@ -167,6 +307,10 @@ if __name__ == "__main__":
     parser.add_argument("--file", required=True, help="Path to CSV file")
     parser.add_argument("--mongo", default="mongodb://localhost:27017/intranet", help="Mongo URI")
     parser.add_argument("--default-password", default="password", help="Password to assign when missing in CSV")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows per bulk_write (default: 500)")
+    parser.add_argument("--workers", type=int, default=0, help="Hashing processes (default: CPU count)")
+    parser.add_argument("--rounds", type=int, default=int(os.getenv("BCRYPT_ROUNDS", "12")), help="bcrypt cost (default: $BCRYPT_ROUNDS or 12)")
+    parser.add_argument("--dry-run", action="store_true", help="Show the differences with the database without writing")
 
     args = parser.parse_args()
     csv_path = Path(args.file)
@@ -175,4 +319,7 @@ if __name__ == "__main__":
     if not csv_path.is_absolute() and not csv_path.exists():
         csv_path = Path(__file__).parent / csv_path
 
-    asyncio.run(import_users(csv_path, args.mongo, args.default_password))
+    asyncio.run(import_users(
+        csv_path, args.mongo, args.default_password,
+        batch_size=args.batch_size, workers=args.workers, rounds=args.rounds, dry_run=args.dry_run,
+    ))
@@ -1,46 +1,32 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+import argparse
 import asyncio
 from datetime import datetime, timedelta
 from app.utils.ai_news_migration import run_migrations
+from app.utils.indexes import reconcile_indexes
 
 async def init_ai_news_collections(db):
-    # Creazione indici per ai_news
-    await db.ai_news.create_index("section")
-    await db.ai_news.create_index("tags")
-    await db.ai_news.create_index("branch")
-    await db.ai_news.create_index("employment_type")
-    await db.ai_news.create_index("uploaded_at")
-    await db.ai_news.create_index("author_id")
-    await db.ai_news.create_index([("title", "text"), ("description", "text")])
-    await db.ai_news.create_index("stats.views")
-    await db.ai_news.create_index("stats.likes")
-    await db.ai_news.create_index("stats.comments")
-    print("✅ Indici ai_news creati")
-
-    # Creazione indici per tracking visite
-    await db.ai_news_views.create_index([("news_id", 1), ("user_id", 1)], unique=True)
-    await db.ai_news_views.create_index("viewed_at")
-    # TTL index per pulizia automatica dopo 30 giorni
-    await db.ai_news_views.create_index(
-        "viewed_at", 
-        expireAfterSeconds=30 * 24 * 60 * 60
+    # Gli indici sono dichiarati in app/utils/indexes.py (vedi scripts/manage_indexes.py)
+    report = await reconcile_indexes(
+        db, collections=["ai_news", "ai_news_views", "ai_news_comments", "ai_news_likes"]
     )
-    print("✅ Indici ai_news_views creati")
-
-    # Creazione indici per commenti
-    await db.ai_news_comments.create_index("news_id")
-    await db.ai_news_comments.create_index("author_id")
-    await db.ai_news_comments.create_index("parent_id")
-    await db.ai_news_comments.create_index("created_at")
-    print("✅ Indici ai_news_comments creati")
+    for row in report:
+        print(f"  {row['status']:<9} {row['collection']}.{row['index']}")
+    print("✅ Indici ai_news verificati")
 
-async def main():
+async def main(include=()):
     # Connessione al database
     client = AsyncIOMotorClient("mongodb://localhost:27017")
     db = client.intranet
 
-    # Esegui le migrazioni
-    await run_migrations(db)
+    # Esegui le migrazioni (i passi che riscrivono le news solo se richiesti)
+    await run_migrations(db, include=include)
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migrazioni AI news")
+    parser.add_argument(
+        "--include", default="",
+        help="Passi opzionali separati da virgola: ai_news_legacy_schema, ai_news_recategorize, ai_news_comment_depths"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(tuple(filter(None, (name.strip() for name in args.include.split(",")))))) 
\ No newline at end of file
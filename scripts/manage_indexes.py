@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Reconcile MongoDB indexes with the registry in ``app/utils/indexes.py``.
+
+Usage (single line, from the repository root):
+    python scripts/manage_indexes.py --mongo "mongodb://localhost:27017/intranet" --apply --explain
+
+Without ``--apply`` the script only reports what differs (dry run).
+
+Statuses
+--------
+* ``ok``        – an equivalent index exists (possibly under another name);
+* ``missing``   – declared but absent (dry run);
+* ``created``   – created by this run;
+* ``conflict``  – an index with the same name, or a second text index, has a
+  different definition; rerun with ``--prune`` to drop and recreate it;
+* ``failed``    – creation failed, typically duplicates blocking a unique index;
+* ``extra``     – present in MongoDB but not declared (``--prune`` drops it);
+* ``dropped``   – removed by ``--prune``.
+
+``--explain`` runs ``explain()`` on the representative route queries in
+``QUERY_PROBES`` and flags the ones whose winning plan still uses COLLSCAN.
+The exit code is 1 if any index is in conflict/failed or any probe scans the
+collection, so the script can gate a deploy.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.utils.indexes import explain_report, reconcile_indexes  # noqa: E402
+
+# ---------------------------------------------------------------------
+# main routine
+# ---------------------------------------------------------------------
+
+
+async def run(mongo_uri: str, apply: bool, prune: bool, explain: bool, collections: list[str] | None) -> int:
+    client = AsyncIOMotorClient(mongo_uri)
+    db = client.get_default_database()
+    problems = 0
+
+    print(f"Index registry vs {db.name} ({'apply' if apply else 'dry run'}{', prune' if prune else ''})")
+    for row in await reconcile_indexes(db, apply=apply, prune=prune, collections=collections):
+        if row["status"] in ("conflict", "failed"):
+            problems += 1
+        detail = f"  ({row['detail']})" if row["detail"] else ""
+        print(f"  {row['status']:<9} {row['collection']}.{row['index']}{detail}")
+
+    if explain:
+        print("\nQuery plans (explain):")
+        for row in await explain_report(db):
+            flag = "COLLSCAN" if row["collscan"] else "ok"
+            if row["collscan"]:
+                problems += 1
+            print(f"  {flag:<9} {row['route']:<45} {row['collection']:<18} {row['stages']}")
+
+    client.close()
+    return 1 if problems else 0
+
+
+# ---------------------------------------------------------------------
+# CLI entrypoint
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconcile MongoDB indexes with the declarative registry")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/intranet", help="MongoDB URI (with database)")
+    parser.add_argument("--apply", action="store_true", help="Create missing indexes (default: dry run)")
+    parser.add_argument("--prune", action="store_true", help="With --apply: drop undeclared and conflicting indexes")
+    parser.add_argument("--explain", action="store_true", help="Report COLLSCAN plans of the route query probes")
+    parser.add_argument("--collection", action="append", help="Limit to this collection (repeatable)")
+
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.mongo, args.apply, args.prune, args.explain, args.collection)))
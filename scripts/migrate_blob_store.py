@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Move the legacy ``media/docs`` tree into the content-addressed blob store.
+
+Usage (single line, from the repository root):
+    python scripts/migrate_blob_store.py --mongo "mongodb://localhost:27017/intranet" --apply
+
+Without ``--apply`` the script only hashes the files and reports what the
+migration would do (dry run).
+
+Every ``documents`` / ``ai_news`` entry without a ``blob`` field is ingested
+through ``app.utils.blob_store.put_file``: the file is copied to
+``media/blobs/ab/cd/<sha256>`` (once per distinct content), the reference
+count is incremented and the entry gets ``blob``, ``sha256`` and ``size``.
+The run is idempotent: migrated entries are skipped on the next run.
+
+The report lists
+* entries whose file is missing on disk (left untouched);
+* files in the legacy tree that no entry references;
+* how many bytes deduplication saves.
+
+``--delete-originals`` (with ``--apply``) removes the legacy files once all
+the entries pointing to them have been migrated. ``--recount`` compares the
+``blobs`` reference counts with the actual references afterwards (and fixes
+them with ``--apply``).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import sys
+import time
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.utils import blob_store  # noqa: E402
+
+# ---------------------------------------------------------------------
+# legacy layout
+# ---------------------------------------------------------------------
+
+# collection -> directory the legacy ``filename`` is relative to
+LEGACY_DIRS = {
+    "documents": Path("media/docs"),
+    "ai_news": Path("media/docs/ai_news"),
+}
+
+
+def legacy_filename(doc: dict) -> str | None:
+    """``content.filename`` (new ai_news layout) or the root ``filename``."""
+    content = doc.get("content") or {}
+    if content.get("type") == "file" and content.get("filename"):
+        return content["filename"]
+    return doc.get("filename")
+
+
+def sha256_of(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(blob_store.UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# ---------------------------------------------------------------------
+# main routine
+# ---------------------------------------------------------------------
+
+
+async def run(mongo_uri: str, apply: bool, delete_originals: bool, recount: bool) -> int:
+    client = AsyncIOMotorClient(mongo_uri)
+    db = client.get_default_database()
+    started = time.perf_counter()
+
+    seen: dict[str, int] = {}          # sha256 -> size (already in store or ingested)
+    async for blob in db[blob_store.COLLECTION].find({}, {"size": 1}):
+        seen[blob["_id"]] = blob.get("size") or 0
+
+    migrated = ingested_bytes = saved_bytes = 0
+    missing: list[str] = []
+    referenced: set[Path] = set()
+
+    print(f"Blob store migration on {db.name} ({'apply' if apply else 'dry run'})")
+    for coll, legacy_dir in LEGACY_DIRS.items():
+        query = {"blob": {"$in": [None, ""]}}
+        async for doc in db[coll].find(query):
+            filename = legacy_filename(doc)
+            if not filename:
+                continue            # external link, no file
+            path = legacy_dir / filename
+            referenced.add(path.resolve())
+            if not path.is_file():
+                missing.append(f"{coll}/{doc['_id']}: {path}")
+                continue
+
+            if apply:
+                stored = await blob_store.put_file(db, path, doc.get("content_type"))
+                sha256, size = stored.sha256, stored.size
+                await db[coll].update_one(
+                    {"_id": doc["_id"]},
+                    {"$set": {"blob": sha256, "sha256": sha256, "size": size}},
+                )
+            else:
+                sha256 = await asyncio.to_thread(sha256_of, path)
+                size = path.stat().st_size
+
+            migrated += 1
+            ingested_bytes += size
+            if sha256 in seen:
+                saved_bytes += size
+            seen[sha256] = size
+            print(f"  {'ingested' if apply else 'would ingest':<13} {coll}/{doc['_id']}  {path} -> {sha256[:12]}")
+
+    # files in the legacy tree that no entry references
+    unreferenced = []
+    for root in {d for d in LEGACY_DIRS.values() if d.exists()}:
+        for path in root.rglob("*"):
+            if path.is_file() and path.resolve() not in referenced:
+                unreferenced.append(path)
+    # media/docs/ai_news is inside media/docs: drop duplicates
+    unreferenced = sorted(set(unreferenced))
+
+    elapsed = time.perf_counter() - started
+    mb = ingested_bytes / (1024 * 1024)
+    print(f"\n{migrated} entries, {mb:.1f} MB in {elapsed:.1f}s "
+          f"({migrated / elapsed if elapsed else 0:.1f} files/s, {mb / elapsed if elapsed else 0:.1f} MB/s)")
+    print(f"Deduplication saves {saved_bytes / (1024 * 1024):.1f} MB")
+
+    if missing:
+        print(f"\nMissing files ({len(missing)}):")
+        for line in missing:
+            print(f"  {line}")
+    if unreferenced:
+        print(f"\nUnreferenced files in the legacy tree ({len(unreferenced)}, left in place):")
+        for path in unreferenced:
+            print(f"  {path}")
+
+    if delete_originals and apply:
+        removed = 0
+        for path in referenced:
+            if path.is_file():
+                path.unlink()
+                removed += 1
+        print(f"\nRemoved {removed} migrated originals")
+
+    if recount:
+        report = await blob_store.recount(db, apply=apply)
+        print("\nReference counts:")
+        for key, rows in report.items():
+            print(f"  {key:<14} {len(rows)}")
+            for row in rows:
+                print(f"    {row}")
+
+    client.close()
+    return 1 if missing else 0
+
+
+# ---------------------------------------------------------------------
+# CLI entrypoint
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest media/docs into the content-addressed blob store")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/intranet", help="MongoDB URI (with database)")
+    parser.add_argument("--apply", action="store_true", help="Copy files and update entries (default: dry run)")
+    parser.add_argument("--delete-originals", action="store_true", help="With --apply: remove migrated legacy files")
+    parser.add_argument("--recount", action="store_true", help="Check (and with --apply fix) blob reference counts")
+
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.mongo, args.apply, args.delete_originals, args.recount)))
@@ -14,25 +14,10 @@ ws.addEventListener('message', function(event) {
     }
 
     try {
-        const data = JSON.parse(event.data);
-
-        // Controlla se il messaggio dal server contiene un header 'HX-Trigger'.
-        // Questo è un pattern potente che permette al server di scatenare
-        // eventi e comportamenti sul client in modo asincrono.
-        if (data.headers && data.headers['HX-Trigger']) {
-            const triggers = data.headers['HX-Trigger'];
-            console.log(`[WS -> HTMX] Ricevuto trigger via WebSocket:`, triggers);
-            
-            // HX-Trigger può essere una semplice stringa (nome dell'evento)
-            // o un oggetto JSON per passare dati più complessi.
-            if (typeof triggers === 'string') {
-                htmx.trigger('body', triggers, data.detail || {});
-            } else if (typeof triggers === 'object') {
-                for (const eventName in triggers) {
-                    htmx.trigger('body', eventName, triggers[eventName]);
-                }
-            }
-        }
+        const message = JSON.parse(event.data);
+        // Un frame `batch` contiene più eventi: ognuno può portare un HX-Trigger
+        const events = (message.type === 'batch' && Array.isArray(message.events)) ? message.events : [message];
+        events.forEach(applyHxTrigger);
     } catch (e) {
         // Questo blocco catch ignora silenziosamente i messaggi WebSocket
         // che non sono in formato JSON o non sono destinati a HTMX.
@@ -40,4 +25,24 @@ ws.addEventListener('message', function(event) {
     }
 });
 
+function applyHxTrigger(data) {
+    // Controlla se il messaggio dal server contiene un header 'HX-Trigger'.
+    // Questo è un pattern potente che permette al server di scatenare
+    // eventi e comportamenti sul client in modo asincrono.
+    if (data && data.headers && data.headers['HX-Trigger']) {
+        const triggers = data.headers['HX-Trigger'];
+        console.log(`[WS -> HTMX] Ricevuto trigger via WebSocket:`, triggers);
+        
+        // HX-Trigger può essere una semplice stringa (nome dell'evento)
+        // o un oggetto JSON per passare dati più complessi.
+        if (typeof triggers === 'string') {
+            htmx.trigger('body', triggers, data.detail || {});
+        } else if (typeof triggers === 'object') {
+            for (const eventName in triggers) {
+                htmx.trigger('body', eventName, triggers[eventName]);
+            }
+        }
+    }
+}
+
 console.log('[HTMX-WS] Bridge WebSocket -> HTMX inizializzato e in ascolto.'); 
\ No newline at end of file
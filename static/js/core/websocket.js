@@ -100,39 +100,20 @@ function connect() {
     };
 
     wsInstance.onmessage = (event) => {
+        let message;
         try {
-            const message = JSON.parse(event.data);
-
-            if (message.type === 'heartbeat' && message.status === 'acknowledged') {
-                handleHeartbeatAck();
-                return;
-            }
-            
-            if (message.type === 'error' || message.status === 'error') {
-                log.error('Messaggio di errore applicativo ricevuto:', message);
-                const errorMessage = message.data?.message || message.message || "Errore sconosciuto ricevuto dal server.";
-                const errorTitle = message.data?.title || "Errore dal Server";
-                showToast({ title: errorTitle, body: errorMessage, type: 'error' });
-                eventBus.emit('ws:message:error', {
-                    message: errorMessage,
-                    title: errorTitle,
-                    code: message.data?.code,
-                    details: message.data || message
-                });
-                return;
-            }
-
-            if (message.type) {
-                // Inoltra `message.data` se esiste e contiene le proprietà attese,
-                // altrimenti inoltra l'intero oggetto `message` per flessibilità.
-                // Questo assume che se `data` esiste, è il payload principale.
-                const payload = (typeof message.data !== 'undefined') ? message.data : message;
-                eventBus.emit(message.type, payload);
-            } else {
-                log.warn('Messaggio ricevuto senza un "type":', message);
-            }
+            message = JSON.parse(event.data);
         } catch (e) {
             log.warn('Ignorato messaggio non JSON o malformato:', event.data, e);
+            return;
+        }
+
+        // Il server può raggruppare più eventi in un unico frame
+        // (`broadcast_batch` lato backend): li gestiamo uno alla volta, in ordine.
+        if (message && message.type === 'batch' && Array.isArray(message.events)) {
+            message.events.forEach(handleMessage);
+        } else {
+            handleMessage(message);
         }
     };
 
@@ -147,6 +128,45 @@ function connect() {
 }
 
 
+/**
+ * Smista un singolo messaggio ricevuto dal server sull'eventBus.
+ * @param {object} message - Messaggio già decodificato.
+ */
+function handleMessage(message) {
+    try {
+        if (message.type === 'heartbeat' && message.status === 'acknowledged') {
+            handleHeartbeatAck();
+            return;
+        }
+
+        if (message.type === 'error' || message.status === 'error') {
+            log.error('Messaggio di errore applicativo ricevuto:', message);
+            const errorMessage = message.data?.message || message.message || "Errore sconosciuto ricevuto dal server.";
+            const errorTitle = message.data?.title || "Errore dal Server";
+            showToast({ title: errorTitle, body: errorMessage, type: 'error' });
+            eventBus.emit('ws:message:error', {
+                message: errorMessage,
+                title: errorTitle,
+                code: message.data?.code,
+                details: message.data || message
+            });
+            return;
+        }
+
+        if (message.type) {
+            // Inoltra `message.data` se esiste e contiene le proprietà attese,
+            // altrimenti inoltra l'intero oggetto `message` per flessibilità.
+            // Questo assume che se `data` esiste, è il payload principale.
+            const payload = (typeof message.data !== 'undefined') ? message.data : message;
+            eventBus.emit(message.type, payload);
+        } else {
+            log.warn('Messaggio ricevuto senza un "type":', message);
+        }
+    } catch (e) {
+        log.warn('Errore nella gestione del messaggio:', message, e);
+    }
+}
+
 function handleConnectionError(error) {
     // Funzione chiamata quando WebSocket constructor fallisce o per altri errori critici pre-onclose
     clearInterval(heartbeatIntervalTimer);
@@ -39,9 +39,21 @@ eventBus.on('ws:ai-news', p => { // p è il payload del messaggio WebSocket
         break;
 
       case 'comment/delete':
+        // Un solo evento per l'intero sottoalbero: reply_ids elenca le risposte eliminate a ogni livello
+        for (const replyId of p.data.reply_ids || []) {
+          chatState.removeComment(replyId);
+          eventBus.emit('chat:dom:remove', { commentId: replyId, newsId: p.data.news_id });
+        }
         chatState.removeComment(p.data.comment_id);
         eventBus.emit('chat:dom:remove', { commentId: p.data.comment_id, newsId: p.data.news_id }); // Passa newsId
         eventBus.emit('chat:badge:update', { newsId: p.data.news_id, totalComments: p.data.total_comments });
+        if (p.data.parent_id && p.data.parent_replies_count != null) {
+          eventBus.emit('chat:dom:update_reply_count', {
+            parentId: p.data.parent_id,
+            newCount: p.data.parent_replies_count,
+            newsId: p.data.news_id
+          });
+        }
         break;
 
       case 'reply/add':
@@ -49,7 +61,7 @@ eventBus.on('ws:ai-news', p => { // p è il payload del messaggio WebSocket
           chatState.addComment(p.data.reply);
           eventBus.emit('chat:dom:add', { commentData: p.data.reply, newsId: p.data.news_id }); // dom-renderer usa parent_id da commentData
           eventBus.emit('chat:dom:update_reply_count', {
-            commentId: p.data.parent_id,
+            parentId: p.data.parent_id,
             newCount: p.data.parent_replies_count,
             newsId: p.data.news_id // Aggiunto newsId per coerenza, anche se dom-renderer potrebbe non usarlo qui
           });
@@ -63,7 +75,7 @@ eventBus.on('ws:ai-news', p => { // p è il payload del messaggio WebSocket
           chatState.removeComment(p.data.reply_id);
           eventBus.emit('chat:dom:remove', { commentId: p.data.reply_id, newsId: p.data.news_id });
           eventBus.emit('chat:dom:update_reply_count', {
-            commentId: p.data.parent_id,
+            parentId: p.data.parent_id,
             newCount: p.data.parent_replies_count,
             newsId: p.data.news_id // Aggiunto newsId
           });
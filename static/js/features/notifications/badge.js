@@ -1,13 +1,13 @@
 import { eventBus } from "../../core/event-bus.js";
 
 /**
- * Trova tutti i badge che contano le notifiche e registra il refresh.
- * Badge HTML atteso:
- *   <span id="nav-news-badge"
- *         hx-get="/notifiche/count/news"
- *         hx-trigger="notifications.refresh from:body"
- *         hx-swap="innerHTML"
- *         hx-target="this">0</span>
+ * Registra il refresh dei badge della navbar.
+ * Tutti i badge sono aggiornati da un'unica richiesta (base.html):
+ *   <div id="nav-badges-refresh"
+ *        hx-get="/notifiche/badges"
+ *        hx-trigger="notifications.refresh from:body"
+ *        hx-swap="none"></div>
+ * che risponde con uno swap out-of-band per ogni container di badge.
  */
 export function initBadges() {
   // 1) Primo caricamento: scatena un refresh di tutti i badge HTMX